@@ -1,46 +1,111 @@
-from django.contrib import admin
-from .models import UserProfile, AffiliateLink, Transaction, Withdrawal
+import hashlib
+import time
+
+from django.contrib import admin, messages
+from django.db import transaction as db_transaction
+from django.utils import timezone
+from .models import (
+    UserProfile, AffiliateLink, Transaction, Withdrawal, ClickRollup, UserStats, LedgerEntry, Job, CommissionRule,
+)
+from .exports import streaming_response
+from .holds import hold
+from .jobs import enqueue
+from .stats import apply_site_stats
+
+# Seconds in which repeating an action on the same rows returns the job already queued
+DOUBLE_SUBMIT_WINDOW = 60
+
+def selection_key(job_name, ids):
+    """
+    Idempotency key for running `job_name` on `ids` from the admin. It changes
+    every DOUBLE_SUBMIT_WINDOW seconds, so a double submit maps to one job but
+    running the action again later (say, after the job failed) queues a new one.
+    A resubmit that straddles the window's end can still queue twice; the jobs
+    are safe to run twice.
+    """
+    digest = hashlib.sha1(','.join(map(str, ids)).encode()).hexdigest()
+    return f'admin:{job_name}:{digest}:{int(time.time() // DOUBLE_SUBMIT_WINDOW)}'
+
+def enqueue_for_selection(modeladmin, request, queryset, job_name, description):
+    """Queue `job_name` for the selected rows and tell the admin which job will do it."""
+    ids = sorted(queryset.values_list('pk', flat=True))
+    job = enqueue(job_name, {'ids': ids}, idempotency_key=selection_key(job_name, ids))
+    if job.status in ('queued', 'running'):
+        modeladmin.message_user(request, f"{description} of {len(ids)} rows is queued as job #{job.pk}.")
+    else:
+        modeladmin.message_user(
+            request, f"{description} of these rows already ran as job #{job.pk} ({job.get_status_display()}).",
+            messages.WARNING,
+        )
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
-    list_display = ('user', 'phone_number', 'balance')
+    list_display = ('user', 'phone_number', 'balance', 'held')
     search_fields = ('user__username', 'user__email', 'phone_number')
 
+@admin.register(UserStats)
+class UserStatsAdmin(admin.ModelAdmin):
+    list_display = ('user', 'total_orders', 'approved_count', 'pending_count', 'approved_cashback',
+                   'link_count', 'total_withdrawn', 'updated_at')
+    search_fields = ('user__username',)
+    readonly_fields = ('user',) + tuple(f.name for f in UserStats._meta.fields if f.name not in ('id', 'user'))
+    
+    actions = ['rebuild_stats']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def rebuild_stats(self, request, queryset):
+        user_ids = sorted(queryset.values_list('user_id', flat=True))
+        job = enqueue(
+            'rebuild_user_stats', {'user_ids': user_ids}, idempotency_key=selection_key('rebuild_user_stats', user_ids),
+        )
+        self.message_user(request, f"Queued a rebuild of {len(user_ids)} user stats rows as job #{job.pk}.")
+    rebuild_stats.short_description = "Rebuild selected user stats"
+
 @admin.register(AffiliateLink)
 class AffiliateLinkAdmin(admin.ModelAdmin):
-    list_display = ('user', 'original_link', 'converted_link', 'created_at')
+    list_display = ('user', 'original_link', 'tracking_link', 'click_count', 'created_at')
     list_filter = ('created_at',)
     search_fields = ('user__username', 'original_link', 'converted_link')
     date_hierarchy = 'created_at'
+    
+    def tracking_link(self, obj):
+        return obj.converted_link or obj.get_absolute_url()
+    tracking_link.short_description = "Converted link"
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('user', 'product_name', 'product_price', 'estimated_commission', 
                    'cashback_amount', 'status', 'created_at')
     list_filter = ('status', 'created_at')
-    search_fields = ('user__username', 'product_name')
+    search_fields = ('user__username', 'product_name', 'external_id', 'shop_id', 'category')
     date_hierarchy = 'created_at'
     
-    actions = ['approve_transactions', 'reject_transactions']
+    actions = ['approve_transactions', 'reject_transactions', 'export_csv', 'export_ndjson']
     
     def approve_transactions(self, request, queryset):
-        for transaction in queryset.filter(status='pending'):
-            # Update transaction status
-            transaction.status = 'approved'
-            transaction.save()
-            
-            # Add cashback to user's balance
-            profile = transaction.user.profile
-            profile.balance += transaction.cashback_amount
-            profile.save()
-        
-        self.message_user(request, f"{queryset.filter(status='pending').count()} transactions have been approved.")
+        enqueue_for_selection(self, request, queryset, 'approve_transactions', 'Approval')
     approve_transactions.short_description = "Approve selected transactions"
     
     def reject_transactions(self, request, queryset):
-        queryset.filter(status='pending').update(status='rejected')
-        self.message_user(request, f"{queryset.filter(status='pending').count()} transactions have been rejected.")
+        enqueue_for_selection(self, request, queryset, 'reject_transactions', 'Rejection')
     reject_transactions.short_description = "Reject selected transactions"
+    
+    def export_csv(self, request, queryset):
+        return streaming_response('transactions', queryset, 'csv')
+    export_csv.short_description = "Export selected transactions as CSV"
+    
+    def export_ndjson(self, request, queryset):
+        return streaming_response('transactions', queryset, 'ndjson')
+    export_ndjson.short_description = "Export selected transactions as NDJSON"
+
+@admin.register(CommissionRule)
+class CommissionRuleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'shop_id', 'category', 'commission_rate', 'cashback_rate', 'starts_at', 'ends_at',
+                   'priority', 'is_active')
+    list_filter = ('is_active',)
+    search_fields = ('name', 'shop_id', 'category')
 
 @admin.register(Withdrawal)
 class WithdrawalAdmin(admin.ModelAdmin):
@@ -50,16 +115,105 @@ class WithdrawalAdmin(admin.ModelAdmin):
     search_fields = ('user__username', 'payment_details')
     date_hierarchy = 'requested_at'
     
-    actions = ['approve_withdrawals', 'reject_withdrawals']
+    actions = ['approve_withdrawals', 'reject_withdrawals', 'export_csv', 'export_ndjson']
+    
+    def get_readonly_fields(self, request, obj=None):
+        # New withdrawals start pending and hold their amount; settled ones are final
+        if obj is None:
+            return ('status', 'processed_at')
+        if obj.status != 'pending':
+            return ('user', 'amount', 'status', 'processed_at')
+        return ('user', 'processed_at')
+    
+    def save_model(self, request, obj, form, change):
+        """
+        Save the form. A pending withdrawal's new status is applied through
+        settlement, which debits the balance and releases the hold, and a new
+        amount moves the hold by the difference.
+        """
+        if not change:
+            super().save_model(request, obj, form, change)
+            return
+        status = obj.status
+        with db_transaction.atomic():
+            # Settled since the form was loaded: settlement has already dealt with it
+            current = Withdrawal.objects.select_for_update().get(pk=obj.pk)
+            obj.status = current.status
+            if current.status != 'pending':
+                obj.amount = current.amount
+            elif obj.amount != current.amount:
+                hold(obj.user_id, obj.amount - current.amount)
+                apply_site_stats(pending_withdrawal_amount=obj.amount - current.amount)
+            super().save_model(request, obj, form, change)
+            if status == 'approved':
+                obj.approve()
+            elif status == 'rejected':
+                obj.reject()
     
     def approve_withdrawals(self, request, queryset):
-        for withdrawal in queryset.filter(status='pending'):
-            withdrawal.approve()
-        
-        self.message_user(request, f"{queryset.filter(status='pending').count()} withdrawals have been approved.")
+        enqueue_for_selection(self, request, queryset, 'approve_withdrawals', 'Approval')
     approve_withdrawals.short_description = "Approve selected withdrawals"
     
     def reject_withdrawals(self, request, queryset):
-        queryset.filter(status='pending').update(status='rejected')
-        self.message_user(request, f"{queryset.filter(status='pending').count()} withdrawals have been rejected.")
+        enqueue_for_selection(self, request, queryset, 'reject_withdrawals', 'Rejection')
     reject_withdrawals.short_description = "Reject selected withdrawals"
+    
+    def export_csv(self, request, queryset):
+        return streaming_response('withdrawals', queryset, 'csv')
+    export_csv.short_description = "Export selected withdrawals as CSV"
+    
+    def export_ndjson(self, request, queryset):
+        return streaming_response('withdrawals', queryset, 'ndjson')
+    export_ndjson.short_description = "Export selected withdrawals as NDJSON"
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'user', 'entry_type', 'amount', 'transaction_id', 'withdrawal_id', 'memo')
+    list_filter = ('entry_type', 'created_at')
+    search_fields = ('user__username', 'memo')
+    date_hierarchy = 'created_at'
+    list_select_related = ('user',)
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'max_attempts', 'run_at', 'locked_by',
+                   'created_at', 'finished_at')
+    list_filter = ('status', 'name')
+    search_fields = ('name', 'idempotency_key', 'locked_by')
+    date_hierarchy = 'created_at'
+    readonly_fields = tuple(f.name for f in Job._meta.fields)
+    
+    actions = ['retry_jobs']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def retry_jobs(self, request, queryset):
+        count = queryset.filter(status='failed').update(status='queued', attempts=0, run_at=timezone.now(),
+                                                       finished_at=None)
+        self.message_user(request, f"{count} failed jobs have been queued again.")
+    retry_jobs.short_description = "Retry selected failed jobs"
+
+@admin.register(ClickRollup)
+class ClickRollupAdmin(admin.ModelAdmin):
+    list_display = ('bucket_start', 'period', 'user', 'link', 'clicks')
+    list_filter = ('period', 'bucket_start')
+    search_fields = ('user__username',)
+    date_hierarchy = 'bucket_start'
+    list_select_related = ('user', 'link')
+    raw_id_fields = ('user', 'link')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
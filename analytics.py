@@ -0,0 +1,292 @@
+"""
+Earnings and click time series for charts.
+
+EarningsRollup keeps daily, weekly and monthly buckets per link, per user
+and for the whole site, so a series is one range read on the unique index
+of its scope, whatever its length. The buckets are filled incrementally,
+each source from the high-water mark of its RollupCheckpoint, never by
+recomputing history:
+
+- Transactions: orders and estimated commission, on the day the
+  transaction was recorded. Later changes to a transaction (settlement,
+  revised estimates, deletion) do not move them.
+- Ledger entries: cashback credited, net of reversals, on the day it was
+  credited. The ledger is append-only, so these are exact.
+- Clicks: `clicks.rollup_clicks` folds each batch of ClickEvents in here as
+  well as into the hourly and daily ClickRollups. The first
+  `rollup_earnings` run seeds them from the daily ClickRollups, which
+  still count events that have since been pruned.
+
+Days follow the current time zone; weeks start on Monday.
+
+Ids are handed out when rows are inserted but only become visible when
+their transaction commits, so a row can appear after rows with higher ids
+have been rolled up. Every rollup therefore stops at `rollup_limit`, which
+trails the newest id by ROLLUP_LAG_SECONDS.
+"""
+import calendar
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import ClickRollup, EarningsRollup, LedgerEntry, RollupCheckpoint, Transaction
+
+PERIODS = ('day', 'week', 'month')
+SERIES_FIELDS = ('orders', 'commission', 'cashback', 'clicks')
+BATCH_SIZE = 50000
+# A daily series of a (leap) year, with room to spare
+MAX_BUCKETS = 400
+
+TRANSACTIONS_CHECKPOINT = 'earnings_transactions'
+LEDGER_CHECKPOINT = 'earnings_ledger'
+# Exists once clicks have been seeded; rollup_clicks only folds clicks in after that
+CLICKS_CHECKPOINT = 'earnings_clicks'
+
+
+def bucket_start(day, period):
+    """The first day of the `period` bucket containing `day`."""
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start, period):
+    if period == 'week':
+        return start + timedelta(days=7)
+    if period == 'month':
+        return start + timedelta(days=calendar.monthrange(start.year, start.month)[1])
+    return start + timedelta(days=1)
+
+
+def bucket_starts(first, last, period):
+    """Every bucket start from the bucket containing `first` to the one containing `last`."""
+    start, last = bucket_start(first, period), bucket_start(last, period)
+    while start <= last:
+        yield start
+        start = next_bucket(start, period)
+
+
+def _add(increments, user_id, link_id, day, **values):
+    """Count `values` on `day` towards every period, for the link, its user and the site."""
+    scopes = [(None, None), (user_id, None)]
+    if link_id is not None:
+        scopes.append((user_id, link_id))
+    for period in PERIODS:
+        start = bucket_start(day, period)
+        for scope in scopes:
+            totals = increments[(*scope, period, start)]
+            for field, value in values.items():
+                totals[field] += value
+
+
+def _fold(increments, batch_size=500):
+    """Add {(user_id, link_id, period, bucket_start): {field: delta}} into EarningsRollup."""
+    if not increments:
+        return
+    starts = [key[3] for key in increments]
+    in_range = EarningsRollup.objects.filter(bucket_start__gte=min(starts), bucket_start__lte=max(starts))
+    user_ids = sorted({user_id for user_id, _, _, _ in increments if user_id is not None})
+    candidates = [in_range.filter(user__isnull=True)]
+    candidates += [
+        in_range.filter(user_id__in=user_ids[i:i + batch_size]) for i in range(0, len(user_ids), batch_size)
+    ]
+
+    to_update = []
+    for rollups in candidates:
+        for rollup in rollups:
+            key = (rollup.user_id, rollup.link_id, rollup.period, rollup.bucket_start)
+            if key in increments:
+                for field, value in increments.pop(key).items():
+                    setattr(rollup, field, getattr(rollup, field) + value)
+                to_update.append(rollup)
+    EarningsRollup.objects.bulk_update(to_update, SERIES_FIELDS, batch_size=batch_size)
+    EarningsRollup.objects.bulk_create(
+        [
+            EarningsRollup(user_id=user_id, link_id=link_id, period=period, bucket_start=start, **totals)
+            for (user_id, link_id, period, start), totals in increments.items()
+        ],
+        batch_size=batch_size,
+    )
+
+
+def _transaction_increments(transactions, increments):
+    rows = (
+        transactions.order_by()
+        .annotate(day=TruncDate('created_at'))
+        .values('user_id', 'affiliate_link_id', 'day')
+        .annotate(orders=Count('id'), commission=Sum('estimated_commission'))
+    )
+    for row in rows:
+        _add(increments, row['user_id'], row['affiliate_link_id'], row['day'],
+             orders=row['orders'], commission=row['commission'] or 0)
+
+
+def _ledger_increments(entries, increments):
+    rows = (
+        entries.filter(entry_type__in=('cashback', 'reversal'))
+        .order_by()
+        .annotate(day=TruncDate('created_at'))
+        .values('user_id', 'transaction__affiliate_link_id', 'day')
+        .annotate(cashback=Sum('amount'))
+    )
+    for row in rows:
+        _add(increments, row['user_id'], row['transaction__affiliate_link_id'], row['day'], cashback=row['cashback'])
+
+
+def rollup_limit(name, model):
+    """
+    Return the highest id of `model` that checkpoint `name` may roll up now.
+
+    Each call notes the newest id in a '<name>:horizon' checkpoint; once
+    that note is ROLLUP_LAG_SECONDS old, every id up to it is released and
+    the newest id is noted again. Until then nothing new is released, so a
+    row is rolled up between one and two lags after it was inserted, plus
+    the interval between runs. A transaction that stays open for longer
+    than the lag after inserting can still be skipped.
+    """
+    newest = model.objects.aggregate(newest=Max('id'))['newest'] or 0
+    lag = getattr(settings, 'ROLLUP_LAG_SECONDS', 60)
+    if not lag:
+        return newest
+    with transaction.atomic():
+        position = RollupCheckpoint.objects.get_or_create(name=name)[0].position
+        horizon, created = RollupCheckpoint.objects.select_for_update().get_or_create(
+            name=f'{name}:horizon', defaults={'position': newest},
+        )
+        if created or horizon.updated_at > timezone.now() - timedelta(seconds=lag):
+            return position
+        limit = horizon.position
+        horizon.position = newest
+        horizon.save(update_fields=['position', 'updated_at'])
+    return limit
+
+
+def _rollup_source(name, model, collect, batch_size):
+    """Fold rows of `model` past checkpoint `name` in id batches. Returns the number of rows."""
+    processed = 0
+    limit = rollup_limit(name, model)
+    while True:
+        with transaction.atomic():
+            checkpoint, _ = RollupCheckpoint.objects.select_for_update().get_or_create(name=name)
+            ids = (
+                model.objects.filter(id__gt=checkpoint.position, id__lte=limit)
+                .order_by('id').values_list('id', flat=True)
+            )
+            upper = next(iter(ids[batch_size - 1:batch_size]), None) or ids.last()
+            if upper is None:
+                return processed
+            rows = model.objects.filter(id__gt=checkpoint.position, id__lte=upper)
+            count = rows.count()
+            increments = defaultdict(Counter)
+            collect(rows, increments)
+            _fold(increments)
+            checkpoint.position = upper
+            checkpoint.save(update_fields=['position', 'updated_at'])
+        processed += count
+
+
+def _seed_clicks(batch_size):
+    with transaction.atomic():
+        # Holding the clicks checkpoint keeps rollup_clicks out until the seed is in
+        clicks, _ = RollupCheckpoint.objects.select_for_update().get_or_create(name='clicks')
+        _, created = RollupCheckpoint.objects.get_or_create(
+            name=CLICKS_CHECKPOINT, defaults={'position': clicks.position},
+        )
+        if not created:
+            return
+        daily = (
+            ClickRollup.objects.filter(period='day', link__isnull=False)
+            .values_list('user_id', 'link_id', 'bucket_start', 'clicks')
+            .iterator(chunk_size=batch_size)
+        )
+        increments = defaultdict(Counter)
+        for seen, (user_id, link_id, start, count) in enumerate(daily, 1):
+            _add(increments, user_id, link_id, timezone.localdate(start), clicks=count)
+            if seen % batch_size == 0:
+                _fold(increments)
+                increments = defaultdict(Counter)
+        _fold(increments)
+
+
+def fold_clicks(events, position):
+    """
+    Count a batch of ClickEvents, up to id `position`, into the rollups.
+    Called by `rollup_clicks` inside its transaction; does nothing until
+    `rollup_earnings` has seeded the clicks.
+    """
+    if not RollupCheckpoint.objects.filter(name=CLICKS_CHECKPOINT).update(position=position):
+        return
+    rows = (
+        events.order_by()
+        .annotate(day=TruncDate('clicked_at'))
+        .values('link_id', 'link__user_id', 'day')
+        .annotate(clicks=Count('id'))
+    )
+    increments = defaultdict(Counter)
+    for row in rows:
+        _add(increments, row['link__user_id'], row['link_id'], row['day'], clicks=row['clicks'])
+    _fold(increments)
+
+
+def rollup_earnings(batch_size=BATCH_SIZE):
+    """Fold new transactions and ledger entries into the rollups. Returns the number of rows processed."""
+    _seed_clicks(batch_size)
+    return (
+        _rollup_source(TRANSACTIONS_CHECKPOINT, Transaction, _transaction_increments, batch_size)
+        + _rollup_source(LEDGER_CHECKPOINT, LedgerEntry, _ledger_increments, batch_size)
+    )
+
+
+def merge_link_rollups(survivor, duplicate_ids):
+    """Move the per-link rollups of links merged into `survivor` onto it."""
+    rollups = EarningsRollup.objects.filter(link_id__in=duplicate_ids)
+    increments = defaultdict(Counter)
+    for period, start, *values in rollups.values_list('period', 'bucket_start', *SERIES_FIELDS):
+        totals = increments[(survivor.user_id, survivor.pk, period, start)]
+        for field, value in zip(SERIES_FIELDS, values):
+            totals[field] += value
+    if increments:
+        rollups.delete()
+        _fold(increments)
+
+
+def earnings_series(period, first, last, user=None, link=None):
+    """
+    Return the `period` series from the bucket containing date `first` to
+    the one containing `last`, for `link`, `user` or (with neither) the
+    whole site, as {'period', 'labels', 'orders', 'commission', 'cashback',
+    'clicks'} with one value per bucket and zeroes for empty buckets.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period {period!r}.")
+    if first > last:
+        raise ValueError("The series ends before it starts.")
+    starts = list(bucket_starts(first, last, period))
+    if len(starts) > MAX_BUCKETS:
+        raise ValueError(f"A series is limited to {MAX_BUCKETS} buckets.")
+
+    if link is not None:
+        scope = Q(link=link)
+    elif user is not None:
+        scope = Q(user=user, link__isnull=True)
+    else:
+        scope = Q(user__isnull=True, link__isnull=True)
+    rows = EarningsRollup.objects.filter(
+        scope, period=period, bucket_start__gte=starts[0], bucket_start__lte=starts[-1],
+    ).values_list('bucket_start', *SERIES_FIELDS)
+    found = {start: values for start, *values in rows}
+
+    empty = (0,) * len(SERIES_FIELDS)
+    series = {'period': period, 'labels': [start.isoformat() for start in starts]}
+    for i, field in enumerate(SERIES_FIELDS):
+        series[field] = [found.get(start, empty)[i] for start in starts]
+    for field in ('commission', 'cashback'):
+        series[field] = [float(value) for value in series[field]]
+    return series
@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'generateshoppe.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after the app registry is ready; serves tracking redirects without the middleware stack
+from shoppelink.asgi_redirects import TrackingRedirectApp  # noqa: E402
+
+application = TrackingRedirectApp(django_application)
@@ -0,0 +1,107 @@
+"""
+ASGI fast path for tracking redirects.
+
+Under ASGI, every request through Django's handler hops to a worker thread
+for the request signals and for each synchronous middleware, which caps
+redirect throughput at roughly the thread pool's speed. A tracking redirect
+needs none of that: no session, no user, no CSRF. `TrackingRedirectApp`
+answers requests for `track_link_click` and `track_short_link` directly on
+the event loop from the redirect caches, and hands every other request to
+the wrapped Django application unchanged.
+
+Only paths under the tracking prefixes are resolved at all. The fast path
+still builds an ASGIRequest, so the Host header is checked against
+ALLOWED_HOSTS by Django's own `get_host()`, and it runs the header-only
+security middleware over the redirect: SecurityMiddleware (HTTPS redirect,
+HSTS, nosniff, referrer policy) and XFrameOptionsMiddleware. A request those
+would reject or redirect goes through Django instead, which answers it the
+usual way.
+"""
+from functools import cached_property
+from io import BytesIO
+
+from django.core.exceptions import DisallowedHost
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponseRedirect
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.middleware.security import SecurityMiddleware
+from django.urls import NoReverseMatch, Resolver404, resolve, reverse
+
+from .clicks import click_buffer, client_fingerprint
+from .redirect_cache import redirect_cache, short_code_cache
+from .shortcodes import is_valid_code
+
+
+def _no_response(request):
+    raise AssertionError("The fast path only uses the middleware's request and response hooks")
+
+
+class TrackingRedirectApp:
+    def __init__(self, application, url_name='track_link_click', short_url_name='track_short_link'):
+        self.application = application
+        self.url_name = url_name
+        self.short_url_name = short_url_name
+        self.security = SecurityMiddleware(_no_response)
+        self.frame_options = XFrameOptionsMiddleware(_no_response)
+
+    @cached_property
+    def prefixes(self):
+        """Path prefixes of the tracking routes, e.g. ('/t/', '/s/')."""
+        prefixes = []
+        for name, kwargs in ((self.url_name, {'link_id': 0}), (self.short_url_name, {'code': '0'})):
+            try:
+                path = reverse(name, kwargs=kwargs)
+            except NoReverseMatch:
+                continue
+            prefixes.append(path[:path.rindex('0')])
+        return tuple(prefixes)
+
+    async def resolve_link(self, match):
+        """Return (link_id, original_link) for a tracking URL match, or None."""
+        if match.url_name == self.short_url_name:
+            code = match.kwargs['code']
+            return await short_code_cache.aget(code) if is_valid_code(code) else None
+        if match.url_name == self.url_name:
+            target = await redirect_cache.aget(match.kwargs['link_id'])
+            return (match.kwargs['link_id'], target) if target is not None else None
+        return None
+
+    async def redirect(self, scope):
+        """Return the redirect response for a tracking request, or None to leave it to Django."""
+        try:
+            match = resolve(scope['path'])
+        except Resolver404:
+            return None
+        request = ASGIRequest(scope, BytesIO())
+        try:
+            request.get_host()
+        except DisallowedHost:
+            return None
+        if self.security.process_request(request) is not None:
+            return None
+        resolved = await self.resolve_link(match)
+        if resolved is None:
+            return None
+        link_id, target = resolved
+        click_buffer.record(link_id, client_fingerprint(request), background=True)
+        response = HttpResponseRedirect(target)
+        response['Content-Length'] = '0'
+        response['Cache-Control'] = 'no-store'
+        response = self.security.process_response(request, response)
+        return self.frame_options.process_response(request, response)
+
+    async def __call__(self, scope, receive, send):
+        response = None
+        if (scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD')
+                and scope['path'].startswith(self.prefixes)):
+            response = await self.redirect(scope)
+        if response is None:
+            # Everything else, including unknown links (for the usual 404 page), goes through Django
+            await self.application(scope, receive, send)
+            return
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.items()],
+        })
+        await send({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,268 @@
+"""
+Write-behind click counting for the tracking redirect.
+
+`track_link_click` used to do a read plus an UPDATE on every hit, which on
+SQLite serializes all redirects behind the database write lock. Instead,
+clicks are counted in a per-process buffer and written back in batches with
+`F()` updates, either when the buffer reaches CLICK_BUFFER_MAX_PENDING
+clicks or when CLICK_BUFFER_FLUSH_INTERVAL seconds have passed.
+
+Durability bound: the buffer lives in process memory, so a worker that is
+killed without running its exit hooks (SIGKILL, OOM, power loss) loses at
+most the clicks recorded since its last flush, i.e. fewer than
+CLICK_BUFFER_MAX_PENDING clicks and no more than CLICK_BUFFER_FLUSH_INTERVAL
+seconds of traffic per worker process. A normal shutdown flushes the buffer.
+
+Each flush also appends the individual clicks to ClickEvent. `rollup_clicks`
+folds new events into hourly and daily ClickRollup buckets, tracking its
+progress in a RollupCheckpoint (lagging behind the newest events, see
+analytics.rollup_limit), and prunes events older than
+CLICK_EVENT_RETENTION_DAYS once they have been rolled up. The same batches
+feed the click counts of the earnings series (see analytics.py).
+"""
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from . import analytics
+from .models import AffiliateLink, ClickEvent, ClickRollup, LinkAlias, RollupCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+class ClickBuffer:
+    """Thread-safe, in-process counter of clicks not yet written to the database."""
+
+    def __init__(self, max_pending=500, flush_interval=5.0):
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._counts = Counter()
+        self._events = []
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self._wake = threading.Event()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def record(self, link_id, fingerprint='', background=False):
+        """Queue a click on `link_id`, flushing if a threshold is hit.
+
+        With `background=True` a due flush is handed to the timer thread
+        instead of running inline, so async callers never block on the
+        database.
+        """
+        with self._lock:
+            self._counts[link_id] += 1
+            self._events.append(ClickEvent(link_id=link_id, clicked_at=timezone.now(), fingerprint=fingerprint))
+            self._pending += 1
+            due = (
+                self._pending >= self.max_pending
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        self._ensure_timer()
+        if due and background:
+            self._wake.set()
+        elif due:
+            self.flush()
+
+    def flush(self, retry=True):
+        """Write all buffered clicks to the database. Returns the number of clicks written.
+
+        If the write fails the clicks stay buffered for the next flush, or
+        with `retry=False` (the last flush at exit) are dropped.
+        """
+        # Only one thread writes at a time; others keep buffering meanwhile.
+        if not self._flush_lock.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                counts, self._counts = self._counts, Counter()
+                events, self._events = self._events, []
+                self._pending = 0
+                self._last_flush = time.monotonic()
+            if not counts:
+                return 0
+            try:
+                write_clicks(counts, events)
+            except Exception as e:
+                if not retry:
+                    logger.warning("Dropped %d buffered clicks: %s", sum(counts.values()), e)
+                    return 0
+                # Put the clicks back so the next flush retries them.
+                logger.exception("Failed to flush %d buffered clicks", sum(counts.values()))
+                with self._lock:
+                    self._counts.update(counts)
+                    self._events[:0] = events
+                    self._pending += sum(counts.values())
+                return 0
+            return sum(counts.values())
+        finally:
+            self._flush_lock.release()
+
+    def discard(self):
+        """Drop all buffered clicks without writing them."""
+        with self._lock:
+            self._counts = Counter()
+            self._events = []
+            self._pending = 0
+
+    def _ensure_timer(self):
+        if self._timer is not None and self._timer.is_alive():
+            return
+        with self._lock:
+            if self._timer is not None and self._timer.is_alive():
+                return
+            self._timer = threading.Thread(target=self._run_timer, name='click-buffer-flush', daemon=True)
+            self._timer.start()
+
+    def _run_timer(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._pending:
+                self.flush()
+
+
+def write_clicks(counts, events):
+    """Apply a {link_id: clicks} mapping with one UPDATE per distinct increment and log the events."""
+    with transaction.atomic():
+        existing = set(AffiliateLink.objects.filter(id__in=counts).values_list('id', flat=True))
+        missing = counts.keys() - existing
+        if missing:
+            # Clicks on links merged into another one count towards the surviving link
+            aliases = dict(LinkAlias.objects.filter(alias_id__in=missing).values_list('alias_id', 'link_id'))
+            if aliases:
+                remapped = Counter()
+                for link_id, count in counts.items():
+                    remapped[aliases.get(link_id, link_id)] += count
+                counts = remapped
+                for event in events:
+                    event.link_id = aliases.get(event.link_id, event.link_id)
+                existing.update(aliases.values())
+
+        by_increment = defaultdict(list)
+        for link_id, count in counts.items():
+            if link_id in existing:
+                by_increment[count].append(link_id)
+        for count, link_ids in by_increment.items():
+            AffiliateLink.objects.filter(id__in=link_ids).update(click_count=F('click_count') + count)
+        # Links deleted while their clicks were buffered are dropped.
+        ClickEvent.objects.bulk_create(
+            [event for event in events if event.link_id in existing], batch_size=500
+        )
+
+
+def client_fingerprint(request):
+    """Return a short, salted hash identifying the client without storing its IP."""
+    raw = '|'.join([
+        request.META.get('REMOTE_ADDR', ''),
+        request.META.get('HTTP_USER_AGENT', ''),
+        settings.SECRET_KEY,
+    ])
+    return hashlib.blake2b(raw.encode(), digest_size=8).hexdigest()
+
+
+def _fold_buckets(events, trunc, period):
+    """Add event counts per (link, bucket) and per (user, bucket) into ClickRollup."""
+    rows = (
+        events.annotate(bucket=trunc('clicked_at'))
+        .values('link_id', 'link__user_id', 'bucket')
+        .annotate(clicks=Count('id'))
+    )
+    per_link = {}
+    per_user = Counter()
+    for row in rows:
+        per_link[(row['link_id'], row['bucket'])] = (row['link__user_id'], row['clicks'])
+        per_user[(row['link__user_id'], row['bucket'])] += row['clicks']
+    if not per_link:
+        return
+
+    buckets = {bucket for _, bucket in per_link}
+    existing = ClickRollup.objects.filter(period=period, bucket_start__in=buckets)
+    to_update = []
+    for rollup in existing.filter(link_id__in={link_id for link_id, _ in per_link}):
+        key = (rollup.link_id, rollup.bucket_start)
+        if key in per_link:
+            rollup.clicks += per_link.pop(key)[1]
+            to_update.append(rollup)
+    for rollup in existing.filter(link__isnull=True, user_id__in={user_id for user_id, _ in per_user}):
+        key = (rollup.user_id, rollup.bucket_start)
+        if key in per_user:
+            rollup.clicks += per_user.pop(key)
+            to_update.append(rollup)
+
+    ClickRollup.objects.bulk_update(to_update, ['clicks'], batch_size=500)
+    ClickRollup.objects.bulk_create(
+        [
+            ClickRollup(user_id=user_id, link_id=link_id, period=period, bucket_start=bucket, clicks=clicks)
+            for (link_id, bucket), (user_id, clicks) in per_link.items()
+        ] + [
+            ClickRollup(user_id=user_id, period=period, bucket_start=bucket, clicks=clicks)
+            for (user_id, bucket), clicks in per_user.items()
+        ],
+        batch_size=500,
+    )
+
+
+def rollup_clicks(batch_size=50000):
+    """Fold ClickEvents newer than the checkpoint into hourly and daily rollups.
+
+    Returns the number of events processed.
+    """
+    processed = 0
+    # Events committed out of id order are waited for (see analytics.rollup_limit)
+    limit = analytics.rollup_limit('clicks', ClickEvent)
+    while True:
+        with transaction.atomic():
+            checkpoint, _ = RollupCheckpoint.objects.select_for_update().get_or_create(name='clicks')
+            ids = (
+                ClickEvent.objects.filter(id__gt=checkpoint.position, id__lte=limit)
+                .order_by('id').values_list('id', flat=True)
+            )
+            upper = next(iter(ids[batch_size - 1:batch_size]), None) or ids.last()
+            if upper is None:
+                return processed
+            events = ClickEvent.objects.filter(id__gt=checkpoint.position, id__lte=upper)
+            count = events.count()
+            _fold_buckets(events, TruncHour, 'hour')
+            _fold_buckets(events, TruncDay, 'day')
+            analytics.fold_clicks(events, upper)
+            checkpoint.position = upper
+            checkpoint.save(update_fields=['position', 'updated_at'])
+        processed += count
+
+
+def prune_click_events(retention_days=None):
+    """Delete rolled-up ClickEvents older than the retention window. Returns the number deleted."""
+    if retention_days is None:
+        retention_days = getattr(settings, 'CLICK_EVENT_RETENTION_DAYS', 30)
+    checkpoint = RollupCheckpoint.objects.filter(name='clicks').first()
+    if checkpoint is None:
+        return 0
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    deleted, _ = ClickEvent.objects.filter(id__lte=checkpoint.position, clicked_at__lt=cutoff).delete()
+    return deleted
+
+
+click_buffer = ClickBuffer(
+    max_pending=getattr(settings, 'CLICK_BUFFER_MAX_PENDING', 500),
+    flush_interval=getattr(settings, 'CLICK_BUFFER_FLUSH_INTERVAL', 5.0),
+)
+
+# Nothing is retried at exit, and the database may already be gone (e.g. a destroyed test database)
+atexit.register(click_buffer.flush, retry=False)
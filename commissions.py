@@ -0,0 +1,275 @@
+"""
+Commission and cashback rates.
+
+A CommissionRule gives the commission rate (the share of the product price
+the network pays) and the cashback rate (the share of that commission
+passed on to the user) for a shop, a category, both or neither, optionally
+limited to a campaign period. The most specific rule wins: shop and
+category, then shop, then category, then the catch-all. Among overlapping
+rules for the same shop and category, the highest priority wins, then the
+latest start. Where no rule applies, COMMISSION_DEFAULT_RATE and
+CASHBACK_DEFAULT_RATE do.
+
+Rules are compiled into a RuleIndex: a dict keyed on (shop_id, category)
+whose values are the sorted boundaries at which the winning rule changes,
+searched with bisect. Each process keeps one compiled index and rebuilds
+it when the rule set's version (rule count and latest update) changes.
+The version is checked at most every COMMISSION_RULES_CHECK_SECONDS, and
+saving or deleting a rule also drops the local copy at once. Rules changed
+with queryset.update() do not bump the version; use save().
+
+Evaluating rules never queries the database, so `evaluate_many` prices
+thousands of transactions with at most one version check.
+
+When rates change, `recompute_range` re-prices pending transactions. The
+pending rows are split into ID ranges and each range is walked in primary
+key order, one locked chunk per database transaction. Changed rows are
+written with bulk_update, and the last ID done is recorded in a
+RollupCheckpoint, so ranges can run in parallel processes and an
+interrupted run resumes where it stopped. A run also records the version
+of the rule set it prices with; once the rules change, running it again
+starts over from the first range, so that every pending row gets the new
+rates, rather than resuming a run that has long finished. Settled
+transactions are never touched: their cashback is already in the ledger.
+Conversions imported from a network report (see reports.py) keep the
+commission the network reported; only their cashback share is recomputed.
+"""
+import hashlib
+import math
+import threading
+import time
+from bisect import bisect_right
+from decimal import Decimal
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from .conversion import shop_id_of
+from .models import CommissionRule, RollupCheckpoint, Transaction
+
+CENT = Decimal('0.01')
+RECOMPUTE_BATCH_SIZE = 2000
+
+
+class Rates(NamedTuple):
+    commission_rate: Decimal
+    cashback_rate: Decimal
+    rule_id: int = None
+
+    def commission(self, price):
+        return (Decimal(price) * self.commission_rate).quantize(CENT)
+
+    def cashback(self, commission):
+        return (Decimal(commission) * self.cashback_rate).quantize(CENT)
+
+
+def default_rates():
+    return Rates(
+        Decimal(str(getattr(settings, 'COMMISSION_DEFAULT_RATE', '0.10'))),
+        Decimal(str(getattr(settings, 'CASHBACK_DEFAULT_RATE', '0.05'))),
+    )
+
+
+def _timestamp(when):
+    return (when or timezone.now()).timestamp()
+
+
+def _compile_periods(rules):
+    """Return (boundaries, winners): from boundaries[i] on, winners[i] applies (None: no rule)."""
+    spans = [
+        (
+            rule.starts_at.timestamp() if rule.starts_at else -math.inf,
+            rule.ends_at.timestamp() if rule.ends_at else math.inf,
+            rule,
+        )
+        for rule in rules
+    ]
+    boundaries, winners = [], []
+    for point in sorted({point for start, end, _ in spans for point in (start, end)}):
+        active = [(rule.priority, start, rule.pk, rule) for start, end, rule in spans if start <= point < end]
+        winner = max(active, key=lambda candidate: candidate[:3])[3] if active else None
+        rates = Rates(winner.commission_rate, winner.cashback_rate, winner.pk) if winner else None
+        if not winners or winners[-1] != rates:
+            boundaries.append(point)
+            winners.append(rates)
+    return boundaries, winners
+
+
+class RuleIndex:
+    def __init__(self, rules, default=None):
+        self.default = default or default_rates()
+        by_scope = {}
+        for rule in rules:
+            by_scope.setdefault((rule.shop_id, rule.category), []).append(rule)
+        self._periods = {scope: _compile_periods(scope_rules) for scope, scope_rules in by_scope.items()}
+
+    def _lookup(self, scope, timestamp):
+        periods = self._periods.get(scope)
+        if periods is None:
+            return None
+        boundaries, winners = periods
+        i = bisect_right(boundaries, timestamp) - 1
+        return winners[i] if i >= 0 else None
+
+    def rates(self, shop_id='', category='', when=None):
+        """Rates for a sale in `shop_id`/`category` at `when` (default: now)."""
+        return self._rates(shop_id or '', category or '', _timestamp(when))
+
+    def _rates(self, shop_id, category, timestamp):
+        # Most specific first; with a blank shop or category some of these coincide
+        for scope in ((shop_id, category), (shop_id, ''), ('', category), ('', '')):
+            rates = self._lookup(scope, timestamp)
+            if rates is not None:
+                return rates
+        return self.default
+
+
+class _RuleCache:
+    """The compiled rules of this process, rebuilt when the rule set's version changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+    def get(self):
+        interval = getattr(settings, 'COMMISSION_RULES_CHECK_SECONDS', 5)
+        now = time.monotonic()
+        with self._lock:
+            if self._index is not None and now - self._checked_at < interval:
+                return self._index
+        version = rules_version()
+        with self._lock:
+            if self._index is None or version != self._version:
+                self._index = RuleIndex(CommissionRule.objects.filter(is_active=True).order_by('pk'))
+                self._version = version
+            self._checked_at = now
+            return self._index
+
+
+rule_cache = _RuleCache()
+
+
+def rules_version():
+    """The rule set's version: it changes when a rule is added, deleted or saved."""
+    return CommissionRule.objects.aggregate(count=Count('id'), latest=Max('updated_at'))
+
+
+def rules_fingerprint(version=None):
+    """`version` (default: the current one) as a number a checkpoint position can hold."""
+    version = version or rules_version()
+    latest = version['latest'].isoformat() if version['latest'] else ''
+    return int(hashlib.sha1(f"{version['count']}:{latest}".encode()).hexdigest()[:15], 16)
+
+
+def get_rules():
+    """The current RuleIndex."""
+    return rule_cache.get()
+
+
+def rates_for(shop_id='', category='', when=None):
+    return get_rules().rates(shop_id, category, when)
+
+
+def evaluate_many(rows):
+    """
+    Price many sales at once. `rows` is an iterable of (product_price,
+    shop_id, category, when) tuples; returns a list of (commission,
+    cashback) pairs in the same order.
+    """
+    index = get_rules()
+    results = []
+    for price, shop_id, category, when in rows:
+        rates = index._rates(shop_id or '', category or '', _timestamp(when))
+        commission = rates.commission(price)
+        results.append((commission, rates.cashback(commission)))
+    return results
+
+
+def rules_checkpoint(run):
+    """Name of the checkpoint holding the fingerprint of the rules recompute run `run` prices with."""
+    return f'recompute:{run}:rules'
+
+
+def recompute_ranges(run='commissions', parts=1):
+    """
+    Return the ID ranges of recompute run `run` as (checkpoint name, first
+    id, last id) tuples. A new run splits the pending transactions into
+    `parts` ranges and records a checkpoint for each; an existing run keeps
+    the ranges it started with, so that it resumes where it stopped, unless
+    the rules have changed since it started: then it starts over.
+    """
+    prefix = f'recompute:{run}:'
+    fingerprint = rules_fingerprint()
+    with transaction.atomic():
+        rules, _ = RollupCheckpoint.objects.select_for_update().get_or_create(
+            name=rules_checkpoint(run), defaults={'position': fingerprint},
+        )
+        if rules.position != fingerprint:
+            RollupCheckpoint.objects.filter(name__startswith=prefix).exclude(pk=rules.pk).delete()
+            rules.position = fingerprint
+            rules.save(update_fields=['position', 'updated_at'])
+        checkpoints = list(RollupCheckpoint.objects.filter(name__startswith=prefix).exclude(pk=rules.pk).order_by('pk'))
+    if not checkpoints:
+        bounds = Transaction.objects.filter(status='pending').aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            return []
+        width = math.ceil((bounds['last'] - bounds['first'] + 1) / parts)
+        checkpoints = RollupCheckpoint.objects.bulk_create([
+            RollupCheckpoint(name=f'{prefix}{start}-{min(start + width - 1, bounds["last"])}', position=start - 1)
+            for start in range(bounds['first'], bounds['last'] + 1, width)
+        ])
+    ranges = []
+    for checkpoint in checkpoints:
+        first, last = checkpoint.name[len(prefix):].split('-')
+        ranges.append((checkpoint.name, int(first), int(last)))
+    return ranges
+
+
+def recompute_range(name, last, batch_size=RECOMPUTE_BATCH_SIZE):
+    """
+    Re-price the pending transactions up to id `last` that come after the
+    position of checkpoint `name`. Returns (examined, updated).
+    Imported conversions only get their cashback recomputed.
+    """
+    examined = updated = 0
+    while True:
+        with transaction.atomic():
+            checkpoint = RollupCheckpoint.objects.select_for_update().get(name=name)
+            if checkpoint.position >= last:
+                return examined, updated
+            rows = list(
+                Transaction.objects.filter(pk__gt=checkpoint.position, pk__lte=last, status='pending')
+                .select_for_update(of=('self',))
+                .order_by('pk')
+                .values_list('pk', 'product_price', 'shop_id', 'category', 'created_at',
+                             'affiliate_link__original_link', 'external_id', 'estimated_commission',
+                             'cashback_amount')[:batch_size]
+            )
+            index = get_rules()
+            changed = []
+            for pk, price, shop_id, category, created_at, url, external_id, commission, cashback in rows:
+                # Rows submitted before shop IDs were recorded get theirs from the link
+                new_shop_id = shop_id or shop_id_of(url or '')
+                rates = index.rates(new_shop_id, category, created_at)
+                # An imported conversion's commission is what the network reported, not an estimate
+                new_commission = commission if external_id else rates.commission(price)
+                new_cashback = rates.cashback(new_commission)
+                if (shop_id, commission, cashback) != (new_shop_id, new_commission, new_cashback):
+                    changed.append(Transaction(
+                        pk=pk, shop_id=new_shop_id, estimated_commission=new_commission, cashback_amount=new_cashback,
+                    ))
+            Transaction.objects.bulk_update(changed, ['shop_id', 'estimated_commission', 'cashback_amount'],
+                                            batch_size=500)
+            checkpoint.position = rows[-1][0] if len(rows) == batch_size else last
+            checkpoint.save(update_fields=['position', 'updated_at'])
+        examined += len(rows)
+        updated += len(changed)
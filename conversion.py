@@ -0,0 +1,295 @@
+"""
+Link conversion: validating pasted Shopee URLs and creating affiliate links.
+
+Links are created with a single bulk_create and no follow-up write. The
+tracking URL depends only on the link's short code, which is drawn before
+the insert (see shortcodes.py), so it is not stored; views fill
+`converted_link` from `AffiliateLink.get_absolute_url()` when they render
+a link (see `with_tracking_urls`). A stored `converted_link` marks a link
+from before short codes, whose ID-based URL is still served. Converting one link or a few
+hundred costs the same handful of queries; the backend only splits the
+INSERT when it exceeds its parameter limit (about 140 rows on SQLite).
+
+Each link also stores `canonical_key`, a hash of the product URL with
+tracking parameters and host variants normalized away. A unique
+(user, canonical_key) constraint means pasting the same product again
+returns the existing link instead of creating another one. Links saved one
+at a time (admin, shell) get their key in `AffiliateLink.save()`.
+`merge_duplicate_links` backfills the key on older rows and merges the
+duplicates they turn up, leaving a LinkAlias behind for each merged ID.
+
+bulk_create() needs a backend that returns primary keys from a bulk
+insert (SQLite 3.35+, PostgreSQL, MariaDB 10.5+).
+"""
+import hashlib
+import re
+from collections import Counter, defaultdict
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction as db_transaction
+from django.db.models import F
+
+from .analytics import merge_link_rollups
+from .models import AffiliateLink, ClickEvent, ClickRollup, LinkAlias, Transaction
+from .redirect_cache import redirect_cache, short_code_cache
+from .shortcodes import MAX_ATTEMPTS, generate_code
+from .stats import apply_user_stats
+
+SHOPEE_DOMAINS = ('shopee.ph', 'shopee.com.ph')
+MAX_BATCH_LINKS = 500
+
+# Query parameters that only identify the referrer or campaign, never the product
+TRACKING_PARAMS = {
+    'affiliate', 'subid', 'sp_atk', 'xptdk', 'smtt', 'mmp_pid', 'uls_trackid',
+    'gclid', 'fbclid', 'is_retargeting', 'deep_and_deferred', 'pid', 'c',
+}
+TRACKING_PREFIXES = ('utm_', 'af_')
+
+# /product/<shop_id>/<item_id> and /<product-name>-i.<shop_id>.<item_id>
+_PRODUCT_PATH = re.compile(r'^/product/(\d+)/(\d+)')
+_SLUG_PATH = re.compile(r'-i\.(\d+)\.(\d+)$')
+
+_url_field = forms.URLField(max_length=200, assume_scheme='https')
+
+
+def is_shopee_link(url):
+    host = (urlsplit(url).hostname or '').lower()
+    return any(host == domain or host.endswith('.' + domain) for domain in SHOPEE_DOMAINS)
+
+
+def canonicalize_link(url):
+    """
+    Reduce a Shopee URL to a canonical form that is the same for every way of
+    linking to one product: `shopee.ph/product/<shop_id>/<item_id>` when the
+    IDs can be read from the path, otherwise the normalized host and path
+    with tracking parameters dropped and the rest sorted.
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if any(host == domain or host.endswith('.' + domain) for domain in SHOPEE_DOMAINS):
+        host = 'shopee.ph'
+    path = unquote(parts.path).rstrip('/')
+
+    match = _PRODUCT_PATH.match(path) or _SLUG_PATH.search(path)
+    if match:
+        return f'shopee.ph/product/{match[1]}/{match[2]}'
+
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in TRACKING_PARAMS and not name.lower().startswith(TRACKING_PREFIXES)
+    )
+    return f'{host}{path or "/"}' + (f'?{urlencode(query)}' if query else '')
+
+
+def shop_id_of(url):
+    """The Shopee shop ID in a product URL, or '' if it has none."""
+    path = unquote(urlsplit(url.strip()).path).rstrip('/')
+    match = _PRODUCT_PATH.match(path) or _SLUG_PATH.search(path)
+    return match[1] if match else ''
+
+
+def canonical_key(url):
+    return hashlib.sha256(canonicalize_link(url).encode()).hexdigest()
+
+
+def normalize_links(values, limit=MAX_BATCH_LINKS):
+    """
+    Clean a list of pasted URLs.
+
+    Returns (urls, errors): the valid Shopee URLs with surrounding whitespace
+    and duplicates removed, in their original order, and one message per
+    rejected value.
+    """
+    urls, errors, seen = [], [], set()
+    for value in values:
+        value = str(value).strip()
+        if not value:
+            continue
+        try:
+            url = _url_field.clean(value)
+        except ValidationError:
+            errors.append(f"{value}: not a valid URL.")
+            continue
+        if not is_shopee_link(url):
+            errors.append(f"{value}: not a Shopee link.")
+            continue
+        if url not in seen:
+            seen.add(url)
+            urls.append(url)
+    if len(urls) > limit:
+        errors.append(f"At most {limit} links can be converted at once; got {len(urls)}.")
+    return urls, errors
+
+
+def convert_links(user, urls, batch_size=500):
+    """
+    Return the user's AffiliateLink for each distinct product in `urls`, in
+    order, creating only the ones that do not exist yet.
+    """
+    by_key = {}
+    for url in urls:
+        by_key.setdefault(canonical_key(url), url)
+    if not by_key:
+        return []
+
+    for attempt in range(2):
+        try:
+            with db_transaction.atomic():
+                links = {
+                    link.canonical_key: link
+                    for link in AffiliateLink.objects.filter(user=user, canonical_key__in=list(by_key))
+                }
+                new_links = [
+                    AffiliateLink(user=user, original_link=url, canonical_key=key, short_code=generate_code())
+                    for key, url in by_key.items() if key not in links
+                ]
+                if new_links:
+                    new_links = AffiliateLink.objects.bulk_create(new_links, batch_size=batch_size)
+                    # bulk_create skips post_save, so do what the signal handlers would
+                    apply_user_stats(user.id, link_count=len(new_links))
+            break
+        except IntegrityError:
+            # A concurrent request created one of these links first (the retry finds it),
+            # or, very rarely, a short code collided (the retry draws new ones)
+            if attempt:
+                raise
+
+    redirect_cache.invalidate_many(link.pk for link in new_links)
+    short_code_cache.invalidate_many(link.short_code for link in new_links)
+    links.update((link.canonical_key, link) for link in new_links)
+    return [links[key] for key in by_key]
+
+
+def with_tracking_urls(request, links):
+    """Set `converted_link` to the absolute tracking URL on links stored without one."""
+    for link in links:
+        if not link.converted_link:
+            link.converted_link = request.build_absolute_uri(link.get_absolute_url())
+    return links
+
+
+def _merge_rollups(survivor, duplicate_ids):
+    moved = Counter()
+    rollups = ClickRollup.objects.filter(link_id__in=duplicate_ids)
+    for period, bucket_start, clicks in rollups.values_list('period', 'bucket_start', 'clicks'):
+        moved[(period, bucket_start)] += clicks
+    if not moved:
+        return
+    rollups.delete()
+
+    to_update = []
+    for rollup in ClickRollup.objects.filter(link=survivor):
+        key = (rollup.period, rollup.bucket_start)
+        if key in moved:
+            rollup.clicks += moved.pop(key)
+            to_update.append(rollup)
+    ClickRollup.objects.bulk_update(to_update, ['clicks'], batch_size=500)
+    ClickRollup.objects.bulk_create([
+        ClickRollup(user_id=survivor.user_id, link=survivor, period=period, bucket_start=bucket_start, clicks=clicks)
+        for (period, bucket_start), clicks in moved.items()
+    ], batch_size=500)
+
+
+def merge_links(survivor, duplicates):
+    """Fold `duplicates` into `survivor`: clicks, transactions and rollups move over, then the duplicates go."""
+    duplicate_ids = [link.pk for link in duplicates]
+    with db_transaction.atomic():
+        AffiliateLink.objects.filter(pk=survivor.pk).update(
+            click_count=F('click_count') + sum(link.click_count for link in duplicates)
+        )
+        Transaction.objects.filter(affiliate_link_id__in=duplicate_ids).update(affiliate_link=survivor)
+        ClickEvent.objects.filter(link_id__in=duplicate_ids).update(link=survivor)
+        _merge_rollups(survivor, duplicate_ids)
+        merge_link_rollups(survivor, duplicate_ids)
+        LinkAlias.objects.filter(link_id__in=duplicate_ids).update(link=survivor)
+        LinkAlias.objects.bulk_create([
+            LinkAlias(alias_id=link.pk, short_code=link.short_code, link=survivor) for link in duplicates
+        ])
+        # Per-object delete so the signal handlers fix link_count and the redirect cache
+        AffiliateLink.objects.filter(pk__in=duplicate_ids).delete()
+
+
+def merge_duplicate_links(batch_size=2000, dry_run=False):
+    """
+    Backfill `canonical_key` on links that lack it and merge each user's
+    duplicates into their oldest link (or the one that already has the key).
+
+    Works through the table in primary-key order, `batch_size` links per
+    transaction. Returns (backfilled, merged): the number of links that got
+    a key and the number folded into another link.
+    """
+    backfilled = merged = 0
+    last_pk = 0
+    # In a dry run the chunk's survivors are not written, so later chunks would not find them
+    planned = set()
+    while True:
+        chunk = list(
+            AffiliateLink.objects.filter(pk__gt=last_pk, canonical_key__isnull=True)
+            .order_by('pk')
+            .only('id', 'user_id', 'original_link', 'short_code', 'click_count')[:batch_size]
+        )
+        if not chunk:
+            return backfilled, merged
+        last_pk = chunk[-1].pk
+
+        groups = defaultdict(list)
+        for link in chunk:
+            link.canonical_key = canonical_key(link.original_link)
+            groups[(link.user_id, link.canonical_key)].append(link)
+        keyed = {
+            (link.user_id, link.canonical_key): link
+            for link in AffiliateLink.objects.filter(
+                user_id__in={user_id for user_id, _ in groups},
+                canonical_key__in={key for _, key in groups},
+            )
+        }
+
+        with db_transaction.atomic():
+            to_backfill = []
+            for key, links in groups.items():
+                survivor = keyed.get(key)
+                if survivor is None and key not in planned:
+                    survivor = links.pop(0)
+                    to_backfill.append(survivor)
+                    if dry_run:
+                        planned.add(key)
+                if links:
+                    merged += len(links)
+                    if not dry_run:
+                        merge_links(survivor, links)
+            backfilled += len(to_backfill)
+            if not dry_run:
+                AffiliateLink.objects.bulk_update(to_backfill, ['canonical_key'], batch_size=500)
+
+
+def backfill_short_codes(batch_size=2000):
+    """
+    Give links created before short codes existed a code. Their stored
+    `converted_link` is kept, so their old ID-based tracking URLs keep
+    working. Returns the number of links updated.
+    """
+    updated = collisions = 0
+    last_pk = 0
+    while True:
+        chunk = list(
+            AffiliateLink.objects.filter(pk__gt=last_pk, short_code__isnull=True).order_by('pk').only('id')[:batch_size]
+        )
+        if not chunk:
+            return updated
+        for link in chunk:
+            link.short_code = generate_code()
+        try:
+            with db_transaction.atomic():
+                AffiliateLink.objects.bulk_update(chunk, ['short_code'], batch_size=500)
+        except IntegrityError:
+            # A code collided; go round again with fresh codes for the same rows,
+            # unless it keeps failing, which no run of bad luck explains
+            collisions += 1
+            if collisions >= MAX_ATTEMPTS:
+                raise
+            continue
+        collisions = 0
+        last_pk = chunk[-1].pk
+        updated += len(chunk)
@@ -0,0 +1,191 @@
+"""
+Streaming exports of transactions and withdrawals.
+
+Rows are read with values_list() in primary key order through
+.iterator(chunk_size=...), so neither model instances nor the whole result
+set are held in memory, and are formatted as CSV or NDJSON a line at a
+time. The admin actions hand the generator to a StreamingHttpResponse and
+the `export_records` command writes it to a file, so memory stays flat
+however many rows there are, and a download starts sending at once instead
+of waiting for the whole file.
+
+Every row carries its id and rows come out in id order, so an interrupted
+export can be resumed with `after=<last id written>`; `last_exported_id`
+finds it in a partly written file, whose CSV rows may span several lines.
+"""
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Transaction, Withdrawal
+
+CHUNK_SIZE = 2000
+# Lines are joined into blocks of about this many characters before being sent
+BUFFER_SIZE = 64 * 1024
+
+# name: (model, date field for range filters, exported columns)
+EXPORTS = {
+    'transactions': (Transaction, 'created_at', (
+        'id', 'user_id', 'user__username', 'affiliate_link_id', 'product_name', 'shop_id', 'category', 'product_price',
+        'estimated_commission', 'cashback_amount', 'status', 'external_id', 'created_at', 'updated_at',
+    )),
+    'withdrawals': (Withdrawal, 'requested_at', (
+        'id', 'user_id', 'user__username', 'amount', 'payment_method', 'payment_details', 'status',
+        'requested_at', 'processed_at',
+    )),
+}
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def filtered_queryset(name, since=None, before=None, status=None):
+    """The rows of export `name` with `since` <= date < `before` and the given status."""
+    model, date_field, _ = EXPORTS[name]
+    queryset = model.objects.all()
+    if since is not None:
+        queryset = queryset.filter(**{f'{date_field}__gte': since})
+    if before is not None:
+        queryset = queryset.filter(**{f'{date_field}__lt': before})
+    if status:
+        queryset = queryset.filter(status=status)
+    return queryset
+
+
+def export_rows(queryset, fields, after=None, chunk_size=CHUNK_SIZE):
+    """Yield value tuples for `fields` in id order, starting after id `after`."""
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    return queryset.order_by('pk').values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class _Echo:
+    """File-like object whose write() returns the line, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(fields, rows, header=True):
+    writer = csv.writer(_Echo())
+    if header:
+        yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_plain(value) for value in row])
+
+
+def ndjson_lines(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, map(_plain, row)))) + '\n'
+
+
+def _buffered(lines, size=BUFFER_SIZE):
+    buffer = []
+    buffered = 0
+    for line in lines:
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_export(name, queryset, fmt='csv', after=None, header=True, chunk_size=CHUNK_SIZE):
+    """Yield export `name` of `queryset` as blocks of CSV or NDJSON text."""
+    fields = EXPORTS[name][2]
+    rows = export_rows(queryset, fields, after=after, chunk_size=chunk_size)
+    if fmt == 'csv':
+        lines = csv_lines(fields, rows, header=header)
+    elif fmt == 'ndjson':
+        lines = ndjson_lines(fields, rows)
+    else:
+        raise ValueError(f"Unknown export format {fmt!r}.")
+    return _buffered(lines)
+
+
+def streaming_response(name, queryset, fmt='csv'):
+    """A StreamingHttpResponse downloading export `name` of `queryset`."""
+    response = StreamingHttpResponse(stream_export(name, queryset, fmt), content_type=CONTENT_TYPES[fmt])
+    filename = f'{name}-{timezone.now():%Y%m%d-%H%M%S}.{fmt}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _last_line(f):
+    """Return (start, end) offsets of the last complete line of `f`, reading backwards from its end."""
+    end = f.seek(0, os.SEEK_END)
+    position = end
+    tail = b''
+    # Read backwards until the tail holds a complete line (or the whole file)
+    while position > 0 and tail.count(b'\n') < 2:
+        step = min(4096, position)
+        position -= step
+        f.seek(position)
+        tail = f.read(step) + tail
+    last_break = tail.rfind(b'\n')
+    if last_break < 0:
+        return 0, 0
+    return position + tail.rfind(b'\n', 0, last_break) + 1, position + last_break + 1
+
+
+def _last_csv_record(f):
+    """
+    Return (start, end) offsets of the last complete CSV record of `f`.
+
+    A quoted field may contain line breaks, so a record can span several
+    lines and no line can be told apart as a record boundary from the end
+    of the file. The file is scanned forwards instead: csv.writer only
+    quotes whole fields and doubles the quotes inside them, so a line ends
+    a record exactly when the quotes up to its end are balanced.
+    """
+    f.seek(0)
+    start = end = position = 0
+    in_quotes = False
+    for line in f:
+        position += len(line)
+        if line.count(b'"') % 2:
+            in_quotes = not in_quotes
+        if not in_quotes and line.endswith(b'\n'):
+            start, end = end, position
+    return start, end
+
+
+def last_exported_id(path, fmt='csv'):
+    """
+    Return the id of the last complete row in an export file, or None if
+    it has none. A trailing partial row, left by an interrupted run, is
+    truncated so that the resumed export can be appended after it.
+    """
+    with open(path, 'rb+') as f:
+        # NDJSON escapes line breaks inside values, so each line is one row
+        start, end = _last_csv_record(f) if fmt == 'csv' else _last_line(f)
+        if f.seek(0, os.SEEK_END) > end:
+            f.truncate(end)
+        f.seek(start)
+        last_row = f.read(end - start).decode()
+
+    if not last_row.strip():
+        return None
+    if fmt == 'ndjson':
+        return json.loads(last_row)['id']
+    first_column = next(csv.reader(io.StringIO(last_row, newline='')))[0]
+    # Only the header has been written
+    return int(first_column) if first_column.isdigit() else None
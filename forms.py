@@ -3,6 +3,7 @@ from django.core.validators import MinValueValidator
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
 from .models import UserProfile, AffiliateLink, Transaction, Withdrawal
+from .conversion import MAX_BATCH_LINKS, normalize_links
 
 class CustomUserCreationForm(UserCreationForm):
     email = forms.EmailField(
@@ -57,6 +58,25 @@ class AffiliateLinkForm(forms.ModelForm):
             'original_link': 'Shopee Product Link'
         }
 
+class BulkLinkConverterForm(forms.Form):
+    links = forms.CharField(
+        label='Shopee Product Links',
+        help_text=f'One link per line, up to {MAX_BATCH_LINKS} at a time.',
+        widget=forms.Textarea(attrs={
+            'class': 'form-control',
+            'rows': 12,
+            'placeholder': 'Paste your Shopee product links here, one per line'
+        })
+    )
+    
+    def clean_links(self):
+        urls, errors = normalize_links(self.cleaned_data['links'].splitlines())
+        if errors:
+            raise forms.ValidationError(errors)
+        if not urls:
+            raise forms.ValidationError('Enter at least one Shopee link.')
+        return urls
+
 class ProductInfoForm(forms.Form):
     product_name = forms.CharField(
         max_length=255,
@@ -95,6 +115,9 @@ class TransactionForm(forms.ModelForm):
         }
 
 class WithdrawalForm(forms.ModelForm):
+    # Generated when the form is shown, so that submitting it twice makes one withdrawal
+    idempotency_key = forms.CharField(max_length=64, required=False, widget=forms.HiddenInput)
+    
     class Meta:
         model = Withdrawal
         fields = ['amount', 'payment_method', 'payment_details']
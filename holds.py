@@ -0,0 +1,99 @@
+"""
+Withdrawal requests and the holds that reserve their amounts.
+
+UserProfile.held is the total of the user's pending withdrawals: creating
+a pending withdrawal adds its amount (see signals.py), and approving,
+rejecting or deleting it releases the amount again, in the same database
+transaction as the status change (see settlement.py). What a user can
+still withdraw is `balance - held`, so pending requests can never add up
+to more than the balance.
+
+`request_withdrawal` locks the user's profile row before checking what is
+available, so concurrent requests of one user (double submits, several
+tabs) are checked one after the other and each sees the holds of the
+others. A request may carry an idempotency key, unique per user: sending
+the same key again returns the withdrawal it created the first time
+instead of a second one.
+
+`reconcile_holds` recomputes the holds from the pending withdrawals.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Sum
+
+from .models import UserProfile, Withdrawal
+from .stats import bulk_increment
+
+MINIMUM_WITHDRAWAL = Decimal('100.00')
+BATCH_SIZE = 500
+
+
+class InsufficientBalance(ValueError):
+    pass
+
+
+def available_balance(profile):
+    return profile.balance - profile.held
+
+
+def hold(user_id, amount):
+    UserProfile.objects.filter(user_id=user_id).update(held=F('held') + amount)
+
+
+def release_many(rows):
+    """Release the holds of withdrawals given as (id, user_id, amount) tuples."""
+    released = defaultdict(Decimal)
+    for _, user_id, amount in rows:
+        released[user_id] -= amount
+    bulk_increment(UserProfile, {user_id: {'held': amount} for user_id, amount in released.items()}, BATCH_SIZE)
+
+
+def request_withdrawal(user, amount, payment_method, payment_details, idempotency_key=None):
+    """
+    Create a pending withdrawal of `amount` and hold it. Returns (withdrawal,
+    created); `created` is False when `idempotency_key` was already used.
+    Raises ValueError below the minimum and InsufficientBalance when less
+    than `amount` is available.
+    """
+    with transaction.atomic():
+        profile = UserProfile.objects.select_for_update().get(user=user)
+        if idempotency_key:
+            existing = Withdrawal.objects.filter(user=user, idempotency_key=idempotency_key).first()
+            if existing is not None:
+                return existing, False
+        if amount < MINIMUM_WITHDRAWAL:
+            raise ValueError(f"Minimum withdrawal amount is ₱{MINIMUM_WITHDRAWAL:.0f}.")
+        if amount > available_balance(profile):
+            raise InsufficientBalance("You cannot withdraw more than your available balance.")
+        withdrawal = Withdrawal.objects.create(
+            user=user,
+            amount=amount,
+            payment_method=payment_method,
+            payment_details=payment_details,
+            status='pending',
+            idempotency_key=idempotency_key or None,
+        )
+    return withdrawal, True
+
+
+def reconcile_holds(user_ids=None):
+    """Set every held amount to the total of the user's pending withdrawals. Returns the number fixed."""
+    profiles = UserProfile.objects.all()
+    if user_ids is not None:
+        profiles = profiles.filter(user_id__in=user_ids)
+    with transaction.atomic():
+        # Lock first, so that no request adds a hold between the sum and the write
+        held = dict(profiles.select_for_update().order_by('pk').values_list('user_id', 'held'))
+        pending = dict(
+            Withdrawal.objects.filter(status='pending', user_id__in=profiles.values('user_id'))
+            .order_by().values('user_id').annotate(total=Sum('amount')).values_list('user_id', 'total')
+        )
+        stale = {
+            user_id: pending.get(user_id, Decimal('0.00'))
+            for user_id, amount in held.items() if amount != pending.get(user_id, Decimal('0.00'))
+        }
+        for user_id, amount in stale.items():
+            UserProfile.objects.filter(user_id=user_id).update(held=amount)
+    return len(stale)
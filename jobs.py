@@ -0,0 +1,240 @@
+"""
+Database-backed background jobs.
+
+Work that is too slow for a request (bulk settlement, stats rebuilds,
+rollups) is stored as a Job row by `enqueue` and run by the `run_workers`
+management command, so no broker is needed beyond the database itself.
+
+Claiming: on backends that support it, a worker locks the next due job
+with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers never wait
+on each other. Elsewhere (SQLite) it picks a candidate and claims it with
+a conditional UPDATE ... WHERE status = 'queued'; only one worker's update
+can match, and the others move on to the next candidate. SQLite still
+allows only one writer at a time: with IMMEDIATE transactions and
+busy_timeout (see settings and routers.py) extra workers queue on the
+write lock rather than fail, but they add no throughput, so one worker
+is the sensible setting there.
+
+Failures: a job that raises is re-queued with exponential backoff
+(JOB_RETRY_BACKOFF seconds, doubled per attempt) until it has been tried
+max_attempts times, then marked failed. Jobs left 'running' by a worker
+that died are re-queued after JOB_LOCK_TIMEOUT seconds, so handlers must
+be safe to run twice. The built-in ones are: settlement only touches rows
+that are still pending, the rebuilds recompute from source tables, and
+the recompute continues from its checkpoint. A slow job re-queued while
+it still ran keeps its outcome as long as no other worker has claimed it
+yet.
+"""
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction as db_transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import analytics, clicks, commissions, ledger, reports, settlement, stats
+from .models import Job, Transaction, Withdrawal
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(name):
+    """Register a function as the handler for jobs called `name`."""
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, payload=None, idempotency_key=None, run_at=None, max_attempts=3):
+    """
+    Queue a job and return it. With an idempotency key, a job already
+    enqueued under that key is returned instead, whatever its status.
+    """
+    if name not in TASKS:
+        raise ValueError(f"Unknown job {name!r}.")
+    fields = {
+        'name': name,
+        'payload': payload or {},
+        'run_at': run_at or timezone.now(),
+        'max_attempts': max_attempts,
+    }
+    if idempotency_key is None:
+        return Job.objects.create(**fields)
+    try:
+        with db_transaction.atomic():
+            return Job.objects.get_or_create(idempotency_key=idempotency_key, defaults=fields)[0]
+    except IntegrityError:
+        # Lost a race with another enqueue of the same key
+        return Job.objects.get(idempotency_key=idempotency_key)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_job(worker):
+    """Mark the next due job as running by `worker` and return it, or None if none is due."""
+    now = timezone.now()
+    due = Job.objects.filter(status='queued', run_at__lte=now).order_by('run_at', 'id')
+    claim = {'status': 'running', 'locked_by': worker, 'locked_at': now, 'attempts': F('attempts') + 1}
+
+    if connection.features.has_select_for_update_skip_locked:
+        with db_transaction.atomic():
+            job = due.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            Job.objects.filter(pk=job.pk).update(**claim)
+    else:
+        for job_id in due.values_list('id', flat=True)[:10]:
+            if Job.objects.filter(pk=job_id, status='queued').update(**claim):
+                break
+        else:
+            return None
+        job = Job(pk=job_id)
+    job.refresh_from_db()
+    return job
+
+
+def record_outcome(job, **fields):
+    """
+    Store the outcome of a run of `job`. A job re-queued as stale while it ran
+    (see requeue_stale_jobs) but not claimed again yet still gets it, so a job
+    that finished is not run again. Once another worker has claimed the job,
+    that worker's run decides the outcome. Returns True if it was stored.
+    """
+    mine = Q(locked_by=job.locked_by) | Q(status='queued', locked_by='')
+    if Job.objects.filter(mine, pk=job.pk).update(**fields):
+        return True
+    logger.warning("Job #%s %s was claimed by another worker; dropping this run's outcome", job.pk, job.name)
+    return False
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome. Returns True if it succeeded."""
+    try:
+        handler = TASKS[job.name]
+        result = handler(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception("Job #%s %s failed (attempt %s of %s)", job.pk, job.name, job.attempts, job.max_attempts)
+        update = {'last_error': error, 'locked_by': '', 'locked_at': None}
+        if job.attempts < job.max_attempts:
+            backoff = getattr(settings, 'JOB_RETRY_BACKOFF', 30) * 2 ** (job.attempts - 1)
+            update.update(status='queued', run_at=timezone.now() + timedelta(seconds=backoff))
+        else:
+            update.update(status='failed', finished_at=timezone.now())
+        record_outcome(job, **update)
+        return False
+
+    record_outcome(
+        job, status='succeeded', result=result, last_error='', finished_at=timezone.now(),
+        locked_by=job.locked_by, locked_at=None,
+    )
+    return True
+
+
+def requeue_stale_jobs(timeout=None):
+    """Put jobs whose worker stopped reporting back on the queue. Returns how many."""
+    if timeout is None:
+        timeout = getattr(settings, 'JOB_LOCK_TIMEOUT', 600)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    return Job.objects.filter(status='running', locked_at__lt=cutoff).update(
+        status='queued', locked_by='', locked_at=None, run_at=timezone.now(),
+    )
+
+
+def work(worker=None, poll_interval=1.0, burst=False, max_jobs=None, should_stop=lambda: False):
+    """
+    Claim and run jobs until `should_stop()` is true, `max_jobs` have run,
+    or, with `burst`, the queue has nothing due. Returns the number of jobs run.
+    """
+    worker = worker or worker_name()
+    processed = 0
+    while not should_stop() and (max_jobs is None or processed < max_jobs):
+        job = claim_job(worker)
+        if job is None:
+            if burst:
+                break
+            requeue_stale_jobs()
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        processed += 1
+    return processed
+
+
+def settle_in_batches(settle, model, ids, batch_size=settlement.BATCH_SIZE):
+    """
+    Run `settle` on the rows of `model` with the given ids, batch_size ids at
+    a time. Each batch is settled in its own transaction, so a selection of
+    any size never puts more ids than that into one query. Returns the total.
+    """
+    return sum(
+        settle(model.objects.filter(pk__in=ids[start:start + batch_size]))
+        for start in range(0, len(ids), batch_size)
+    )
+
+
+@task('approve_transactions')
+def approve_transactions(ids):
+    return {'approved': settle_in_batches(settlement.approve_transactions, Transaction, ids)}
+
+
+@task('reject_transactions')
+def reject_transactions(ids):
+    return {'rejected': settle_in_batches(settlement.reject_transactions, Transaction, ids)}
+
+
+@task('approve_withdrawals')
+def approve_withdrawals(ids):
+    return {'approved': settle_in_batches(settlement.approve_withdrawals, Withdrawal, ids)}
+
+
+@task('reject_withdrawals')
+def reject_withdrawals(ids):
+    return {'rejected': settle_in_batches(settlement.reject_withdrawals, Withdrawal, ids)}
+
+
+@task('import_conversion_report')
+def import_conversion_report(path, dry_run=False):
+    outcomes, mismatch_path = reports.import_report_file(path, dry_run=dry_run)
+    return {'outcomes': dict(outcomes), 'mismatches': mismatch_path}
+
+
+@task('recompute_commissions')
+def recompute_commissions(name, last):
+    examined, updated = commissions.recompute_range(name, last)
+    return {'examined': examined, 'updated': updated}
+
+
+@task('rebuild_user_stats')
+def rebuild_user_stats(user_ids=None):
+    return {'rebuilt': stats.rebuild_user_stats(user_ids)}
+
+
+@task('reconcile_site_stats')
+def reconcile_site_stats():
+    return {'totals': {field: str(value) for field, value in stats.reconcile_site_stats().items()}}
+
+
+@task('rollup_clicks')
+def rollup_clicks():
+    return {'events': clicks.rollup_clicks()}
+
+
+@task('rollup_earnings')
+def rollup_earnings():
+    return {'rows': analytics.rollup_earnings()}
+
+
+@task('take_balance_snapshots')
+def take_balance_snapshots():
+    return {'snapshots': ledger.take_snapshots()}
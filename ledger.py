@@ -0,0 +1,135 @@
+"""
+Append-only balance ledger.
+
+Every change to a user's balance is written as a LedgerEntry, and
+UserProfile.balance is moved by the same amount with an `F()` update in the
+same database transaction, so concurrent postings cannot overwrite each
+other. UserProfile.balance is therefore a cached running total of the
+ledger.
+
+`take_snapshots` periodically records each active user's balance as a
+BalanceSnapshot, and `balance_as_of` answers historical queries from the
+latest snapshot before the requested time plus the entries posted after it.
+An entry can commit after entries with higher ids, and a snapshot covers
+every id up to its last_entry_id, so snapshots stop at
+`analytics.rollup_limit` like the rollups do.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from . import analytics
+from .models import BalanceSnapshot, LedgerEntry, RollupCheckpoint, UserProfile
+from .stats import bulk_increment
+
+BATCH_SIZE = 500
+
+
+def post(user_id, amount, entry_type, transaction=None, withdrawal=None, memo=''):
+    """Record one ledger entry and move the user's balance by `amount`."""
+    return post_many([
+        LedgerEntry(
+            user_id=user_id,
+            amount=amount,
+            entry_type=entry_type,
+            transaction=transaction,
+            withdrawal=withdrawal,
+            memo=memo,
+        )
+    ])[0]
+
+
+def post_many(entries):
+    """Record several ledger entries and apply their per-user sums to balances."""
+    deltas = defaultdict(Decimal)
+    for entry in entries:
+        deltas[entry.user_id] += Decimal(entry.amount)
+    with transaction.atomic():
+        entries = LedgerEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+        bulk_increment(
+            UserProfile, {user_id: {'balance': delta} for user_id, delta in deltas.items()}, BATCH_SIZE
+        )
+    return entries
+
+
+def ledger_balance(user_id):
+    """Sum every ledger entry of the user; should equal UserProfile.balance."""
+    return LedgerEntry.objects.filter(user_id=user_id).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+
+
+def balance_as_of(user_id, when):
+    """Return the user's balance at `when` from the nearest snapshot plus the entries after it."""
+    snapshot = (
+        BalanceSnapshot.objects.filter(user_id=user_id, taken_at__lte=when)
+        .order_by('-taken_at', '-last_entry_id')
+        .first()
+    )
+    tail = LedgerEntry.objects.filter(user_id=user_id, created_at__lte=when)
+    base = Decimal('0.00')
+    if snapshot is not None:
+        tail = tail.filter(id__gt=snapshot.last_entry_id)
+        base = snapshot.balance
+    return base + (tail.aggregate(total=Sum('amount'))['total'] or Decimal('0.00'))
+
+
+def take_snapshots():
+    """Snapshot the balance of every user with entries since the previous run. Returns the count."""
+    limit = analytics.rollup_limit('ledger_snapshots', LedgerEntry)
+    with transaction.atomic():
+        checkpoint, _ = RollupCheckpoint.objects.select_for_update().get_or_create(name='ledger_snapshots')
+        new_entries = LedgerEntry.objects.filter(id__gt=checkpoint.position, id__lte=limit)
+        upper = new_entries.aggregate(upper=Max('id'))['upper']
+        if upper is None:
+            return 0
+        deltas = dict(
+            new_entries.filter(id__lte=upper).order_by()
+            .values('user_id').annotate(delta=Sum('amount')).values_list('user_id', 'delta')
+        )
+        previous = {}
+        user_ids = list(deltas)
+        for start in range(0, len(user_ids), BATCH_SIZE):
+            latest_ids = (
+                BalanceSnapshot.objects.filter(user_id__in=user_ids[start:start + BATCH_SIZE])
+                .order_by().values('user_id').annotate(latest=Max('id')).values('latest')
+            )
+            previous.update(
+                BalanceSnapshot.objects.filter(id__in=latest_ids).values_list('user_id', 'balance')
+            )
+        now = timezone.now()
+        BalanceSnapshot.objects.bulk_create(
+            [
+                BalanceSnapshot(
+                    user_id=user_id,
+                    balance=previous.get(user_id, Decimal('0.00')) + delta,
+                    last_entry_id=upper,
+                    taken_at=now,
+                )
+                for user_id, delta in deltas.items()
+            ],
+            batch_size=BATCH_SIZE,
+        )
+        checkpoint.position = upper
+        checkpoint.save(update_fields=['position', 'updated_at'])
+    return len(deltas)
+
+
+def open_accounts():
+    """Record opening entries for balances that predate the ledger. Returns the count.
+
+    The entries describe balances that already exist, so unlike `post` they
+    do not move UserProfile.balance.
+    """
+    posted = LedgerEntry.objects.order_by().values('user_id').annotate(total=Sum('amount'))
+    totals = {row['user_id']: row['total'] for row in posted}
+    entries = []
+    for user_id, balance in UserProfile.objects.values_list('user_id', 'balance').iterator(chunk_size=BATCH_SIZE):
+        difference = balance - totals.get(user_id, Decimal('0.00'))
+        if difference:
+            entries.append(LedgerEntry(
+                user_id=user_id, amount=difference, entry_type='adjustment', memo='Opening balance',
+            ))
+    LedgerEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+    return len(entries)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.conversion import backfill_short_codes
+
+
+class Command(BaseCommand):
+    help = (
+        "Assign short codes to affiliate links created before they existed. "
+        "Their old ID-based tracking URLs keep redirecting."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help="Links updated per transaction.")
+
+    def handle(self, *args, **options):
+        count = backfill_short_codes(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Assigned short codes to {count} links."))
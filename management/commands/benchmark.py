@@ -0,0 +1,193 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from shoppelink.clicks import click_buffer
+from shoppelink.jobs import work
+from shoppelink.models import AffiliateLink, Transaction
+
+SCENARIOS = ('dashboard', 'transactions', 'track_link_click', 'link_converter', 'admin_approve')
+
+# Status each scenario answers with when it works; anything else means it measures an error page
+EXPECTED_STATUS = {
+    'dashboard': 200,
+    'transactions': 200,
+    'track_link_click': 302,
+    'link_converter': 200,
+    'admin_approve': 302,
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the main views through the Django test client and report latency, "
+        "queries per request and peak memory as JSON. Writes to the database; "
+        "run it against a seeded benchmark database, never production."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Requests per scenario.")
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                            help="Scenario to run; repeat for several (default: all).")
+        parser.add_argument('--user', help="Username to browse as (default: the most active user).")
+        parser.add_argument('--approve-batch', type=int, default=100,
+                            help="Pending transactions approved per admin action request.")
+        parser.add_argument('--label', default='', help="Free-form label stored with the results.")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.user = self.get_user(options['user'])
+        self.client = Client(SERVER_NAME='localhost')
+        self.client.force_login(self.user)
+        self.links = [
+            (link.get_absolute_url(), link.click_count)
+            for link in AffiliateLink.objects.order_by('-click_count').only('id', 'short_code', 'click_count')[:1000]
+        ]
+        if not self.links:
+            raise CommandError("No affiliate links found; run seed_data first.")
+
+        results = {}
+        for name in options['scenario'] or SCENARIOS:
+            results[name] = self.run_scenario(name, options)
+            self.stderr.write(f"{name}: p50 {results[name]['p50_ms']} ms, "
+                              f"{results[name]['queries_mean']} queries/request")
+        click_buffer.flush()
+
+        report = {
+            'label': options['label'],
+            'commit': self.git_commit(),
+            'timestamp': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'requests_per_scenario': options['requests'],
+            'scenarios': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def get_user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f"User {username!r} does not exist.")
+        user = User.objects.filter(profile__isnull=False).order_by('-stats__total_orders').first()
+        if user is None:
+            raise CommandError("No users with profiles found; run seed_data first.")
+        return user
+
+    def run_scenario(self, name, options):
+        request = getattr(self, f'request_{name}')
+        client = self.client
+        if name == 'admin_approve':
+            client = Client(SERVER_NAME='localhost')
+            client.force_login(self.get_admin())
+
+        response = request(client, options)
+        if response.status_code != EXPECTED_STATUS[name]:
+            raise CommandError(
+                f"Scenario {name} answered {response.status_code} instead of {EXPECTED_STATUS[name]}; "
+                "it would not measure what it is meant to."
+            )
+
+        latencies, query_counts, statuses = [], [], {}
+        for _ in range(options['requests']):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = request(client, options)
+                latencies.append((time.perf_counter() - started) * 1000)
+            query_counts.append(len(queries))
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        # tracemalloc slows everything down, so memory gets its own short pass
+        tracemalloc.start()
+        for _ in range(min(options['requests'], 10)):
+            request(client, options)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            'requests': len(latencies),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(statistics.fmean(latencies), 3),
+            'queries_mean': round(statistics.fmean(query_counts), 2),
+            'queries_max': max(query_counts),
+            'peak_memory_kb': round(peak / 1024, 1),
+            'status_codes': {str(code): count for code, count in statuses.items()},
+        }
+
+    def request_dashboard(self, client, options):
+        return client.get(reverse('dashboard'))
+
+    def request_transactions(self, client, options):
+        return client.get(reverse('transactions'))
+
+    def request_track_link_click(self, client, options):
+        # Pick links in proportion to their recorded clicks so hot links stay hot
+        path = self.rng.choices(
+            [path for path, _ in self.links],
+            [clicks + 1 for _, clicks in self.links],
+        )[0]
+        return client.get(path)
+
+    def request_link_converter(self, client, options):
+        item = self.rng.randrange(10 ** 9)
+        return client.post(reverse('link_converter'), {
+            'original_link': f'https://shopee.ph/product/{self.rng.randrange(10 ** 6)}/{item}',
+        })
+
+    def request_admin_approve(self, client, options):
+        ids = list(
+            Transaction.objects.filter(status='pending').values_list('id', flat=True)[:options['approve_batch']]
+        )
+        response = client.post(reverse('admin:shoppelink_transaction_changelist'), {
+            'action': 'approve_transactions',
+            '_selected_action': ids,
+        })
+        # The action only enqueues; run the job here so the scenario still measures the approval
+        work(burst=True)
+        return response
+
+    def get_admin(self):
+        admin, created = User.objects.get_or_create(
+            username='benchmark-admin', defaults={'is_staff': True, 'is_superuser': True}
+        )
+        if created:
+            admin.set_unusable_password()
+            admin.save()
+        return admin
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ''
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+
+from shoppelink.asgi_redirects import TrackingRedirectApp
+from shoppelink.clicks import click_buffer
+from shoppelink.models import AffiliateLink
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare tracking-redirect throughput through the WSGI and ASGI handlers in-process: "
+        "the view under WSGI worker threads, the view under Django's ASGI handler, and the same route "
+        "served by the TrackingRedirectApp fast path that asgi.py installs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000, help="Requests per mode.")
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help="Concurrent requests (threads for WSGI, tasks for ASGI).")
+        parser.add_argument('--links', type=int, default=100, help="Number of distinct hot links to hit.")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        links = list(AffiliateLink.objects.order_by('-click_count').only('id', 'short_code')[:options['links']])
+        if not links:
+            raise CommandError("No affiliate links found; run seed_data first.")
+        rng = random.Random(options['seed'])
+        paths = [rng.choice(links).get_absolute_url() for _ in range(options['requests'])]
+
+        results = {
+            'wsgi_view': self.run_wsgi(paths, options),
+            'asgi_view': self.run_asgi(paths, options),
+            'asgi_fast_path': self.run_asgi(paths, options, fast_path=True),
+        }
+        click_buffer.flush()
+        self.stdout.write(json.dumps({
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'results': results,
+        }, indent=2))
+
+    @staticmethod
+    def summarize(elapsed, statuses):
+        total = sum(statuses.values())
+        return {
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(total / elapsed, 1) if elapsed else 0.0,
+            'status_codes': {str(code): count for code, count in statuses.items()},
+        }
+
+    def run_wsgi(self, paths, options):
+        handler = WSGIHandler()
+
+        def call(path):
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+                'SERVER_PORT': '80', 'REMOTE_ADDR': '127.0.0.1', 'HTTP_HOST': 'localhost',
+                'wsgi.input': BytesIO(), 'wsgi.url_scheme': 'http', 'wsgi.errors': BytesIO(),
+            }
+            status = []
+            body = handler(environ, lambda code, headers, exc_info=None: status.append(code))
+            b''.join(body)
+            return int(status[0].split()[0])
+
+        call(paths[0])  # warm up caches and connections
+        statuses = {}
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            for code in pool.map(call, paths):
+                statuses[code] = statuses.get(code, 0) + 1
+        return self.summarize(time.perf_counter() - started, statuses)
+
+    def run_asgi(self, paths, options, fast_path=False):
+        handler = ASGIHandler()
+        if fast_path:
+            handler = TrackingRedirectApp(handler)
+
+        async def call(path):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+                'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+            }
+            sent = []
+            pending = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+            finished = asyncio.Event()
+
+            async def receive():
+                if pending:
+                    return pending.pop()
+                # Django keeps listening for a disconnect until the response is sent
+                await finished.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if message['type'] == 'http.response.body' and not message.get('more_body'):
+                    finished.set()
+
+            await handler(scope, receive, send)
+            return sent[0]['status']
+
+        async def run():
+            await call(paths[0])
+            semaphore = asyncio.Semaphore(options['concurrency'])
+
+            async def limited(path):
+                async with semaphore:
+                    return await call(path)
+
+            started = time.perf_counter()
+            codes = await asyncio.gather(*(limited(path) for path in paths))
+            return time.perf_counter() - started, codes
+
+        elapsed, codes = asyncio.run(run())
+        statuses = {}
+        for code in codes:
+            statuses[code] = statuses.get(code, 0) + 1
+        return self.summarize(elapsed, statuses)
@@ -0,0 +1,60 @@
+import os
+from datetime import date, datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shoppelink.exports import CHUNK_SIZE, EXPORTS, filtered_queryset, last_exported_id, stream_export
+
+
+def day_start(value):
+    return timezone.make_aware(datetime.combine(date.fromisoformat(value), time.min))
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream transactions or withdrawals to CSV or NDJSON with constant memory. "
+        "Rows are written in id order; --after or --resume continues an interrupted export."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(EXPORTS), help="What to export.")
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        parser.add_argument('--output', help="File to write. Defaults to stdout.")
+        parser.add_argument('--since', type=day_start, help="First day to include (YYYY-MM-DD).")
+        parser.add_argument('--before', type=day_start, help="Day to stop before (YYYY-MM-DD).")
+        parser.add_argument('--status', help="Only rows with this status.")
+        parser.add_argument('--after', type=int, help="Only rows with an id above this one.")
+        parser.add_argument('--resume', action='store_true',
+                            help="Append to --output, continuing after the last row it contains.")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows fetched per database round trip.")
+        parser.add_argument('--database', default='default', help="Database alias to read from.")
+
+    def handle(self, *args, **options):
+        name, fmt, output, after = options['name'], options['format'], options['output'], options['after']
+        resuming = options['resume'] and output and os.path.exists(output)
+        if options['resume'] and not output:
+            raise CommandError("--resume needs --output.")
+        if resuming:
+            # Also drops a partial trailing row, which an explicit --after must not leave behind either
+            last_id = last_exported_id(output, fmt)
+            if after is None:
+                after = last_id
+
+        queryset = filtered_queryset(name, options['since'], options['before'], options['status'])
+        queryset = queryset.using(options['database'])
+        header = not (resuming and os.path.getsize(output))
+        blocks = stream_export(name, queryset, fmt, after=after, header=header, chunk_size=options['chunk_size'])
+
+        if not output:
+            for block in blocks:
+                self.stdout.write(block, ending='')
+            return
+
+        with open(output, 'a' if resuming else 'w', newline='') as f:
+            for block in blocks:
+                f.write(block)
+        last_id = last_exported_id(output, fmt)
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {name} to {output}" + (f" up to id {last_id}." if last_id is not None else " (no rows).")
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.reports import BATCH_SIZE, import_report_file
+
+
+class Command(BaseCommand):
+    help = (
+        "Import conversion reports (CSV, NDJSON or JSON) from the affiliate network: match each "
+        "conversion to a transaction, then approve or reject it. Unmatched rows go to a mismatch report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('reports', nargs='+', help="Report files to import, in order.")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without writing.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Report rows per transaction.")
+        parser.add_argument('--mismatches', help="CSV file for rows that could not be applied. "
+                                                 "Defaults to <report>.mismatches.csv next to each report.")
+
+    def handle(self, *args, **options):
+        for path in options['reports']:
+            outcomes, mismatch_path = import_report_file(
+                path, dry_run=options['dry_run'], batch_size=options['batch_size'],
+                mismatch_path=options['mismatches'],
+            )
+            summary = ', '.join(f"{count} {outcome.replace('_', ' ')}" for outcome, count in sorted(outcomes.items()))
+            prefix = "Dry run of" if options['dry_run'] else "Imported"
+            self.stdout.write(self.style.SUCCESS(f"{prefix} {path}: {summary or 'no rows'}."))
+            if outcomes['mismatched']:
+                self.stdout.write(f"{outcomes['mismatched']} rows did not match; see {mismatch_path}.")
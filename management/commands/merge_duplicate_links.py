@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.conversion import merge_duplicate_links
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill canonical keys on affiliate links and merge each user's duplicate links "
+        "into one, moving clicks, click rollups and transactions to the surviving link."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help="Links examined per transaction.")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without writing.")
+
+    def handle(self, *args, **options):
+        backfilled, merged = merge_duplicate_links(options['batch_size'], dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(f"Would backfill {backfilled} canonical keys and merge {merged} duplicate links.")
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Backfilled {backfilled} canonical keys and merged {merged} duplicate links."
+            ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.stats import rebuild_user_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute UserStats rows from transactions, links and withdrawals."
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int, help="Only rebuild these users (default: all).")
+
+    def handle(self, *args, **options):
+        count = rebuild_user_stats(options['user_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} user stats rows."))
@@ -0,0 +1,74 @@
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.autoreload import get_child_arguments
+
+from shoppelink.commissions import RECOMPUTE_BATCH_SIZE, recompute_range, recompute_ranges, rules_checkpoint
+from shoppelink.jobs import enqueue
+from shoppelink.models import RollupCheckpoint
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-price pending transactions with the current commission rules. The work is split into ID ranges "
+        "that run in parallel processes (--processes) or as background jobs (--enqueue); running the same "
+        "--run again resumes it from its checkpoints, or starts it over once the rules have changed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--run', default='commissions',
+                            help="Name of the run; its checkpoints are kept under this name.")
+        parser.add_argument('--processes', type=int, default=1,
+                            help="Number of ID ranges, each run by its own process. Ignored when resuming.")
+        parser.add_argument('--enqueue', action='store_true',
+                            help="Queue one job per range for run_workers instead of running them here.")
+        parser.add_argument('--restart', action='store_true', help="Discard the run's checkpoints and start over.")
+        parser.add_argument('--batch-size', type=int, default=RECOMPUTE_BATCH_SIZE,
+                            help="Transactions per database transaction.")
+        parser.add_argument('--range', dest='range_name', help="Only run this range (used by the child processes).")
+
+    def handle(self, *args, **options):
+        run = options['run']
+        if len(run) > 16 or ':' in run:
+            raise CommandError("--run must be at most 16 characters, without ':'.")
+        if options['restart']:
+            RollupCheckpoint.objects.filter(name__startswith=f'recompute:{run}:').delete()
+        ranges = recompute_ranges(run, parts=max(1, options['processes']))
+        if not ranges:
+            self.stdout.write("No pending transactions.")
+            return
+        if options['range_name']:
+            ranges = [r for r in ranges if r[0] == options['range_name']]
+            if not ranges:
+                raise CommandError(f"No range {options['range_name']!r} in run {run!r}.")
+
+        if options['enqueue']:
+            # A run started over under new rules has the same names and positions as the last one
+            rules = RollupCheckpoint.objects.get(name=rules_checkpoint(run)).position
+            for name, _, last in ranges:
+                position = RollupCheckpoint.objects.get(name=name).position
+                job = enqueue('recompute_commissions', {'name': name, 'last': last},
+                              idempotency_key=f'{name}@{position}:{rules}')
+                self.stdout.write(f"Range {name} is job #{job.pk}.")
+            return
+        if len(ranges) > 1:
+            return self.supervise(ranges, options)
+
+        for name, _, last in ranges:
+            examined, updated = recompute_range(name, last, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"{name}: examined {examined}, updated {updated} transactions."))
+
+    def supervise(self, ranges, options):
+        # Separate interpreters rather than fork(), as in run_workers
+        launcher = get_child_arguments()[:-(len(sys.argv) - 1) or None]
+        children = [
+            subprocess.Popen(launcher + [
+                'recompute_commissions', '--run', options['run'], '--range', name,
+                '--batch-size', str(options['batch_size']),
+            ])
+            for name, _, _ in ranges
+        ]
+        failures = sum(child.wait() != 0 for child in children)
+        if failures:
+            raise CommandError(f"{failures} of {len(children)} ranges failed; run the command again to resume.")
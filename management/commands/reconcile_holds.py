@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.holds import reconcile_holds
+
+
+class Command(BaseCommand):
+    help = "Recompute the amounts held on balances from the pending withdrawals."
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int, help="Only reconcile these users (default: all).")
+
+    def handle(self, *args, **options):
+        count = reconcile_holds(options['user_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f"Corrected the held amount of {count} users."))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.stats import reconcile_site_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the site-wide totals on the admin dashboard from the source tables."
+
+    def handle(self, *args, **options):
+        for field, value in reconcile_site_stats().items():
+            self.stdout.write(f"{field}: {value}")
+        self.stdout.write(self.style.SUCCESS("Site stats reconciled."))
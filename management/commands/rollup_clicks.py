@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.clicks import prune_click_events, rollup_clicks
+
+
+class Command(BaseCommand):
+    help = "Fold new click events into hourly/daily rollups and prune old raw events."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument('--no-prune', action='store_true', help="Keep raw events past the retention window.")
+        parser.add_argument('--retention-days', type=int, default=None,
+                            help="Override CLICK_EVENT_RETENTION_DAYS.")
+
+    def handle(self, *args, **options):
+        processed = rollup_clicks(batch_size=options['batch_size'])
+        self.stdout.write(f"Rolled up {processed} click events.")
+        if not options['no_prune']:
+            deleted = prune_click_events(options['retention_days'])
+            self.stdout.write(f"Pruned {deleted} raw click events.")
+        self.stdout.write(self.style.SUCCESS("Done."))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.analytics import BATCH_SIZE, rollup_earnings
+
+
+class Command(BaseCommand):
+    help = "Fold new transactions and ledger entries into the daily/weekly/monthly earnings rollups."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        processed = rollup_earnings(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {processed} transactions and ledger entries."))
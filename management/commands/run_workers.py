@@ -0,0 +1,66 @@
+import signal
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+from django.utils.autoreload import get_child_arguments
+
+from shoppelink.jobs import work, worker_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background job workers. With --workers N, starts N worker processes and "
+        "waits for them; SIGINT/SIGTERM lets each finish its current job before exiting."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help="Number of worker processes.")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait before polling an empty queue again.")
+        parser.add_argument('--burst', action='store_true', help="Exit once no job is due.")
+        parser.add_argument('--max-jobs', type=int, help="Exit after running this many jobs.")
+
+    def handle(self, *args, **options):
+        if options['workers'] > 1:
+            return self.supervise(options)
+
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        name = worker_name()
+        self.stdout.write(f"Worker {name} started.")
+        processed = work(
+            name,
+            poll_interval=options['poll_interval'],
+            burst=options['burst'],
+            max_jobs=options['max_jobs'],
+            should_stop=lambda: bool(stopping),
+        )
+        self.stdout.write(self.style.SUCCESS(f"Worker {name} ran {processed} jobs."))
+
+    def supervise(self, options):
+        # Separate interpreters rather than fork(), so each worker opens its own database connection.
+        # get_child_arguments() re-creates how this process was started (manage.py, python -m django, ...)
+        # followed by our own arguments, which are swapped for the single-worker ones.
+        launcher = get_child_arguments()[:-(len(sys.argv) - 1) or None]
+        command = launcher + ['run_workers', '--poll-interval', str(options['poll_interval'])]
+        if options['burst']:
+            command.append('--burst')
+        if options['max_jobs']:
+            command += ['--max-jobs', str(options['max_jobs'])]
+        children = [subprocess.Popen(command) for _ in range(options['workers'])]
+
+        def forward(signum, frame):
+            for child in children:
+                child.send_signal(signum)
+
+        signal.signal(signal.SIGINT, forward)
+        signal.signal(signal.SIGTERM, forward)
+        failures = sum(child.wait() != 0 for child in children)
+        if failures:
+            self.stderr.write(f"{failures} of {len(children)} workers exited with an error.")
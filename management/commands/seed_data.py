@@ -0,0 +1,174 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from shoppelink.commissions import default_rates
+from shoppelink.conversion import canonical_key
+from shoppelink.holds import reconcile_holds
+from shoppelink.ledger import open_accounts
+from shoppelink.models import AffiliateLink, Transaction, UserProfile, Withdrawal
+from shoppelink.shortcodes import generate_code
+from shoppelink.stats import rebuild_user_stats, reconcile_site_stats
+
+BATCH_SIZE = 1000
+
+
+@contextmanager
+def manual_timestamps(*fields):
+    """Let bulk_create keep explicit values for auto_now_add fields, restoring the flags afterwards."""
+    saved = [(field, field.auto_now_add) for field in fields]
+    try:
+        for field in fields:
+            field.auto_now_add = False
+        yield
+    finally:
+        for field, auto_now_add in saved:
+            field.auto_now_add = auto_now_add
+
+
+def zipf_weights(count, exponent):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+class Command(BaseCommand):
+    help = "Seed a synthetic population of users, links, transactions and withdrawals for load testing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--links-per-user', type=int, default=20)
+        parser.add_argument('--transactions-per-user', type=int, default=50)
+        parser.add_argument('--withdrawals-per-user', type=int, default=3)
+        parser.add_argument('--clicks', type=int, default=100000, help="Total clicks spread across all links.")
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help="Zipf exponent for clicks and activity; higher means a few hot links/users.")
+        parser.add_argument('--days', type=int, default=365, help="Spread timestamps over this many past days.")
+        parser.add_argument('--password', default='benchmark-pass-123')
+        parser.add_argument('--prefix', default='seed', help="Username prefix for generated users.")
+        parser.add_argument('--seed', type=int, default=42, help="Random seed for reproducible datasets.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        now = timezone.now()
+        span = timedelta(days=options['days']).total_seconds()
+
+        def past():
+            return now - timedelta(seconds=rng.random() * span)
+
+        password = make_password(options['password'])
+        prefix = options['prefix']
+        start = User.objects.filter(username__startswith=f'{prefix}-').count()
+        users = User.objects.bulk_create(
+            [
+                User(username=f'{prefix}-{start + i}', email=f'{prefix}-{start + i}@example.com', password=password)
+                for i in range(options['users'])
+            ],
+            batch_size=BATCH_SIZE,
+        )
+        if users and users[0].pk is None:
+            users = list(User.objects.filter(username__in=[user.username for user in users]).order_by('pk'))
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in users], batch_size=BATCH_SIZE)
+
+        # A few users account for most of the activity
+        activity = zipf_weights(len(users), options['skew'])
+        total_activity = sum(activity)
+        self.stdout.write(f"Created {len(users)} users.")
+
+        with transaction.atomic(), manual_timestamps(
+            AffiliateLink._meta.get_field('created_at'),
+            Transaction._meta.get_field('created_at'),
+            Withdrawal._meta.get_field('requested_at'),
+        ):
+            links = []
+            for user in users:
+                for _ in range(options['links_per_user']):
+                    item = rng.randrange(10 ** 9)
+                    original_link = f'https://shopee.ph/product/{rng.randrange(10 ** 6)}/{item}'
+                    links.append(AffiliateLink(
+                        user=user,
+                        original_link=original_link,
+                        canonical_key=canonical_key(original_link),
+                        short_code=generate_code(),
+                        converted_link='',
+                        created_at=past(),
+                    ))
+            link_weights = zipf_weights(len(links), options['skew'])
+            rng.shuffle(link_weights)
+            total_weight = sum(link_weights)
+            for link, weight in zip(links, link_weights):
+                link.click_count = round(options['clicks'] * weight / total_weight)
+            links = AffiliateLink.objects.bulk_create(links, batch_size=BATCH_SIZE)
+            if links and links[0].pk is None:
+                links = list(AffiliateLink.objects.filter(user__in=users))
+            self.stdout.write(f"Created {len(links)} links.")
+
+            links_by_user = {}
+            for link in links:
+                links_by_user.setdefault(link.user_id, []).append(link)
+
+            rates = default_rates()
+            transactions = []
+            total_transactions = options['transactions_per_user'] * len(users)
+            for user, weight in zip(users, activity):
+                user_links = links_by_user.get(user.pk) or [None]
+                for _ in range(max(1, round(total_transactions * weight / total_activity))):
+                    price = Decimal(rng.randrange(100, 500000)) / 100
+                    commission = rates.commission(price)
+                    transactions.append(Transaction(
+                        user=user,
+                        affiliate_link=rng.choice(user_links),
+                        product_name=f'Product {rng.randrange(10 ** 6)}',
+                        product_price=price,
+                        estimated_commission=commission,
+                        cashback_amount=rates.cashback(commission),
+                        status=rng.choices(['pending', 'approved', 'rejected'], [3, 6, 1])[0],
+                        created_at=past(),
+                    ))
+            Transaction.objects.bulk_create(transactions, batch_size=BATCH_SIZE)
+            self.stdout.write(f"Created {len(transactions)} transactions.")
+
+            earned = {}
+            for txn in transactions:
+                if txn.status == 'approved':
+                    earned[txn.user_id] = earned.get(txn.user_id, Decimal('0.00')) + txn.cashback_amount
+
+            withdrawals = []
+            for user in users:
+                available = earned.get(user.pk, Decimal('0.00'))
+                for _ in range(options['withdrawals_per_user']):
+                    amount = Decimal(rng.randrange(10000, 50000)) / 100
+                    status = rng.choices(['pending', 'approved', 'rejected'], [1, 3, 1])[0]
+                    if status == 'approved':
+                        if amount > available:
+                            continue
+                        available -= amount
+                    withdrawals.append(Withdrawal(
+                        user=user,
+                        amount=amount,
+                        payment_method=rng.choice(['gcash', 'paymaya', 'bank']),
+                        payment_details=f'09{rng.randrange(10 ** 9):09d}',
+                        status=status,
+                        requested_at=past(),
+                        processed_at=now if status != 'pending' else None,
+                    ))
+                earned[user.pk] = available
+            Withdrawal.objects.bulk_create(withdrawals, batch_size=BATCH_SIZE)
+            self.stdout.write(f"Created {len(withdrawals)} withdrawals.")
+
+            profiles = list(UserProfile.objects.filter(user__in=users))
+            for profile in profiles:
+                profile.balance = earned.get(profile.user_id, Decimal('0.00'))
+            UserProfile.objects.bulk_update(profiles, ['balance'], batch_size=BATCH_SIZE)
+
+        # bulk_create skips the signals that keep the counters, so rebuild them from the new rows
+        rebuild_user_stats([user.pk for user in users])
+        reconcile_holds([user.pk for user in users])
+        reconcile_site_stats()
+        open_accounts()
+        self.stdout.write(self.style.SUCCESS("Seeding complete."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from shoppelink.ledger import open_accounts, take_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Snapshot the ledger balance of every user with new entries since the last run. Entries newer than "
+        "ROLLUP_LAG_SECONDS are left to a later run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--open-accounts', action='store_true',
+                            help="First record opening entries for balances that predate the ledger.")
+
+    def handle(self, *args, **options):
+        if options['open_accounts']:
+            opened = open_accounts()
+            self.stdout.write(f"Recorded {opened} opening balance entries.")
+        count = take_snapshots()
+        self.stdout.write(self.style.SUCCESS(f"Took {count} balance snapshots."))
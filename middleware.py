@@ -0,0 +1,203 @@
+"""
+Opt-in per-request profiling.
+
+When PROFILING_ENABLED is set, QueryProfilingMiddleware wraps every request
+in `execute_wrapper` on each database alias to count and time SQL queries,
+times template rendering (through the ProfilingTemplates backend configured
+in TEMPLATES) and the view as a whole, and folds the results into
+per-URL-name histograms served by the `metrics` view. Requests slower than
+PROFILING_SLOW_REQUEST_MS are logged with their slowest and most repeated
+SQL, which is usually enough to spot an N+1 pattern.
+
+With profiling disabled the middleware removes itself at startup, and the
+template backend only checks for a profile before each render. Enabled, it
+adds a few clock reads per query and per request.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template as DjangoTemplate
+
+logger = logging.getLogger('shoppelink.profiling')
+
+# Upper bounds in milliseconds, as used by Prometheus histograms
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_local = threading.local()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        running = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            running += count
+            yield bound, running
+
+
+class ViewMetrics:
+    def __init__(self, window):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_ms = 0.0
+        self.template_ms = 0.0
+        self.duplicate_requests = 0
+        self.recent = deque(maxlen=window)
+
+
+class MetricsRegistry:
+    """Process-wide, thread-safe store of per-view request metrics."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._views = defaultdict(lambda: ViewMetrics(self.window))
+        self._lock = threading.Lock()
+
+    def record(self, view, profile):
+        with self._lock:
+            metrics = self._views[view]
+            metrics.latency.observe(profile.total_ms)
+            metrics.queries.observe(profile.query_count)
+            metrics.db_ms += profile.db_ms
+            metrics.template_ms += profile.template_ms
+            metrics.duplicate_requests += bool(profile.duplicates())
+            metrics.recent.append(profile.total_ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {view: metrics for view, metrics in self._views.items()}
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+    def render_prometheus(self):
+        lines = []
+        for view, metrics in sorted(self.snapshot().items()):
+            label = f'view="{view}"'
+            for name, histogram in (('request_duration_ms', metrics.latency), ('request_queries', metrics.queries)):
+                for bound, running in histogram.cumulative():
+                    lines.append(f'shoppelink_{name}_bucket{{{label},le="{bound}"}} {running}')
+                lines.append(f'shoppelink_{name}_sum{{{label}}} {histogram.total:.3f}')
+                lines.append(f'shoppelink_{name}_count{{{label}}} {histogram.count}')
+            lines.append(f'shoppelink_db_time_ms_total{{{label}}} {metrics.db_ms:.3f}')
+            lines.append(f'shoppelink_template_time_ms_total{{{label}}} {metrics.template_ms:.3f}')
+            lines.append(f'shoppelink_duplicate_query_requests_total{{{label}}} {metrics.duplicate_requests}')
+            recent = sorted(metrics.recent)
+            for quantile in (0.5, 0.95, 0.99):
+                if recent:
+                    value = recent[min(len(recent) - 1, int(quantile * len(recent)))]
+                    lines.append(f'shoppelink_recent_duration_ms{{{label},quantile="{quantile}"}} {value:.3f}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry(window=getattr(settings, 'PROFILING_WINDOW', 1000))
+
+
+class RequestProfile:
+    def __init__(self):
+        self.queries = []
+        self.template_ms = 0.0
+        self.total_ms = 0.0
+
+    @property
+    def query_count(self):
+        return len(self.queries)
+
+    @property
+    def db_ms(self):
+        return sum(duration for _, duration in self.queries)
+
+    def duplicates(self, threshold=None):
+        """Return {sql: count} for statements repeated at least `threshold` times."""
+        threshold = threshold or getattr(settings, 'PROFILING_DUPLICATE_THRESHOLD', 3)
+        counts = Counter(sql for sql, _ in self.queries)
+        return {sql: count for sql, count in counts.items() if count >= threshold}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            # `sql` still has placeholders, so repeats of one statement share a signature
+            self.queries.append((sql, (time.perf_counter() - started) * 1000))
+
+
+class ProfiledTemplate(DjangoTemplate):
+    def render(self, context=None, request=None):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            profile.template_ms += (time.perf_counter() - started) * 1000
+
+
+class ProfilingTemplates(DjangoTemplates):
+    """The Django template backend, timing each template render into the request's profile."""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return ProfiledTemplate(super().get_template(template_name).template, self)
+
+
+class QueryProfilingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'PROFILING_SLOW_REQUEST_MS', 500)
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        _local.profile = profile
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                # Every alias, so that queries sent to the read replica are counted too
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _local.profile = None
+        profile.total_ms = (time.perf_counter() - started) * 1000
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name if match else None) or 'unresolved'
+        registry.record(view, profile)
+        if profile.total_ms >= self.slow_ms:
+            self.log_slow_request(request, view, profile)
+        return response
+
+    def log_slow_request(self, request, view, profile):
+        slowest = sorted(profile.queries, key=lambda query: query[1], reverse=True)[:5]
+        lines = [
+            f"Slow request {request.method} {request.path} ({view}): {profile.total_ms:.1f} ms total, "
+            f"{profile.query_count} queries in {profile.db_ms:.1f} ms, templates {profile.template_ms:.1f} ms"
+        ]
+        lines += [f"  {duration:.1f} ms: {sql}" for sql, duration in slowest]
+        for sql, count in profile.duplicates().items():
+            lines.append(f"  repeated {count}x: {sql}")
+        logger.warning('\n'.join(lines))
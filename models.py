@@ -1,12 +1,17 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.auth.models import User
+from django.urls import reverse
 from django.utils import timezone
-from decimal import Decimal
+
+from .shortcodes import generate_code
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     phone_number = models.CharField(max_length=15, blank=True, null=True)
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    # Reserved by pending withdrawals; what can still be withdrawn is balance - held (see holds.py)
+    held = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     
     def __str__(self):
         return f"{self.user.username}'s Profile"
@@ -19,13 +24,63 @@ class AffiliateLink(models.Model):
     )
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='affiliate_links')
     original_link = models.URLField()
-    converted_link = models.URLField()
+    # The /t/<id>/ URL handed out before short codes existed; only links that have one redirect by ID.
+    # Blank on new links, which views show with the URL from get_absolute_url()
+    converted_link = models.URLField(blank=True)
+    # Public ID used in tracking URLs; NULL only on rows created before short codes existed. No field
+    # default: adding the column must leave old rows NULL for backfill_short_codes (see shortcodes.py)
+    short_code = models.CharField(max_length=12, unique=True, null=True, blank=True, editable=False)
+    # SHA-256 of the canonical product URL (see conversion.canonical_key); NULL on rows not yet backfilled
+    canonical_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     click_count = models.PositiveIntegerField(default=0)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='link_user_created_idx'),
+            models.Index(fields=['created_at'], name='link_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'canonical_key'], name='unique_user_canonical_link'),
+        ]
+    
+    def clean(self):
+        # Report a second link to the same product here rather than as an IntegrityError on save
+        from .conversion import canonical_key
+        if self.original_link and self.user_id:
+            key = canonical_key(self.original_link)
+            if AffiliateLink.objects.filter(user_id=self.user_id, canonical_key=key).exclude(pk=self.pk).exists():
+                raise ValidationError({'original_link': "This user already has a link to this product."})
+    
+    def save(self, *args, **kwargs):
+        if self._state.adding and not self.short_code:
+            self.short_code = generate_code()
+        # Links created outside convert_links (admin, shell) need the key too; rows still
+        # without one are left to merge_duplicate_links, which merges their duplicates first
+        if self.original_link and (self._state.adding or self.canonical_key):
+            from .conversion import canonical_key
+            self.canonical_key = canonical_key(self.original_link)
+        super().save(*args, **kwargs)
+    
     def __str__(self):
         return f"Link by {self.user.username} - {self.created_at.strftime('%Y-%m-%d')}"
+    
+    def get_absolute_url(self):
+        """Path of the tracking redirect for this link"""
+        if self.short_code:
+            return reverse('track_short_link', args=[self.short_code])
+        return reverse('track_link_click', args=[self.pk])
+
+class LinkAlias(models.Model):
+    """ID of a duplicate link merged into `link`, so its tracking URL keeps working."""
+    alias_id = models.PositiveBigIntegerField(primary_key=True)
+    short_code = models.CharField(max_length=12, unique=True, null=True, blank=True)
+    link = models.ForeignKey(AffiliateLink, on_delete=models.CASCADE, related_name='aliases')
+    merged_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"Link {self.alias_id} -> {self.link_id}"
 
 class Transaction(models.Model):
     STATUS_CHOICES = (
@@ -41,18 +96,64 @@ class Transaction(models.Model):
     estimated_commission = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     cashback_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # Shopee shop ID and product category, for picking the commission rule (see commissions.py)
+    shop_id = models.CharField(max_length=20, blank=True)
+    category = models.CharField(max_length=100, blank=True)
+    # Conversion (order) ID from the affiliate network's report, once matched (see reports.py)
+    external_id = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            # Per-user listings and the dashboard, optionally filtered by status
+            models.Index(fields=['user', 'created_at', 'id'], name='txn_user_created_idx'),
+            models.Index(fields=['user', 'status', 'created_at', 'id'], name='txn_user_status_created_idx'),
+            # Dashboard "top products"
+            models.Index(fields=['user', 'status', 'cashback_amount'], name='txn_user_status_cashback_idx'),
+            # Admin status filter, date hierarchy and site-wide recent activity
+            models.Index(fields=['status', 'created_at'], name='txn_status_created_idx'),
+            models.Index(fields=['created_at'], name='txn_created_idx'),
+        ]
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what was loaded so signal handlers can tell what changed
+        instance._loaded_status = instance.__dict__.get('status')
+        instance._loaded_cashback = instance.__dict__.get('cashback_amount')
+        return instance
+    
     def save(self, *args, **kwargs):
-        # Calculate cashback as 5% of estimated commission if not already set
+        # Calculate cashback from the commission rules if not already set
         if self.estimated_commission and self.cashback_amount == 0:
-            self.cashback_amount = self.estimated_commission * Decimal('0.05')
+            from .commissions import rates_for
+            rates = rates_for(self.shop_id, self.category, self.created_at)
+            self.cashback_amount = rates.cashback(self.estimated_commission)
         super().save(*args, **kwargs)
     
     def __str__(self):
         return f"Transaction {self.id} - {self.user.username} - ₱{self.cashback_amount}"
 
+class CommissionRule(models.Model):
+    """Commission and cashback rates for a shop and/or category, optionally for a campaign period."""
+    name = models.CharField(max_length=100)
+    # Blank matches any shop or category
+    shop_id = models.CharField(max_length=20, blank=True)
+    category = models.CharField(max_length=100, blank=True)
+    # Share of the product price the network pays us, and share of that passed on as cashback
+    commission_rate = models.DecimalField(max_digits=5, decimal_places=4)
+    cashback_rate = models.DecimalField(max_digits=5, decimal_places=4)
+    starts_at = models.DateTimeField(null=True, blank=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
+    # Breaks ties between overlapping rules for the same shop and category
+    priority = models.IntegerField(default=0)
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name}: {self.commission_rate:.2%} commission, {self.cashback_rate:.2%} cashback"
+
 class Withdrawal(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -73,16 +174,251 @@ class Withdrawal(models.Model):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     requested_at = models.DateTimeField(auto_now_add=True)
     processed_at = models.DateTimeField(null=True, blank=True)
+    # Sent with the request form; repeating a key returns the withdrawal it created
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_user_withdrawal_key'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'requested_at', 'id'], name='wd_user_requested_idx'),
+            models.Index(fields=['user', 'status', 'requested_at', 'id'], name='wd_user_status_requested_idx'),
+            # Admin status filter, date hierarchy and the pending queue
+            models.Index(fields=['status', 'requested_at'], name='wd_status_requested_idx'),
+        ]
     
     def __str__(self):
         return f"Withdrawal {self.id} - {self.user.username} - ₱{self.amount}"
         
     def approve(self):
-        self.status = 'approved'
-        self.processed_at = timezone.now()
-        self.save()
+        """Approve this withdrawal if it is still pending, debiting the balance and releasing the hold."""
+        from .settlement import approve_withdrawals
+        
+        approve_withdrawals(Withdrawal.objects.filter(pk=self.pk))
+        self.refresh_from_db(fields=['status', 'processed_at'])
         
-        # Deduct the amount from user's balance
-        profile = self.user.profile
-        profile.balance -= self.amount
-        profile.save()
+    def reject(self):
+        """Reject this withdrawal if it is still pending, releasing the hold."""
+        from .settlement import reject_withdrawals
+        
+        reject_withdrawals(Withdrawal.objects.filter(pk=self.pk))
+        self.refresh_from_db(fields=['status', 'processed_at'])
+
+class UserStats(models.Model):
+    """Denormalized per-user totals, kept in step with transactions, links and withdrawals."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='stats')
+    total_orders = models.PositiveIntegerField(default=0)
+    approved_count = models.PositiveIntegerField(default=0)
+    pending_count = models.PositiveIntegerField(default=0)
+    approved_cashback = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    link_count = models.PositiveIntegerField(default=0)
+    total_withdrawn = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name_plural = 'user stats'
+    
+    def __str__(self):
+        return f"{self.user.username}'s Stats"
+
+class SiteStats(models.Model):
+    """
+    One shard of the site-wide totals shown on the admin dashboard. Deltas
+    go to a random shard so that concurrent writers rarely wait on the same
+    row; the totals are the sum over all shards (see stats.py), so a single
+    shard can go negative.
+    """
+    shard = models.PositiveSmallIntegerField(unique=True)
+    user_count = models.IntegerField(default=0)
+    link_count = models.IntegerField(default=0)
+    total_orders = models.IntegerField(default=0)
+    approved_count = models.IntegerField(default=0)
+    pending_count = models.IntegerField(default=0)
+    approved_cashback = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    total_withdrawn = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    pending_withdrawal_count = models.IntegerField(default=0)
+    pending_withdrawal_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name_plural = 'site stats'
+    
+    def __str__(self):
+        return f"Site stats shard {self.shard}"
+
+class LedgerEntry(models.Model):
+    """Immutable record of a change to a user's balance."""
+    ENTRY_TYPE_CHOICES = (
+        ('cashback', 'Cashback Credit'),
+        ('withdrawal', 'Withdrawal Debit'),
+        ('reversal', 'Reversal'),
+        ('adjustment', 'Adjustment'),
+    )
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ledger_entries')
+    entry_type = models.CharField(max_length=10, choices=ENTRY_TYPE_CHOICES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)  # positive credits, negative debits
+    # Plain references so entries keep pointing at rows that are later deleted
+    transaction = models.ForeignKey(Transaction, on_delete=models.DO_NOTHING, db_constraint=False,
+                                    null=True, blank=True, related_name='ledger_entries')
+    withdrawal = models.ForeignKey(Withdrawal, on_delete=models.DO_NOTHING, db_constraint=False,
+                                   null=True, blank=True, related_name='ledger_entries')
+    memo = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        verbose_name_plural = 'ledger entries'
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='ledger_user_created_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_entry_type_display()} {self.amount} for {self.user.username}"
+    
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("Ledger entries are immutable.")
+        super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries are immutable.")
+
+class BalanceSnapshot(models.Model):
+    """A user's balance after folding in every ledger entry up to `last_entry_id`."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_snapshots')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    last_entry_id = models.BigIntegerField()
+    taken_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'taken_at'], name='snapshot_user_taken_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username}: {self.balance} at {self.taken_at:%Y-%m-%d %H:%M}"
+
+class ClickEvent(models.Model):
+    link = models.ForeignKey(AffiliateLink, on_delete=models.CASCADE, related_name='click_events')
+    clicked_at = models.DateTimeField(default=timezone.now)
+    fingerprint = models.CharField(max_length=16, blank=True)
+    
+    def __str__(self):
+        return f"Click on link {self.link_id} at {self.clicked_at:%Y-%m-%d %H:%M:%S}"
+
+class ClickRollup(models.Model):
+    PERIOD_CHOICES = (
+        ('hour', 'Hourly'),
+        ('day', 'Daily'),
+    )
+    
+    # Rows with a link are per-link buckets; rows without one are per-user totals
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='click_rollups')
+    link = models.ForeignKey(AffiliateLink, on_delete=models.CASCADE, null=True, blank=True, related_name='click_rollups')
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket_start = models.DateTimeField()
+    clicks = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['link', 'period', 'bucket_start'],
+                condition=models.Q(link__isnull=False),
+                name='unique_link_click_bucket',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'period', 'bucket_start'],
+                condition=models.Q(link__isnull=True),
+                name='unique_user_click_bucket',
+            ),
+        ]
+    
+    def __str__(self):
+        target = f"link {self.link_id}" if self.link_id else self.user.username
+        return f"{self.get_period_display()} clicks for {target} at {self.bucket_start:%Y-%m-%d %H:00}"
+
+class EarningsRollup(models.Model):
+    """Orders, commission, cashback and clicks per day, week or month (see analytics.py)."""
+    PERIOD_CHOICES = (
+        ('day', 'Daily'),
+        ('week', 'Weekly'),
+        ('month', 'Monthly'),
+    )
+    
+    # Rows with a link are per-link buckets, rows with only a user are per-user
+    # totals and rows with neither are site-wide totals
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='earnings_rollups')
+    link = models.ForeignKey(AffiliateLink, on_delete=models.CASCADE, null=True, blank=True,
+                             related_name='earnings_rollups')
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    bucket_start = models.DateField()
+    orders = models.PositiveIntegerField(default=0)
+    commission = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    cashback = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    clicks = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        # One per scope; each also serves that scope's series reads
+        constraints = [
+            models.UniqueConstraint(
+                fields=['link', 'period', 'bucket_start'],
+                condition=models.Q(link__isnull=False),
+                name='unique_link_earnings_bucket',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'period', 'bucket_start'],
+                condition=models.Q(user__isnull=False, link__isnull=True),
+                name='unique_user_earnings_bucket',
+            ),
+            models.UniqueConstraint(
+                fields=['period', 'bucket_start'],
+                condition=models.Q(user__isnull=True, link__isnull=True),
+                name='unique_site_earnings_bucket',
+            ),
+        ]
+    
+    def __str__(self):
+        target = f"link {self.link_id}" if self.link_id else (self.user.username if self.user_id else "site")
+        return f"{self.get_period_display()} earnings for {target} from {self.bucket_start:%Y-%m-%d}"
+
+class RollupCheckpoint(models.Model):
+    """High-water mark of the last source row folded into a rollup table."""
+    name = models.CharField(max_length=50, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name} @ {self.position}"
+
+class Job(models.Model):
+    """A unit of background work, claimed and run by `run_workers` (see jobs.py)."""
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    )
+    
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    # Enqueueing again with the same key returns the existing job instead of adding one
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at', 'id'], name='job_status_run_at_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Job #{self.pk} {self.name} ({self.status})"
@@ -0,0 +1,95 @@
+"""
+Keyset (cursor) pagination for per-user listings.
+
+Pages are ordered newest first on `(order_field, id)`. A cursor encodes the
+sort key of the row at the edge of the current page, and the next or
+previous page is read with a range condition on that key, so every page
+costs one indexed range scan no matter how deep the user has scrolled.
+"""
+import base64
+from dataclasses import dataclass, field
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+PER_PAGE = 25
+
+
+@dataclass
+class KeysetPage:
+    items: list = field(default_factory=list)
+    next_cursor: str = ''
+    previous_cursor: str = ''
+
+    @property
+    def has_next(self):
+        return bool(self.next_cursor)
+
+    @property
+    def has_previous(self):
+        return bool(self.previous_cursor)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+def encode_cursor(direction, value, pk):
+    raw = f"{direction}|{value.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (direction, value, pk) for a cursor, or None if it is malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, value, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        value = parse_datetime(value)
+        if direction not in ('next', 'prev') or value is None:
+            return None
+        return direction, value, int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def paginate_keyset(queryset, cursor=None, order_field='created_at', per_page=PER_PAGE):
+    """Return the KeysetPage of `queryset` addressed by `cursor` (the first page if None)."""
+    decoded = decode_cursor(cursor) if cursor else None
+    direction = 'next'
+    if decoded is not None:
+        direction, value, pk = decoded
+        if direction == 'next':
+            queryset = queryset.filter(Q(**{f'{order_field}__lt': value}) | Q(**{order_field: value, 'pk__lt': pk}))
+        else:
+            queryset = queryset.filter(Q(**{f'{order_field}__gt': value}) | Q(**{order_field: value, 'pk__gt': pk}))
+
+    if direction == 'next':
+        rows = list(queryset.order_by(f'-{order_field}', '-pk')[:per_page + 1])
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        has_next, has_previous = more, decoded is not None
+    else:
+        rows = list(queryset.order_by(order_field, 'pk')[:per_page + 1])
+        more = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next, has_previous = True, more
+
+    page = KeysetPage(items=rows)
+    if rows and has_next:
+        last = rows[-1]
+        page.next_cursor = encode_cursor('next', getattr(last, order_field), last.pk)
+    if rows and has_previous:
+        first = rows[0]
+        page.previous_cursor = encode_cursor('prev', getattr(first, order_field), first.pk)
+    return page
+
+
+def status_filter(request, model):
+    """Return the `status` query parameter if it is one of `model`'s statuses, else ''."""
+    status = request.GET.get('status', '')
+    return status if status in dict(model.STATUS_CHOICES) else ''
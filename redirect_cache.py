@@ -0,0 +1,214 @@
+"""
+Bounded cache of tracking-link redirect targets.
+
+Lookups go through a per-process LRU with a TTL and, when
+REDIRECT_CACHE_ALIAS names a configured Django cache, through that shared
+cache as well. Unknown link IDs are cached as misses for a shorter TTL so
+that scans of random IDs do not reach the database either.
+
+Links resolve by ID only if they are from before short codes, i.e. still
+store their old URL in `converted_link`; newer links are only reachable by
+code. IDs of links merged away by merge_duplicate_links (which only merges
+such older links) resolve through LinkAlias to the surviving link's target. With a read alias configured, database
+lookups go to it first and to the primary on a miss (see routers.py).
+
+`short_code_cache` does the same for short-code URLs, mapping each code to
+a (link_id, original_link) pair so the redirect can record the click
+without another lookup.
+
+Saving or deleting an AffiliateLink invalidates its entry (see signals.py).
+The local LRU of other worker processes only catches up when their entry
+expires, so REDIRECT_CACHE_TTL bounds how long a stale target can be served.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import AffiliateLink, LinkAlias
+from .routers import read_aliases
+
+_MISSING = ''
+
+
+class RedirectCache:
+    """LRU/TTL cache mapping link IDs to original links, with hit/miss counters."""
+
+    def __init__(self, max_entries=10000, ttl=300, negative_ttl=30, cache_alias=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_alias = cache_alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    @property
+    def shared_cache(self):
+        return caches[self.cache_alias] if self.cache_alias else None
+
+    @staticmethod
+    def _key(link_id):
+        return f'shoppelink:redirect:{link_id}'
+
+    def get(self, link_id):
+        """Return the original link for `link_id`, or None if no such link exists."""
+        target = self._get_local(link_id)
+        if target is None and self.shared_cache is not None:
+            target = self.shared_cache.get(self._key(link_id))
+            if target is not None:
+                self._set_local(link_id, target)
+        if target is None:
+            self.misses += 1
+            target = self._store(link_id, self._lookup(link_id))
+            if self.shared_cache is not None:
+                self.shared_cache.set(self._key(link_id), target, self._ttl_for(target))
+        else:
+            self._count_hit(target)
+        return target or None
+
+    async def aget(self, link_id):
+        """Async variant of `get`; a local hit returns without leaving the event loop."""
+        target = self._get_local(link_id)
+        if target is None and self.shared_cache is not None:
+            target = await self.shared_cache.aget(self._key(link_id))
+            if target is not None:
+                self._set_local(link_id, target)
+        if target is None:
+            self.misses += 1
+            target = self._store(link_id, await self._alookup(link_id))
+            if self.shared_cache is not None:
+                await self.shared_cache.aset(self._key(link_id), target, self._ttl_for(target))
+        else:
+            self._count_hit(target)
+        return target or None
+
+    def _queries(self, link_id):
+        return [
+            # Only links from before short codes were handed out an ID-based URL
+            AffiliateLink.objects.filter(id=link_id).exclude(converted_link='').values_list('original_link', flat=True),
+            LinkAlias.objects.filter(alias_id=link_id).values_list('link__original_link', flat=True),
+        ]
+
+    def _lookup(self, key):
+        # The read alias may not have a just-created link yet, so a miss there is retried on the primary
+        for alias in read_aliases():
+            for query in self._queries(key):
+                value = query.using(alias).first()
+                if value is not None:
+                    return value
+        return None
+
+    async def _alookup(self, key):
+        for alias in read_aliases():
+            for query in self._queries(key):
+                value = await query.using(alias).afirst()
+                if value is not None:
+                    return value
+        return None
+
+    def _store(self, link_id, target):
+        if target is None:
+            target = _MISSING
+        self._set_local(link_id, target)
+        return target
+
+    def _count_hit(self, target):
+        if target == _MISSING:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+
+    def _ttl_for(self, target):
+        return self.negative_ttl if target == _MISSING else self.ttl
+
+    def _get_local(self, link_id):
+        with self._lock:
+            entry = self._entries.get(link_id)
+            if entry is None:
+                return None
+            target, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[link_id]
+                return None
+            self._entries.move_to_end(link_id)
+            return target
+
+    def _set_local(self, link_id, target):
+        with self._lock:
+            self._entries[link_id] = (target, time.monotonic() + self._ttl_for(target))
+            self._entries.move_to_end(link_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, link_id):
+        with self._lock:
+            self._entries.pop(link_id, None)
+        if self.shared_cache is not None:
+            self.shared_cache.delete(self._key(link_id))
+
+    def invalidate_many(self, link_ids):
+        link_ids = list(link_ids)
+        with self._lock:
+            for link_id in link_ids:
+                self._entries.pop(link_id, None)
+        if self.shared_cache is not None and link_ids:
+            self.shared_cache.delete_many([self._key(link_id) for link_id in link_ids])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+
+class ShortCodeCache(RedirectCache):
+    """RedirectCache keyed by short code, caching (link_id, original_link) pairs."""
+
+    @staticmethod
+    def _key(code):
+        return f'shoppelink:shortcode:{code}'
+
+    def _queries(self, code):
+        return [
+            AffiliateLink.objects.filter(short_code=code).values_list('id', 'original_link'),
+            LinkAlias.objects.filter(short_code=code).values_list('link_id', 'link__original_link'),
+        ]
+
+    def _lookup(self, key):
+        value = super()._lookup(key)
+        return tuple(value) if value is not None else None
+
+    async def _alookup(self, key):
+        value = await super()._alookup(key)
+        return tuple(value) if value is not None else None
+
+
+redirect_cache = RedirectCache(
+    max_entries=getattr(settings, 'REDIRECT_CACHE_MAX_ENTRIES', 10000),
+    ttl=getattr(settings, 'REDIRECT_CACHE_TTL', 300),
+    negative_ttl=getattr(settings, 'REDIRECT_CACHE_NEGATIVE_TTL', 30),
+    cache_alias=getattr(settings, 'REDIRECT_CACHE_ALIAS', None),
+)
+
+short_code_cache = ShortCodeCache(
+    max_entries=getattr(settings, 'REDIRECT_CACHE_MAX_ENTRIES', 10000),
+    ttl=getattr(settings, 'REDIRECT_CACHE_TTL', 300),
+    negative_ttl=getattr(settings, 'REDIRECT_CACHE_NEGATIVE_TTL', 30),
+    cache_alias=getattr(settings, 'REDIRECT_CACHE_ALIAS', None),
+)
@@ -0,0 +1,411 @@
+"""
+Import of conversion reports from the affiliate network.
+
+The network reports every order it attributes to us with its own
+conversion ID, the sub-ID we tagged the click with (a link's short code,
+or its numeric ID for links that predate short codes), the amounts, and
+whether the order completed or was cancelled. `import_report` reads such
+a file (CSV, NDJSON, or a JSON array) as a stream and settles it in
+batches of BATCH_SIZE rows, each batch in one database transaction:
+
+1. Rows are matched to transactions by conversion ID (`external_id`),
+   then by sub-ID to the link, through dictionaries filled with a few
+   `__in` queries per batch. A link's oldest pending, not yet matched
+   transaction (typically the one its user submitted by hand) takes the
+   conversion. A conversion with no such transaction gets a new one.
+2. Matched pending transactions take the reported amounts with
+   `bulk_update`; new ones are inserted with `bulk_create`, already in
+   the reported status. The cashback share of the reported commission
+   comes from the commission rules for the shop and category.
+3. Completed and cancelled conversions are approved or rejected through
+   settlement.py, which also posts the ledger entries and UserStats
+   changes of the inserted rows, so both stay consistent.
+
+Rows that cannot be applied (undecodable lines, unknown sub-ID, bad
+amounts, a status that contradicts an already settled transaction, ...)
+are passed to the
+`mismatch` callback with a reason instead of stopping the import. With
+`dry_run`, every batch is rolled back after it has been processed, so the
+counts are exactly what a real run would do.
+
+Re-importing a report is safe: conversions already matched are found by
+`external_id` and only settled if they are still pending.
+"""
+import csv
+import json
+from collections import Counter, defaultdict, deque
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Q
+
+from . import settlement
+from .commissions import get_rules
+from .conversion import shop_id_of
+from .models import AffiliateLink, LinkAlias, Transaction
+
+BATCH_SIZE = 10000
+AMOUNT_FIELDS = ('product_name', 'shop_id', 'category', 'product_price', 'estimated_commission', 'cashback_amount')
+
+# Report column names we accept for each field, after lower-casing and replacing spaces/dashes with '_'
+COLUMNS = {
+    'conversion_id': ('conversion_id', 'order_id', 'checkout_id'),
+    'sub_id': ('sub_id', 'subid', 'sub_id1'),
+    'product_name': ('product_name', 'item_name'),
+    'shop_id': ('shop_id', 'shopid'),
+    'category': ('category', 'category_name', 'l1_category', 'item_category'),
+    'product_price': ('product_price', 'price', 'purchase_value', 'order_amount'),
+    'commission': ('commission', 'estimated_commission', 'net_commission'),
+    'status': ('status', 'order_status', 'conversion_status'),
+}
+REPORT_STATUSES = {
+    'pending': 'pending',
+    'completed': 'approved',
+    'approved': 'approved',
+    'paid': 'approved',
+    'cancelled': 'rejected',
+    'canceled': 'rejected',
+    'rejected': 'rejected',
+    'invalid': 'rejected',
+}
+
+
+class ReportRow:
+    __slots__ = (
+        'line', 'conversion_id', 'sub_id', 'product_name', 'shop_id', 'category', 'product_price', 'commission',
+        'status',
+    )
+
+    def __init__(self, line, conversion_id, sub_id, product_name, shop_id, category, product_price, commission,
+                 status):
+        self.line = line
+        self.conversion_id = conversion_id
+        self.sub_id = sub_id
+        self.product_name = product_name
+        self.shop_id = shop_id
+        self.category = category
+        self.product_price = product_price
+        self.commission = commission
+        self.status = status
+
+
+def read_records(f, invalid=None):
+    """
+    Yield (line number, dict) from a CSV, NDJSON or JSON-array report file
+    opened in text mode. Lines or rows that cannot be decoded are skipped
+    and passed to `invalid(line number, reason)`. In a JSON array the number
+    is the record's position; nothing after an undecodable record can be
+    read, so the array ends there.
+    """
+    invalid = invalid or (lambda number, reason: None)
+    start = f.read(1)
+    while start.isspace():
+        start = f.read(1)
+    if start == '[':
+        number = 0
+        try:
+            for number, record in enumerate(_iter_json_array(f), start=1):
+                yield number, record
+        except json.JSONDecodeError as error:
+            invalid(number + 1, f"invalid JSON ({error.msg}); the rest of the array was not read")
+        return
+    if start == '{':
+        for number, line in enumerate(f, start=1):
+            line = (start + line) if number == 1 else line
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as error:
+                invalid(number, f"invalid JSON ({error.msg})")
+                continue
+            yield number, record
+        return
+    reader = csv.DictReader(_prepend(start, f))
+    reader.fieldnames  # Read the header first, so that line_num counts it
+    while True:
+        # The reader does not count the line it fails on
+        first_line = reader.line_num + 1
+        try:
+            record = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            invalid(first_line, f"unreadable CSV row ({error})")
+            continue
+        yield reader.line_num, record
+
+
+def _prepend(first, lines):
+    lines = iter(lines)
+    yield first + next(lines, '')
+    yield from lines
+
+
+def _iter_json_array(f, chunk_size=64 * 1024):
+    """Decode the objects of a JSON array one at a time, without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if buffer:
+                    raise
+                return
+            buffer += chunk
+            continue
+        yield record
+        buffer = buffer[end:]
+
+
+def normalize_record(record):
+    """Map a report record's column names to their canonical spelling (lower case, '_' for spaces and dashes)."""
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+    return {
+        str(key).strip().lower().replace(' ', '_').replace('-', '_'): value
+        for key, value in record.items() if key is not None
+    }
+
+
+def get_column(values, field):
+    for name in COLUMNS[field]:
+        value = values.get(name)
+        if value not in (None, ''):
+            return str(value).strip()
+    return ''
+
+
+def parse_record(line, values):
+    """Return a ReportRow for one normalized record, or raise ValueError with the reason it is unusable."""
+    conversion_id = get_column(values, 'conversion_id')
+    if not conversion_id:
+        raise ValueError("missing conversion ID")
+    if len(conversion_id) > 64:
+        raise ValueError("conversion ID longer than 64 characters")
+    status = REPORT_STATUSES.get(get_column(values, 'status').lower())
+    if status is None:
+        raise ValueError(f"unknown status {get_column(values, 'status')!r}")
+    try:
+        price = Decimal(get_column(values, 'product_price') or 0).quantize(Decimal('0.01'))
+        commission = Decimal(get_column(values, 'commission') or 0).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError("invalid amount")
+    if price < 0 or commission < 0:
+        raise ValueError("negative amount")
+    return ReportRow(
+        line, conversion_id, get_column(values, 'sub_id'), get_column(values, 'product_name')[:255],
+        get_column(values, 'shop_id')[:20], get_column(values, 'category')[:100], price, commission, status,
+    )
+
+
+class LinkIndex:
+    """sub-ID -> (link_id, user_id, shop_id) for the report's links, filled with three queries per batch."""
+
+    def __init__(self):
+        self._links = {}
+
+    def load(self, sub_ids):
+        missing = {sub_id for sub_id in sub_ids if sub_id and sub_id not in self._links}
+        if not missing:
+            return
+        ids = [int(sub_id) for sub_id in missing if sub_id.isdigit() and len(sub_id) < 19]
+        for link_id, user_id, url, code in (
+            AffiliateLink.objects.filter(short_code__in=missing)
+            .values_list('id', 'user_id', 'original_link', 'short_code')
+        ):
+            self._links[code] = (link_id, user_id, shop_id_of(url))
+        by_id = AffiliateLink.objects.filter(id__in=ids).values_list('id', 'user_id', 'original_link')
+        for link_id, user_id, url in by_id:
+            self._links.setdefault(str(link_id), (link_id, user_id, shop_id_of(url)))
+        # Sub-IDs of links merged into another one
+        aliases = LinkAlias.objects.filter(Q(alias_id__in=ids) | Q(short_code__in=missing)).values_list(
+            'alias_id', 'short_code', 'link_id', 'link__user_id', 'link__original_link',
+        )
+        for alias_id, code, link_id, user_id, url in aliases:
+            for key in (str(alias_id), code):
+                if key in missing:
+                    self._links.setdefault(key, (link_id, user_id, shop_id_of(url)))
+        for sub_id in missing:
+            self._links.setdefault(sub_id, None)
+
+    def get(self, sub_id):
+        return self._links.get(sub_id)
+
+
+def import_report(f, dry_run=False, batch_size=BATCH_SIZE, mismatch=None):
+    """
+    Apply a conversion report read from the text file `f`. Returns a Counter
+    of outcomes; rows that could not be applied also go to
+    `mismatch(line, conversion_id, sub_id, reason)`.
+    """
+    return ReportImporter(dry_run, batch_size, mismatch).run(f)
+
+
+class ReportImporter:
+    def __init__(self, dry_run=False, batch_size=BATCH_SIZE, mismatch=None):
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.mismatch = mismatch
+        self.outcomes = Counter()
+        self.links = LinkIndex()
+        self.seen = set()
+        # Transactions matched so far; a dry run rolls back, so the database cannot tell
+        self.claimed = set()
+
+    def reject(self, line, conversion_id, sub_id, reason):
+        self.outcomes['mismatched'] += 1
+        if self.mismatch is not None:
+            self.mismatch(line, conversion_id, sub_id, reason)
+
+    def unreadable(self, line, reason):
+        self.outcomes['rows'] += 1
+        self.reject(line, '', '', reason)
+
+    def run(self, f):
+        batch = []
+        for line, record in read_records(f, invalid=self.unreadable):
+            self.outcomes['rows'] += 1
+            try:
+                values = normalize_record(record)
+            except ValueError as error:
+                self.reject(line, '', '', str(error))
+                continue
+            try:
+                row = parse_record(line, values)
+            except ValueError as error:
+                self.reject(line, get_column(values, 'conversion_id'), get_column(values, 'sub_id'), str(error))
+                continue
+            if row.conversion_id in self.seen:
+                self.reject(line, row.conversion_id, row.sub_id, "duplicate conversion ID in this report")
+                continue
+            self.seen.add(row.conversion_id)
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.apply_batch(batch)
+                batch = []
+        if batch:
+            self.apply_batch(batch)
+        return self.outcomes
+
+    def revise(self, txn, row, rules, shop_id=''):
+        """Copy the reported product, where given, and amounts onto `txn`. Returns whether anything changed."""
+        shop_id = row.shop_id or txn.shop_id or shop_id
+        category = row.category or txn.category
+        values = {
+            'shop_id': shop_id,
+            'category': category,
+            'estimated_commission': row.commission,
+            'cashback_amount': rules.rates(shop_id, category, txn.created_at).cashback(row.commission),
+        }
+        # A blank or zero product column means the report left it out; keep what the user entered
+        if row.product_name:
+            values['product_name'] = row.product_name
+        if row.product_price:
+            values['product_price'] = row.product_price
+        changed = any(getattr(txn, field) != value for field, value in values.items())
+        for field, value in values.items():
+            setattr(txn, field, value)
+        return changed
+
+    def apply_batch(self, rows):
+        rules = get_rules()
+        with transaction.atomic():
+            existing = {
+                txn.external_id: txn
+                for txn in Transaction.objects.filter(external_id__in=[row.conversion_id for row in rows])
+                .only('id', 'user_id', 'status', 'external_id', 'created_at', *AMOUNT_FIELDS)
+            }
+            new_rows = [row for row in rows if row.conversion_id not in existing]
+            self.links.load(row.sub_id for row in new_rows)
+
+            # Hand-submitted transactions waiting for a conversion, oldest first per link
+            link_ids = {self.links.get(row.sub_id)[0] for row in new_rows if self.links.get(row.sub_id)}
+            candidates = defaultdict(deque)
+            for txn in (
+                Transaction.objects.filter(affiliate_link_id__in=link_ids, status='pending', external_id__isnull=True)
+                .order_by('created_at', 'id')
+                # revise() compares every amount field; one left deferred would be loaded row by row
+                .only('id', 'user_id', 'affiliate_link_id', 'status', 'external_id', 'created_at', *AMOUNT_FIELDS)
+            ):
+                if txn.pk not in self.claimed:
+                    candidates[txn.affiliate_link_id].append(txn)
+
+            matched, created, targets = [], [], []
+            for row in rows:
+                txn = existing.get(row.conversion_id)
+                if txn is not None and txn.status != 'pending':
+                    if txn.status != row.status:
+                        self.reject(row.line, row.conversion_id, row.sub_id,
+                                    f"transaction #{txn.pk} is already {txn.status}, report says {row.status}")
+                    else:
+                        self.outcomes['unchanged'] += 1
+                    continue
+
+                if txn is not None:
+                    # Reported again while still pending; amounts may have been revised
+                    if self.revise(txn, row, rules):
+                        matched.append(txn)
+                        self.outcomes['updated'] += 1
+                    else:
+                        self.outcomes['unchanged'] += 1
+                else:
+                    link = self.links.get(row.sub_id)
+                    if link is None:
+                        self.reject(row.line, row.conversion_id, row.sub_id, "unknown sub-ID")
+                        continue
+                    link_id, user_id, shop_id = link
+                    if candidates[link_id]:
+                        txn = candidates[link_id].popleft()
+                        self.claimed.add(txn.pk)
+                        matched.append(txn)
+                        self.outcomes['matched'] += 1
+                    else:
+                        # Inserted directly in the reported status; settling it afterwards would rewrite every row
+                        txn = Transaction(user_id=user_id, affiliate_link_id=link_id, status=row.status)
+                        created.append(txn)
+                        self.outcomes['created'] += 1
+                        self.outcomes[row.status] += 1
+                    txn.external_id = row.conversion_id
+                    self.revise(txn, row, rules, shop_id)
+                if txn.status == 'pending' and row.status != 'pending':
+                    targets.append((txn, row.status))
+
+            if matched:
+                Transaction.objects.bulk_update(matched, ['external_id', *AMOUNT_FIELDS], batch_size=500)
+            if created:
+                Transaction.objects.bulk_create(created, batch_size=500)
+                settlement.record_new_transactions(created)
+
+            to_approve = [txn.pk for txn, status in targets if status == 'approved']
+            to_reject = [txn.pk for txn, status in targets if status == 'rejected']
+            if to_approve:
+                approved = settlement.approve_transactions(Transaction.objects.filter(pk__in=to_approve))
+                self.outcomes['approved'] += approved
+            if to_reject:
+                rejected = settlement.reject_transactions(Transaction.objects.filter(pk__in=to_reject))
+                self.outcomes['rejected'] += rejected
+
+            if self.dry_run:
+                transaction.set_rollback(True)
+
+
+def import_report_file(path, dry_run=False, batch_size=BATCH_SIZE, mismatch_path=None):
+    """
+    Import the report at `path`, writing rows that could not be applied to
+    the CSV `mismatch_path` (by default next to the report). Returns
+    (outcomes, mismatch_path).
+    """
+    mismatch_path = mismatch_path or f'{path}.mismatches.csv'
+    with open(path, newline='', encoding='utf-8-sig') as report, open(mismatch_path, 'w', newline='') as mismatches:
+        writer = csv.writer(mismatches)
+        writer.writerow(['line', 'conversion_id', 'sub_id', 'reason'])
+        outcomes = import_report(report, dry_run=dry_run, batch_size=batch_size,
+                                 mismatch=lambda *row: writer.writerow(row))
+    return outcomes, mismatch_path
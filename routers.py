@@ -0,0 +1,125 @@
+"""
+Read/write splitting between the primary database and a read alias.
+
+Writes always go to 'default'. Reads go there too, except inside code
+that opted in with `read_from_replica`: the dashboard, the listings and
+the redirect lookups. Those read from READ_REPLICA_ALIAS when it is
+configured in DATABASES, leaving the primary to the writes from the
+admin and the background jobs.
+
+A replica can lag behind the primary. Two rules keep a user's own
+writes visible to them:
+- PrimaryStickinessMiddleware pins every POST to the primary. After a
+  POST it sets a short-lived cookie, so that the user's next requests
+  also read from the primary for DATABASE_REPLICA_STICKY_SECONDS.
+- Reads inside a transaction on the primary stay on the primary.
+Redirect lookups fall back to the primary when the replica does not have
+the link yet, so a link converted a moment ago does not 404.
+
+Without a read alias configured, all of this leaves every query on 'default'.
+"""
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+READ_REPLICA_ALIAS = 'replica'
+STICKY_COOKIE = 'db_primary'
+
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+_pinned = contextvars.ContextVar('pinned_to_primary', default=False)
+
+
+def replica_configured():
+    return READ_REPLICA_ALIAS in settings.DATABASES
+
+
+def read_aliases():
+    """Aliases a replica-tolerant read should try, in order; the primary comes last."""
+    if replica_configured() and not _pinned.get():
+        return [READ_REPLICA_ALIAS, DEFAULT_DB_ALIAS]
+    return [DEFAULT_DB_ALIAS]
+
+
+@contextmanager
+def replica_reads():
+    """Route reads in this block to the read alias, unless the request is pinned to the primary."""
+    token = _read_alias.set(READ_REPLICA_ALIAS)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Route every read in this block to the primary."""
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def read_from_replica(view):
+    """View decorator: the view's queries may be served by the read alias."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads():
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _read_alias.get() is None or _pinned.get() or not replica_configured():
+            return None
+        # Inside a transaction on the primary, read what it has written
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class PrimaryStickinessMiddleware:
+    """Pin POSTs, and the requests that follow them for a few seconds, to the primary."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sticky_seconds = getattr(settings, 'DATABASE_REPLICA_STICKY_SECONDS', 5)
+
+    def __call__(self, request):
+        writing = request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+        if not (writing or STICKY_COOKIE in request.COOKIES):
+            return self.get_response(request)
+
+        with primary_reads():
+            response = self.get_response(request)
+        if writing and replica_configured():
+            response.set_cookie(STICKY_COOKIE, '1', max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+        return response
+
+
+def configure_sqlite(connection):
+    """
+    Tune a new SQLite connection. WAL lets readers carry on while a write
+    is in progress. busy_timeout makes a blocked writer wait for the lock
+    instead of failing at once with "database is locked".
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA busy_timeout={int(getattr(settings, 'SQLITE_BUSY_TIMEOUT_MS', 20000))}")
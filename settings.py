@@ -45,11 +45,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shoppelink.middleware.QueryProfilingMiddleware',  # No-op unless PROFILING_ENABLED
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'shoppelink.routers.PrimaryStickinessMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -58,15 +60,23 @@ ROOT_URLCONF = 'generateshoppe.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, timing renders for the profiling middleware
+        'BACKEND': 'shoppelink.middleware.ProfilingTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            # Parse each template once per process. The dev server's autoreloader
+            # clears this cache when a template changes.
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     },
 ]
@@ -75,12 +85,49 @@ WSGI_APPLICATION = 'generateshoppe.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
+# DATABASE_* variables select another backend (e.g. a local PostgreSQL);
+# without them this is the SQLite file it has always been.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': '/tmp/db.sqlite3' if not DEBUG else BASE_DIR / 'db.sqlite3',
+        'ENGINE': os.environ.get('DATABASE_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('DATABASE_NAME') or ('/tmp/db.sqlite3' if not DEBUG else BASE_DIR / 'db.sqlite3'),
+        'USER': os.environ.get('DATABASE_USER', ''),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+        'HOST': os.environ.get('DATABASE_HOST', ''),
+        'PORT': os.environ.get('DATABASE_PORT', ''),
+        # Keep connections open between requests, checking them before reuse
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': os.environ.get('DATABASE_CONN_HEALTH_CHECKS', 'True') == 'True',
     }
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Take the write lock when a transaction starts, so that two writers
+    # queue on busy_timeout instead of deadlocking on the upgrade. WAL and
+    # busy_timeout themselves are set per connection (shoppelink/routers.py).
+    DATABASES['default']['OPTIONS'] = {'transaction_mode': 'IMMEDIATE'}
+    # Tests use a file as well: the shared in-memory test database answers
+    # concurrent writers with "table is locked" instead of making them wait
+    DATABASES['default']['TEST'] = {'NAME': '/tmp/test_db.sqlite3' if not DEBUG else BASE_DIR / 'test_db.sqlite3'}
+
+# Optional read alias for the dashboard, listings and redirect lookups (see
+# shoppelink/routers.py). Set DATABASE_REPLICA_NAME (a second SQLite file or
+# database) and/or DATABASE_REPLICA_HOST; the other settings follow 'default'.
+if os.environ.get('DATABASE_REPLICA_NAME') or os.environ.get('DATABASE_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ.get('DATABASE_REPLICA_NAME') or DATABASES['default']['NAME'],
+        'HOST': os.environ.get('DATABASE_REPLICA_HOST') or DATABASES['default']['HOST'],
+        'PORT': os.environ.get('DATABASE_REPLICA_PORT') or DATABASES['default']['PORT'],
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_REPLICA_CONN_MAX_AGE', DATABASES['default']['CONN_MAX_AGE'])),
+        'CONN_HEALTH_CHECKS': os.environ.get(
+            'DATABASE_REPLICA_CONN_HEALTH_CHECKS', str(DATABASES['default']['CONN_HEALTH_CHECKS'])) == 'True',
+        'OPTIONS': {},
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['shoppelink.routers.ReadReplicaRouter']
+# After a POST, the same browser reads from the primary for this many seconds
+DATABASE_REPLICA_STICKY_SECONDS = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 5))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 20000))
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -112,6 +159,17 @@ STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')] if os.path.exists(os.path.join(BASE_DIR, 'static')) else []
 
+# In production, collectstatic writes fingerprinted, minified and pre-compressed
+# copies (see shoppelink/storage.py). Serve STATIC_ROOT from the web server with
+# "Cache-Control: public, max-age=31536000, immutable" and gzip_static/brotli_static.
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': ('django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+                    else 'shoppelink.storage.CompressedManifestStaticFilesStorage'),
+    },
+}
+
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
@@ -137,3 +195,53 @@ if not DEBUG:
     SECURE_HSTS_SECONDS = 31536000
     SECURE_HSTS_INCLUDE_SUBDOMAINS = True
     SECURE_HSTS_PRELOAD = True
+
+# Click tracking: clicks are buffered per worker and written back in batches.
+# A crashed worker loses at most CLICK_BUFFER_MAX_PENDING clicks or
+# CLICK_BUFFER_FLUSH_INTERVAL seconds of clicks, whichever comes first.
+CLICK_BUFFER_MAX_PENDING = int(os.environ.get('CLICK_BUFFER_MAX_PENDING', 500))
+CLICK_BUFFER_FLUSH_INTERVAL = float(os.environ.get('CLICK_BUFFER_FLUSH_INTERVAL', 5))
+
+# Redirect target cache for tracking links. Set REDIRECT_CACHE_ALIAS to a
+# shared cache (e.g. 'default' backed by Redis/Memcached) to share entries
+# between workers; the per-process LRU is always used in front of it.
+REDIRECT_CACHE_MAX_ENTRIES = 10000
+REDIRECT_CACHE_TTL = 300
+REDIRECT_CACHE_NEGATIVE_TTL = 30
+REDIRECT_CACHE_ALIAS = os.environ.get('REDIRECT_CACHE_ALIAS') or None
+
+# Raw ClickEvent rows are deleted by `rollup_clicks` after this many days,
+# once they have been folded into the hourly/daily rollups.
+CLICK_EVENT_RETENTION_DAYS = int(os.environ.get('CLICK_EVENT_RETENTION_DAYS', 30))
+# Click, transaction and ledger rollups only take rows whose ids were first
+# seen at least this many seconds earlier, so that rows committed out of id
+# order are not skipped. Keep it above the longest writing transaction.
+ROLLUP_LAG_SECONDS = int(os.environ.get('ROLLUP_LAG_SECONDS', 60))
+
+# Request profiling (see shoppelink/middleware.py). Metrics are served at
+# /metrics/ to staff users, or to scrapers sending "Authorization: Bearer <token>".
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SLOW_REQUEST_MS = int(os.environ.get('PROFILING_SLOW_REQUEST_MS', 500))
+PROFILING_DUPLICATE_THRESHOLD = 3
+PROFILING_WINDOW = 1000
+PROFILING_METRICS_TOKEN = os.environ.get('PROFILING_METRICS_TOKEN', '')
+
+# Background jobs (see shoppelink/jobs.py), run by `manage.py run_workers`.
+# A job still 'running' after JOB_LOCK_TIMEOUT seconds is assumed orphaned and
+# re-queued, so keep it above the longest job. Failed attempts are retried
+# after JOB_RETRY_BACKOFF seconds, doubling each time.
+JOB_LOCK_TIMEOUT = int(os.environ.get('JOB_LOCK_TIMEOUT', 600))
+JOB_RETRY_BACKOFF = int(os.environ.get('JOB_RETRY_BACKOFF', 30))
+
+# Admin dashboard (see views.admin_dashboard). Site totals come from the
+# SiteStats counters, which `reconcile_site_stats` rebuilds; schedule it
+# e.g. hourly. The snapshot is shared by all staff for this many seconds.
+ADMIN_DASHBOARD_CACHE_TTL = int(os.environ.get('ADMIN_DASHBOARD_CACHE_TTL', 30))
+ADMIN_PENDING_WITHDRAWALS_PER_PAGE = 20
+
+# Commission and cashback rates where no CommissionRule applies (see
+# shoppelink/commissions.py). Each process re-reads the rules when they have
+# changed, checking at most every COMMISSION_RULES_CHECK_SECONDS.
+COMMISSION_DEFAULT_RATE = os.environ.get('COMMISSION_DEFAULT_RATE', '0.10')
+CASHBACK_DEFAULT_RATE = os.environ.get('CASHBACK_DEFAULT_RATE', '0.05')
+COMMISSION_RULES_CHECK_SECONDS = int(os.environ.get('COMMISSION_RULES_CHECK_SECONDS', 5))
@@ -0,0 +1,147 @@
+"""
+Set-based approval and rejection of transactions and withdrawals.
+
+Each call settles a whole queryset inside one database transaction: the
+pending rows are locked and read once, their status is flipped with
+chunked UPDATEs, and one ledger entry per row those UPDATEs actually
+changed is bulk-inserted. The resulting balance and UserStats changes are
+summed per user and added in place by `stats.bulk_increment`, one
+set-based UPDATE ... SET f = f + CASE user_id ... END per batch of users,
+so the query count grows with the number of batches rather than with the
+number of rows.
+
+Settling a withdrawal also releases the hold it placed on the user's
+balance (see holds.py), in the same transaction.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import holds, ledger
+from .models import LedgerEntry, Transaction, Withdrawal
+from .stats import apply_site_stats, apply_user_stats_bulk, merge_deltas, transaction_deltas
+
+BATCH_SIZE = 500
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _lock_pending(queryset, amount_field):
+    """Lock the pending rows of `queryset` and return (id, user_id, amount) tuples."""
+    return list(
+        queryset.filter(status='pending')
+        .select_for_update()
+        .order_by('pk')
+        .values_list('pk', 'user_id', amount_field)
+    )
+
+
+def _set_status(model, rows, stamp_field, status):
+    """
+    Move the locked `rows` from pending to `status` and return the ones this
+    call changed. Where select_for_update does not lock (SQLite), another
+    settlement may have got to some of them first; they are left to it.
+    """
+    now = timezone.now()
+    changed = []
+    for chunk in _chunks(rows):
+        ids = [pk for pk, _, _ in chunk]
+        updated = model.objects.filter(pk__in=ids, status='pending').update(status=status, **{stamp_field: now})
+        if updated == len(chunk):
+            changed.extend(chunk)
+        elif updated:
+            ours = set(
+                model.objects.filter(pk__in=ids, status=status, **{stamp_field: now}).values_list('pk', flat=True)
+            )
+            changed.extend(row for row in chunk if row[0] in ours)
+    return changed
+
+
+def approve_transactions(queryset):
+    """Approve the pending transactions in `queryset` and credit their cashback. Returns the count."""
+    with transaction.atomic():
+        rows = _set_status(Transaction, _lock_pending(queryset, 'cashback_amount'), 'updated_at', 'approved')
+        if not rows:
+            return 0
+
+        ledger.post_many([
+            LedgerEntry(user_id=user_id, amount=cashback, entry_type='cashback', transaction_id=pk)
+            for pk, user_id, cashback in rows
+        ])
+
+        stats = defaultdict(lambda: defaultdict(int))
+        for _, user_id, cashback in rows:
+            stats[user_id]['approved_count'] += 1
+            stats[user_id]['pending_count'] -= 1
+            stats[user_id]['approved_cashback'] += cashback
+        apply_user_stats_bulk(stats)
+    return len(rows)
+
+
+def reject_transactions(queryset):
+    """Reject the pending transactions in `queryset`. Returns the count."""
+    with transaction.atomic():
+        rows = _set_status(Transaction, _lock_pending(queryset, 'cashback_amount'), 'updated_at', 'rejected')
+        if not rows:
+            return 0
+
+        stats = defaultdict(lambda: defaultdict(int))
+        for _, user_id, _ in rows:
+            stats[user_id]['pending_count'] -= 1
+        apply_user_stats_bulk(stats)
+    return len(rows)
+
+
+def record_new_transactions(transactions):
+    """
+    Account for transactions just inserted with bulk_create, which skips the
+    post_save handlers: count them in UserStats and credit the cashback of
+    those inserted already approved.
+    """
+    with transaction.atomic():
+        ledger.post_many([
+            LedgerEntry(user_id=txn.user_id, amount=txn.cashback_amount, entry_type='cashback', transaction_id=txn.pk)
+            for txn in transactions if txn.status == 'approved'
+        ])
+        stats = defaultdict(dict)
+        for txn in transactions:
+            stats[txn.user_id] = merge_deltas(stats[txn.user_id], transaction_deltas(txn.status, txn.cashback_amount))
+        apply_user_stats_bulk(stats)
+
+
+def approve_withdrawals(queryset):
+    """Approve the pending withdrawals in `queryset`, debit their amounts and release their holds. Returns the count."""
+    with transaction.atomic():
+        rows = _set_status(Withdrawal, _lock_pending(queryset, 'amount'), 'processed_at', 'approved')
+        if not rows:
+            return 0
+
+        ledger.post_many([
+            LedgerEntry(user_id=user_id, amount=-amount, entry_type='withdrawal', withdrawal_id=pk)
+            for pk, user_id, amount in rows
+        ])
+        holds.release_many(rows)
+
+        debits = defaultdict(Decimal)
+        for _, user_id, amount in rows:
+            debits[user_id] += amount
+        apply_user_stats_bulk({user_id: {'total_withdrawn': amount} for user_id, amount in debits.items()})
+        apply_site_stats(pending_withdrawal_count=-len(rows), pending_withdrawal_amount=-sum(debits.values()))
+    return len(rows)
+
+
+def reject_withdrawals(queryset):
+    """Reject the pending withdrawals in `queryset` and release their holds. Returns the count."""
+    with transaction.atomic():
+        rows = _set_status(Withdrawal, _lock_pending(queryset, 'amount'), 'processed_at', 'rejected')
+        holds.release_many(rows)
+        apply_site_stats(
+            pending_withdrawal_count=-len(rows),
+            pending_withdrawal_amount=-sum(amount for _, _, amount in rows),
+        )
+    return len(rows)
@@ -0,0 +1,34 @@
+"""
+Opaque short codes for tracking URLs.
+
+Codes are random base62 strings drawn before the row is inserted, so a link
+is created with one write and its public URL reveals nothing about how many
+links exist. Eight characters give 62**8 (about 2 * 10**14) codes; the
+unique index on AffiliateLink.short_code catches the rare collision, and
+convert_links retries with fresh codes.
+
+The field has no default on purpose. Adding a unique column with a callable
+default makes the migration evaluate it once and give every existing row
+the same code. The column is added nullable, existing rows get their codes
+from `backfill_short_codes` in batches, and new rows get theirs from
+convert_links or AffiliateLink.save().
+
+Only links created before short codes existed redirect by ID (/t/<id>/):
+they are the ones with the old URL stored in `converted_link`. A new link
+can only be reached through its code.
+"""
+import secrets
+import string
+
+ALPHABET = string.digits + string.ascii_letters
+CODE_LENGTH = 8
+# Collisions in a row before giving up; one is already unlikely at 62**8
+MAX_ATTEMPTS = 5
+
+
+def generate_code(length=CODE_LENGTH):
+    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+def is_valid_code(code):
+    return 0 < len(code) <= 12 and all(char in ALPHABET for char in code)
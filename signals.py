@@ -0,0 +1,94 @@
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import holds
+from .commissions import rule_cache
+from .models import AffiliateLink, CommissionRule, Transaction, UserStats, Withdrawal
+from .redirect_cache import redirect_cache, short_code_cache
+from .routers import configure_sqlite
+from .stats import apply_site_stats, apply_user_stats, merge_deltas, transaction_deltas
+
+
+@receiver(connection_created)
+def tune_new_connection(sender, connection, **kwargs):
+    configure_sqlite(connection)
+
+
+@receiver(post_save, sender=AffiliateLink)
+@receiver(post_delete, sender=AffiliateLink)
+def invalidate_redirect_cache(sender, instance, **kwargs):
+    redirect_cache.invalidate(instance.pk)
+    if instance.short_code:
+        short_code_cache.invalidate(instance.short_code)
+
+
+@receiver(post_save, sender=CommissionRule)
+@receiver(post_delete, sender=CommissionRule)
+def invalidate_commission_rules(sender, **kwargs):
+    rule_cache.invalidate()
+
+
+@receiver(post_save, sender=User)
+def create_user_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UserStats.objects.get_or_create(user=instance)
+        apply_site_stats(user_count=1)
+
+
+@receiver(post_delete, sender=User)
+def uncount_deleted_user(sender, instance, **kwargs):
+    apply_site_stats(user_count=-1)
+
+
+@receiver(post_save, sender=AffiliateLink)
+def count_new_link(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        apply_user_stats(instance.user_id, link_count=1)
+
+
+@receiver(post_delete, sender=AffiliateLink)
+def count_deleted_link(sender, instance, **kwargs):
+    apply_user_stats(instance.user_id, link_count=-1)
+
+
+@receiver(post_save, sender=Transaction)
+def track_transaction_stats(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        deltas = transaction_deltas(instance.status, instance.cashback_amount)
+    else:
+        old_status = getattr(instance, '_loaded_status', None)
+        old_cashback = getattr(instance, '_loaded_cashback', None)
+        if old_status is None or (old_status, old_cashback) == (instance.status, instance.cashback_amount):
+            return
+        deltas = merge_deltas(
+            transaction_deltas(old_status, old_cashback, sign=-1),
+            transaction_deltas(instance.status, instance.cashback_amount),
+        )
+    apply_user_stats(instance.user_id, **deltas)
+    instance._loaded_status = instance.status
+    instance._loaded_cashback = instance.cashback_amount
+
+
+@receiver(post_delete, sender=Transaction)
+def untrack_transaction_stats(sender, instance, **kwargs):
+    apply_user_stats(instance.user_id, **transaction_deltas(instance.status, instance.cashback_amount, sign=-1))
+
+
+@receiver(post_save, sender=Withdrawal)
+def count_new_withdrawal(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.status == 'pending':
+        apply_site_stats(pending_withdrawal_count=1, pending_withdrawal_amount=instance.amount)
+        holds.hold(instance.user_id, instance.amount)
+
+
+@receiver(post_delete, sender=Withdrawal)
+def untrack_withdrawal_stats(sender, instance, **kwargs):
+    if instance.status == 'approved':
+        apply_user_stats(instance.user_id, total_withdrawn=-instance.amount)
+    elif instance.status == 'pending':
+        apply_site_stats(pending_withdrawal_count=-1, pending_withdrawal_amount=-instance.amount)
+        holds.release_many([(instance.pk, instance.user_id, instance.amount)])
@@ -0,0 +1,194 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const sidebar = document.getElementById('sidebar');
+    const mainContent = document.getElementById('mainContent');
+    const sidebarToggle = document.getElementById('sidebarToggle');
+    const mobileMenuToggle = document.getElementById('mobileMenuToggle');
+    const sidebarOverlay = document.getElementById('sidebarOverlay');
+
+    // Sidebar toggle functionality
+    if (sidebarToggle) {
+        sidebarToggle.addEventListener('click', function(e) {
+            e.preventDefault();
+            sidebar.classList.toggle('collapsed');
+            mainContent.classList.toggle('expanded');
+
+            const icon = this.querySelector('i');
+            if (sidebar.classList.contains('collapsed')) {
+                icon.className = 'fas fa-chevron-right';
+            } else {
+                icon.className = 'fas fa-chevron-left';
+            }
+
+            // Add smooth animation
+            mainContent.style.transition = 'all 0.4s cubic-bezier(0.25, 0.46, 0.45, 0.94)';
+            setTimeout(() => {
+                mainContent.style.transition = '';
+            }, 400);
+        });
+    }
+
+    // Mobile menu toggle with animation
+    if (mobileMenuToggle) {
+        mobileMenuToggle.addEventListener('click', function(e) {
+            e.preventDefault();
+            sidebar.classList.toggle('show');
+            sidebarOverlay.classList.toggle('show');
+
+            // Add slide animation for better UX
+            if (sidebar.classList.contains('show')) {
+                sidebar.style.animation = 'slideIn 0.3s forwards';
+                document.body.style.overflow = 'hidden'; // Prevent background scrolling
+            } else {
+                sidebar.style.animation = 'slideOut 0.3s forwards';
+                document.body.style.overflow = '';
+            }
+        });
+    }
+
+    // Sidebar overlay click with smooth transition
+    if (sidebarOverlay) {
+        sidebarOverlay.addEventListener('click', function() {
+            sidebar.classList.remove('show');
+            sidebarOverlay.classList.remove('show');
+            sidebar.style.animation = 'slideOut 0.3s forwards';
+            document.body.style.overflow = '';
+        });
+    }
+
+    // Add slide in/out animations
+    const style = document.createElement('style');
+    style.textContent = `
+        @keyframes slideIn {
+            from { transform: translateX(-100%); }
+            to { transform: translateX(0); }
+        }
+        @keyframes slideOut {
+            from { transform: translateX(0); }
+            to { transform: translateX(-100%); }
+        }
+    `;
+    document.head.appendChild(style);
+
+    // Active navigation highlighting with animation
+    const currentPath = window.location.pathname;
+    const navLinks = document.querySelectorAll('.sidebar .nav-link');
+
+    navLinks.forEach(link => {
+        link.classList.remove('active');
+        if (link.getAttribute('href') === currentPath) {
+            link.classList.add('active');
+
+            // Scroll active link into view if needed
+            setTimeout(() => {
+                link.scrollIntoView({ behavior: 'smooth', block: 'center' });
+            }, 100);
+        }
+
+        // Add hover animation
+        link.addEventListener('mouseenter', function() {
+            if (!this.classList.contains('active')) {
+                this.style.transition = 'all 0.3s cubic-bezier(0.25, 0.46, 0.45, 0.94)';
+            }
+        });
+
+        link.addEventListener('mouseleave', function() {
+            if (!this.classList.contains('active')) {
+                this.style.transition = '';
+            }
+        });
+    });
+
+    // Enhanced logout function with loading state and animation
+    function handleLogout(e) {
+        e.preventDefault();
+        const element = e.currentTarget; // Use currentTarget instead of target
+        const originalHTML = element.innerHTML;
+
+        if (confirm('Are you sure you want to logout?')) {
+            // Show loading state with spinner animation
+            element.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Logging out...';
+            element.style.pointerEvents = 'none';
+            element.style.opacity = '0.7';
+
+            // Create a form to submit logout request
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = document.body.dataset.logoutUrl;
+
+            // Add CSRF token
+            const csrfInput = document.createElement('input');
+            csrfInput.type = 'hidden';
+            csrfInput.name = 'csrfmiddlewaretoken';
+            csrfInput.value = document.body.dataset.csrfToken;
+            form.appendChild(csrfInput);
+
+            document.body.appendChild(form);
+
+            // Brief timeout for better UX
+            setTimeout(() => {
+                form.submit();
+            }, 500);
+        }
+    }
+
+    // Handle logout functionality for dropdown link
+    const logoutLink = document.getElementById('logoutLink');
+    const sidebarLogoutLink = document.getElementById('sidebarLogoutLink');
+
+    if (logoutLink) {
+        logoutLink.addEventListener('click', handleLogout);
+    }
+
+    if (sidebarLogoutLink) {
+        sidebarLogoutLink.addEventListener('click', handleLogout);
+    }
+
+    // Enhanced auto-hide alerts with animation
+    const alerts = document.querySelectorAll('.alert');
+    alerts.forEach(alert => {
+        setTimeout(() => {
+            alert.style.animation = 'slideOutUp 0.5s ease forwards';
+            setTimeout(() => {
+                if (alert.parentNode) {
+                    const bsAlert = new bootstrap.Alert(alert);
+                    bsAlert.close();
+                }
+            }, 500);
+        }, 5000);
+    });
+
+    // Add hover effects to cards
+    document.querySelectorAll('.card').forEach(card => {
+        card.addEventListener('mouseenter', function() {
+            this.style.transform = 'translateY(-2px)';
+        });
+
+        card.addEventListener('mouseleave', function() {
+            this.style.transform = 'translateY(0)';
+        });
+    });
+
+    // Window resize handler
+    window.addEventListener('resize', function() {
+        if (window.innerWidth > 992) {
+            sidebar.classList.remove('show');
+            sidebarOverlay.classList.remove('show');
+        }
+    });
+});
+
+// Add slide out animation for alerts
+const style = document.createElement('style');
+style.textContent = `
+    @keyframes slideOutUp {
+        from {
+            transform: translateY(0);
+            opacity: 1;
+        }
+        to {
+            transform: translateY(-100%);
+            opacity: 0;
+        }
+    }
+`;
+document.head.appendChild(style);
@@ -0,0 +1,265 @@
+"""
+Per-user totals for the dashboard and withdrawal pages.
+
+Totals live in the denormalized UserStats row, so read paths cost one
+indexed lookup no matter how many transactions a user has. Write paths
+adjust the row with `F()` deltas in the same database transaction as the
+change itself (see signals.py and the admin actions). A missing row is
+never patched with deltas; it is built from scratch with
+`compute_user_stats` the first time it is read, and `rebuild_user_stats`
+reconciles any drift in bulk.
+
+Site-wide totals for the admin dashboard follow the same pattern in the
+SiteStats shards: every delta applied to a user's row is also added to one
+shard picked at random, and reading them sums a handful of rows instead of
+counting the source tables. `reconcile_site_stats` recomputes them from
+scratch; it runs on first read and periodically from a job.
+"""
+import random
+from collections import defaultdict
+from decimal import Decimal
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.db import connections, router, transaction
+from django.db.models import Count, F, Q, Sum
+
+from .models import AffiliateLink, SiteStats, Transaction, UserProfile, UserStats, Withdrawal
+
+STAT_FIELDS = (
+    'total_orders', 'approved_count', 'pending_count', 'approved_cashback', 'link_count', 'total_withdrawn',
+)
+SITE_STAT_FIELDS = (
+    'user_count', 'link_count', 'total_orders', 'approved_count', 'pending_count', 'approved_cashback',
+    'total_withdrawn', 'pending_withdrawal_count', 'pending_withdrawal_amount',
+)
+SITE_STATS_SHARDS = 8
+
+
+def transaction_deltas(status, cashback_amount, sign=1):
+    """Return the UserStats deltas contributed by one transaction in `status`."""
+    deltas = {'total_orders': sign}
+    if status == 'approved':
+        deltas['approved_count'] = sign
+        deltas['approved_cashback'] = sign * Decimal(cashback_amount or 0)
+    elif status == 'pending':
+        deltas['pending_count'] = sign
+    return deltas
+
+
+def merge_deltas(*deltas):
+    merged = defaultdict(int)
+    for delta in deltas:
+        for field, value in delta.items():
+            merged[field] += value
+    return {field: value for field, value in merged.items() if value}
+
+
+def apply_user_stats(user_id, **deltas):
+    """Add `deltas` to the user's UserStats row, if it exists yet."""
+    deltas = {field: value for field, value in deltas.items() if value}
+    if deltas:
+        UserStats.objects.filter(user_id=user_id).update(
+            **{field: F(field) + value for field, value in deltas.items()}
+        )
+        apply_site_stats(**deltas)
+
+
+def bulk_increment(model, deltas_by_user, batch_size=500):
+    """
+    Add {user_id: {field: delta}} to rows of a per-user `model`, with one
+    UPDATE per `batch_size` users:
+
+        SET field = field + CASE user_id WHEN %s THEN %s ... ELSE 0 END
+
+    The statement is written out directly: bulk_update() with F() builds and
+    resolves an expression tree per row and field, which cost more than the
+    rest of a large report import together.
+    """
+    deltas_by_user = {
+        user_id: {field: value for field, value in deltas.items() if value}
+        for user_id, deltas in deltas_by_user.items()
+    }
+    deltas_by_user = {user_id: deltas for user_id, deltas in deltas_by_user.items() if deltas}
+    fields = sorted({field for deltas in deltas_by_user.values() for field in deltas})
+    if not fields:
+        return
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    user_column = quote(model._meta.get_field('user').column)
+    # Each user takes up to two parameters per field and one in the WHERE clause
+    max_params = connection.features.max_query_params
+    if max_params:
+        batch_size = min(batch_size, max_params // (2 * len(fields) + 1))
+    user_ids = list(deltas_by_user)
+    for start in range(0, len(user_ids), batch_size):
+        chunk = user_ids[start:start + batch_size]
+        assignments, params = [], []
+        for field in fields:
+            column = quote(model._meta.get_field(field).column)
+            cases = [(user_id, deltas_by_user[user_id][field]) for user_id in chunk if field in deltas_by_user[user_id]]
+            if not cases:
+                continue
+            assignments.append(
+                f"{column} = {column} + CASE {user_column} {' '.join(['WHEN %s THEN %s'] * len(cases))} ELSE 0 END"
+            )
+            params.extend(value for case in cases for value in case)
+        params.extend(chunk)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {quote(model._meta.db_table)} SET {', '.join(assignments)} "
+                f"WHERE {user_column} IN ({', '.join(['%s'] * len(chunk))})",
+                params,
+            )
+
+
+def apply_user_stats_bulk(deltas_by_user):
+    """Apply a {user_id: {field: delta}} mapping to existing UserStats rows."""
+    bulk_increment(UserStats, deltas_by_user)
+    apply_site_stats(**merge_deltas(*deltas_by_user.values()))
+
+
+def apply_site_stats(**deltas):
+    """Add `deltas` to one SiteStats shard, once the shards have been built."""
+    deltas = {field: value for field, value in deltas.items() if value and field in SITE_STAT_FIELDS}
+    if deltas:
+        SiteStats.objects.filter(shard=random.randrange(SITE_STATS_SHARDS)).update(
+            **{field: F(field) + value for field, value in deltas.items()}
+        )
+
+
+def compute_user_stats(user_ids=None):
+    """Recompute totals from the source tables. Returns {user_id: {field: value}}."""
+    transactions = Transaction.objects.all()
+    links = AffiliateLink.objects.all()
+    withdrawals = Withdrawal.objects.filter(status='approved')
+    if user_ids is not None:
+        transactions = transactions.filter(user_id__in=user_ids)
+        links = links.filter(user_id__in=user_ids)
+        withdrawals = withdrawals.filter(user_id__in=user_ids)
+
+    totals = defaultdict(lambda: {
+        'total_orders': 0, 'approved_count': 0, 'pending_count': 0,
+        'approved_cashback': Decimal('0.00'), 'link_count': 0, 'total_withdrawn': Decimal('0.00'),
+    })
+    for user_id in user_ids or ():
+        totals[user_id]  # users with no activity still get a zeroed row
+    approved = Q(status='approved')
+    for row in transactions.order_by().values('user_id').annotate(
+        total_orders=Count('id'),
+        approved_count=Count('id', filter=approved),
+        pending_count=Count('id', filter=Q(status='pending')),
+        approved_cashback=Sum('cashback_amount', filter=approved),
+    ):
+        stats = totals[row.pop('user_id')]
+        stats.update({field: value for field, value in row.items() if value is not None})
+    for row in links.order_by().values('user_id').annotate(count=Count('id')):
+        totals[row['user_id']]['link_count'] = row['count']
+    for row in withdrawals.order_by().values('user_id').annotate(total=Sum('amount')):
+        totals[row['user_id']]['total_withdrawn'] = row['total']
+    return dict(totals)
+
+
+def rebuild_user_stats(user_ids=None, batch_size=500):
+    """Overwrite UserStats rows with freshly computed totals. Returns the number of rows written."""
+    if user_ids is None:
+        user_ids = User.objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=batch_size)
+    user_ids = iter(user_ids)
+    written = 0
+    while chunk := list(islice(user_ids, batch_size)):
+        written += _rebuild_chunk(chunk, batch_size)
+    return written
+
+
+def _rebuild_chunk(user_ids, batch_size):
+    with transaction.atomic():
+        totals = compute_user_stats(user_ids)
+        existing = UserStats.objects.select_for_update().filter(user_id__in=user_ids)
+        to_update = []
+        for stats in existing:
+            for field, value in totals.pop(stats.user_id).items():
+                setattr(stats, field, value)
+            to_update.append(stats)
+        UserStats.objects.bulk_update(to_update, STAT_FIELDS, batch_size=batch_size)
+        created = UserStats.objects.bulk_create(
+            [UserStats(user_id=user_id, **values) for user_id, values in totals.items()],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+    return len(to_update) + len(created)
+
+
+def get_user_stats(user):
+    """Return the user's UserStats row, building it on first use."""
+    try:
+        return UserStats.objects.get(user=user)
+    except UserStats.DoesNotExist:
+        rebuild_user_stats([user.pk])
+        # The row was just written to the primary; a replica may not have it yet
+        return UserStats.objects.using(router.db_for_write(UserStats)).get(user=user)
+
+
+def compute_site_stats():
+    """Recompute the site-wide totals from the source tables."""
+    approved = Q(status='approved')
+    totals = Transaction.objects.aggregate(
+        total_orders=Count('id'),
+        approved_count=Count('id', filter=approved),
+        pending_count=Count('id', filter=Q(status='pending')),
+        approved_cashback=Sum('cashback_amount', filter=approved),
+    )
+    totals.update(Withdrawal.objects.aggregate(
+        total_withdrawn=Sum('amount', filter=approved),
+        pending_withdrawal_count=Count('id', filter=Q(status='pending')),
+        pending_withdrawal_amount=Sum('amount', filter=Q(status='pending')),
+    ))
+    totals['user_count'] = User.objects.count()
+    totals['link_count'] = AffiliateLink.objects.count()
+    return {field: totals[field] or 0 for field in SITE_STAT_FIELDS}
+
+
+def reconcile_site_stats():
+    """
+    Overwrite the SiteStats shards with freshly computed totals, creating
+    them if needed. Returns the totals. The shards stay locked while the
+    source tables are counted, so deltas from concurrent writes wait and
+    land on top of the new values. Only a change committed before its
+    delta (a save in autocommit mode, whose signal runs afterwards) can be
+    counted twice, until the next reconciliation.
+    """
+    with transaction.atomic():
+        SiteStats.objects.bulk_create(
+            [SiteStats(shard=shard) for shard in range(SITE_STATS_SHARDS)], ignore_conflicts=True,
+        )
+        list(SiteStats.objects.select_for_update().values_list('pk'))
+        totals = compute_site_stats()
+        SiteStats.objects.filter(shard=0).update(**totals)
+        SiteStats.objects.exclude(shard=0).update(**{field: 0 for field in SITE_STAT_FIELDS})
+    return totals
+
+
+def get_site_stats():
+    """Return the site-wide totals as a dict, building the shards on first use."""
+    totals = SiteStats.objects.aggregate(shards=Count('id'), **{field: Sum(field) for field in SITE_STAT_FIELDS})
+    if not totals.pop('shards'):
+        return reconcile_site_stats()
+    return totals
+
+
+def get_dashboard_stats(user):
+    """Return the user's profile with the dashboard counters attached.
+
+    The returned UserProfile carries `total_orders`, `transaction_count`,
+    `pending_count`, `total_cashback` and `link_count` attributes.
+    """
+    profile = UserProfile.objects.select_related('user__stats').get(user=user)
+    try:
+        stats = profile.user.stats
+    except UserStats.DoesNotExist:
+        stats = get_user_stats(user)
+    profile.total_orders = stats.total_orders
+    profile.transaction_count = stats.approved_count
+    profile.pending_count = stats.pending_count
+    profile.total_cashback = stats.approved_cashback
+    profile.link_count = stats.link_count
+    return profile
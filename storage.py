@@ -0,0 +1,88 @@
+"""
+Static file storage for production.
+
+`collectstatic` with CompressedManifestStaticFilesStorage writes a
+content-hashed copy of every file (css/base.55a0e3f1c2b4.css) and
+{% static %} resolves names to those copies through the manifest. A
+changed file therefore gets a new URL, which is what makes it safe to
+serve STATIC_ROOT with a far-future `Cache-Control: immutable` header.
+
+On top of that, hashed stylesheets are minified, and text assets get
+pre-compressed .gz (and .br, when the optional `brotli` package is
+installed) siblings for the web server to send as-is, e.g. nginx's
+`gzip_static on;` / `brotli_static on;`. Nothing is compressed per request.
+
+Minification runs after hashing, so the fingerprint is that of the
+source file; it still changes whenever the source does.
+"""
+import gzip
+import re
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only .gz variants are written
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+
+# Comments and string literals; strings are matched so that their contents are never touched
+_CSS_COMMENT_OR_STRING = re.compile(r'''/\*.*?\*/|("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''', re.S)
+_CSS_STRING = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+_CSS_SPACE_AROUND = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(css):
+    """
+    Strip comments and redundant whitespace from a stylesheet. Deliberately
+    conservative: whitespace next to ':' and inside calc() is left alone,
+    since it can be significant there.
+    """
+    # A comment still separates tokens, so it becomes a space rather than nothing
+    css = _CSS_COMMENT_OR_STRING.sub(lambda match: match.group(1) or ' ', css)
+    # split() keeps the captured strings at the odd indexes
+    parts = _CSS_STRING.split(css)
+    return ''.join(part if i % 2 else _squeeze_css(part) for i, part in enumerate(parts)).strip()
+
+
+def _squeeze_css(text):
+    text = re.sub(r'\s+', ' ', text)
+    text = _CSS_SPACE_AROUND.sub(r'\1', text)
+    return text.replace(';}', '}')
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = {}
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names[name] = hashed_name
+            yield name, hashed_name, processed
+
+        if dry_run:
+            return
+        for name, hashed_name in hashed_names.items():
+            if not hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            with self.open(hashed_name) as f:
+                content = f.read()
+            if hashed_name.endswith('.css'):
+                content = minify_css(content.decode()).encode()
+                self._replace(hashed_name, content)
+            self.write_compressed(hashed_name, content)
+
+    def write_compressed(self, name, content):
+        """Write .gz/.br variants of `name`, skipping any that would not be smaller."""
+        variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content, quality=11)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(content):
+                self._replace(name + suffix, compressed)
+
+    def _replace(self, name, content):
+        if self.exists(name):
+            self.delete(name)
+        self._save(name, ContentFile(content))
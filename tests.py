@@ -1,3 +1,1348 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, connection, connections
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    UserProfile, AffiliateLink, Transaction, Withdrawal, UserStats, ClickEvent, ClickRollup, Job, CommissionRule,
+    RollupCheckpoint, LedgerEntry, BalanceSnapshot,
+)
+from . import admin, analytics, clicks, exports, holds, jobs, ledger, routers, settlement, views
+from .clicks import click_buffer
+from .commissions import evaluate_many, rates_for, recompute_range, recompute_ranges, rule_cache
+from .conversion import backfill_short_codes, canonical_key, canonicalize_link, merge_duplicate_links
+from .middleware import registry as metrics_registry
+from .pagination import encode_cursor, paginate_keyset
+from .asgi_redirects import TrackingRedirectApp
+from .management.commands.benchmark import SCENARIOS
+from .redirect_cache import RedirectCache, redirect_cache, short_code_cache
+from .shortcodes import MAX_ATTEMPTS, generate_code
+from .stats import compute_site_stats, get_dashboard_stats, get_site_stats, rebuild_user_stats
+from .reports import import_report
+from .storage import minify_css
+
+
+class DashboardStatsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('shopper', password='secret-pass-123')
+        UserProfile.objects.create(user=cls.user, balance=Decimal('150.00'))
+        link = AffiliateLink.objects.create(user=cls.user, original_link='https://shopee.ph/item', converted_link='')
+        AffiliateLink.objects.create(user=cls.user, original_link='https://shopee.ph/other', converted_link='')
+        for status, commission in [('approved', '100.00'), ('approved', '40.00'), ('pending', '20.00'), ('rejected', '10.00')]:
+            Transaction.objects.create(
+                user=cls.user,
+                affiliate_link=link,
+                product_name='Item',
+                product_price=Decimal(commission) * 10,
+                estimated_commission=Decimal(commission),
+                status=status,
+            )
+        Withdrawal.objects.create(user=cls.user, amount=Decimal('100.00'), payment_method='gcash', payment_details='0917')
+
+    def test_counters(self):
+        stats = get_dashboard_stats(self.user)
+        self.assertEqual(stats.total_orders, 4)
+        self.assertEqual(stats.transaction_count, 2)
+        self.assertEqual(stats.pending_count, 1)
+        self.assertEqual(stats.total_cashback, Decimal('7.00'))
+        self.assertEqual(stats.link_count, 2)
+        self.assertEqual(stats.balance, Decimal('150.00'))
+
+    def test_counters_for_new_user(self):
+        user = User.objects.create_user('newcomer', password='secret-pass-123')
+        UserProfile.objects.create(user=user)
+        stats = get_dashboard_stats(user)
+        self.assertEqual((stats.total_orders, stats.link_count, stats.total_cashback), (0, 0, 0))
+
+    def test_dashboard_query_budget(self):
+        self.client.force_login(self.user)
+        # session + user, stats, recent transactions, pending withdrawals, top products
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_orders'], 4)
+
+    def test_cached_fragments_follow_user_and_counters(self):
+        cache.clear()
+        other = User.objects.create_user('other-shopper', password='secret-pass-123')
+        UserProfile.objects.create(user=other)
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(reverse('dashboard')), '<h6>shopper</h6>')
+
+        self.client.force_login(other)
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, '<h6>other-shopper</h6>')
+        self.assertNotContains(response, '<h6>shopper</h6>')
+        self.assertContains(response, '<h2 class="mb-3 fw-bold text-dark">0</h2>', count=3)
+
+        AffiliateLink.objects.create(user=other, original_link='https://shopee.ph/new', converted_link='')
+        self.assertContains(self.client.get(reverse('dashboard')), '<h2 class="mb-3 fw-bold text-dark">1</h2>')
+
+
+class StaticStorageTests(SimpleTestCase):
+    def test_minify_css_keeps_strings_and_calc(self):
+        css = "/* layout */\n.a > .b ,  .c:hover {\n    content: '  ; } ';\n    width: calc(100% - 8px) ;\n}\n"
+        self.assertEqual(minify_css(css), ".a>.b,.c:hover{content: '  ; } ';width: calc(100% - 8px)}")
+
+
+class ClickBufferTests(TestCase):
+    def test_flushes_when_full(self):
+        buffer = clicks.ClickBuffer(max_pending=3, flush_interval=60)
+        with mock.patch.object(clicks, 'write_clicks') as write:
+            buffer.record(1)
+            buffer.record(1)
+            write.assert_not_called()
+            buffer.record(2)
+        counts, events = write.call_args.args
+        self.assertEqual((counts, len(events), buffer.pending), ({1: 2, 2: 1}, 3, 0))
+
+    def test_timer_flushes_idle_buffer(self):
+        buffer = clicks.ClickBuffer(max_pending=100, flush_interval=0.05)
+        flushed = threading.Event()
+        with mock.patch.object(clicks, 'write_clicks', side_effect=lambda counts, events: flushed.set()):
+            buffer.record(1)
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(buffer.pending, 0)
+
+    def test_failed_flush_is_retried(self):
+        buffer = clicks.ClickBuffer(max_pending=100, flush_interval=60)
+        buffer.record(1)
+        buffer.record(1)
+        with mock.patch.object(clicks, 'write_clicks', side_effect=[DatabaseError('locked'), None]) as write:
+            with self.assertLogs(clicks.logger, 'ERROR'):
+                self.assertEqual(buffer.flush(), 0)
+            self.assertEqual(buffer.pending, 2)
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(write.call_args.args[0], {1: 2})
+
+        buffer.record(1)
+        with mock.patch.object(clicks, 'write_clicks', side_effect=DatabaseError('no such table')):
+            with self.assertLogs(clicks.logger, 'WARNING'):
+                self.assertEqual(buffer.flush(retry=False), 0)
+        self.assertEqual(buffer.pending, 0)
+
+
+def make_legacy(link, short_code=None):
+    """Make `link` one from before short codes: its ID-based URL stored, and no code unless backfilled."""
+    link.short_code = short_code
+    link.converted_link = 'http://testserver' + reverse('track_link_click', args=[link.pk])
+    AffiliateLink.objects.filter(pk=link.pk).update(short_code=short_code, converted_link=link.converted_link)
+    return link
+
+
+class RedirectCacheTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('redirected')
+        self.links = [
+            AffiliateLink.objects.create(user=user, original_link=f'https://shopee.ph/product/1/{i}') for i in range(3)
+        ]
+        for link in self.links:
+            make_legacy(link, short_code=link.short_code)
+        redirect_cache.clear()
+        short_code_cache.clear()
+
+    def test_least_recently_used_entry_is_evicted(self):
+        lru = RedirectCache(max_entries=2)
+        first, second, third = [link.pk for link in self.links]
+        lru.get(first)
+        lru.get(second)
+        lru.get(first)
+        lru.get(third)
+        with self.assertNumQueries(0):
+            lru.get(first)
+            lru.get(third)
+        with self.assertNumQueries(1):
+            self.assertEqual(lru.get(second), 'https://shopee.ph/product/1/1')
+        self.assertEqual(lru.stats()['evictions'], 2)
+
+    def test_entries_and_misses_expire(self):
+        lru = RedirectCache(ttl=300, negative_ttl=30)
+        link, missing = self.links[0], 10 ** 9
+        now = time.monotonic()
+        with mock.patch('time.monotonic', return_value=now) as clock:
+            lru.get(link.pk)
+            self.assertIsNone(lru.get(missing))
+            with self.assertNumQueries(0):
+                lru.get(link.pk)
+                lru.get(missing)
+            clock.return_value = now + 60
+            # The miss is looked up again (link, then alias); the link is still cached
+            with self.assertNumQueries(2):
+                self.assertIsNone(lru.get(missing))
+                self.assertEqual(lru.get(link.pk), link.original_link)
+            clock.return_value = now + 301
+            with self.assertNumQueries(1):
+                self.assertEqual(lru.get(link.pk), link.original_link)
+        self.assertEqual((lru.stats()['hits'], lru.stats()['negative_hits']), (2, 1))
+
+    def test_saving_or_deleting_a_link_invalidates_it(self):
+        link = self.links[0]
+        self.assertEqual(redirect_cache.get(link.pk), link.original_link)
+        self.assertEqual(short_code_cache.get(link.short_code), (link.pk, link.original_link))
+        link.original_link = 'https://shopee.ph/product/2/2'
+        link.save()
+        self.assertEqual(redirect_cache.get(link.pk), 'https://shopee.ph/product/2/2')
+        self.assertEqual(short_code_cache.get(link.short_code), (link.pk, 'https://shopee.ph/product/2/2'))
+        code, pk = link.short_code, link.pk
+        link.delete()
+        self.assertIsNone(redirect_cache.get(pk))
+        self.assertIsNone(short_code_cache.get(code))
+
+
+class TrackingRedirectAppTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('fastpath')
+        self.link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/3/3')
+        self.legacy = make_legacy(
+            AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/4/4')
+        )
+        redirect_cache.clear()
+        short_code_cache.clear()
+        self.passed = []
+
+        async def django_app(scope, receive, send):
+            self.passed.append(scope['path'])
+
+        self.app = TrackingRedirectApp(django_app)
+
+    def tearDown(self):
+        click_buffer.discard()
+
+    def call(self, path, host=b'testserver', scheme='http'):
+        scope = {
+            'type': 'http', 'method': 'GET', 'scheme': scheme, 'path': path, 'query_string': b'',
+            'headers': [(b'host', host), (b'user-agent', b'tests')], 'client': ('127.0.0.1', 50000),
+        }
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        async_to_sync(self.app)(scope, receive, send)
+        return sent[0] if sent else None
+
+    def test_tracking_urls_are_answered_on_the_fast_path(self):
+        for link, path in ((self.link, self.link.get_absolute_url()), (self.legacy, self.legacy.get_absolute_url())):
+            with mock.patch.object(click_buffer, 'record') as record:
+                start = self.call(path)
+            headers = dict(start['headers'])
+            self.assertEqual((start['status'], headers[b'location']), (302, link.original_link.encode()))
+            self.assertEqual(headers[b'x-frame-options'], b'DENY')
+            record.assert_called_once_with(link.pk, mock.ANY, background=True)
+        self.assertEqual(self.passed, [])
+
+    def test_other_requests_go_through_django(self):
+        with mock.patch('shoppelink.asgi_redirects.resolve') as resolve:
+            self.assertIsNone(self.call('/dashboard/'))
+        resolve.assert_not_called()
+        self.assertIsNone(self.call('/t/999999/'))
+        # New links are only reachable by their code
+        self.assertIsNone(self.call(f'/t/{self.link.pk}/'))
+        path = self.link.get_absolute_url()
+        self.assertIsNone(self.call(path, host=b'evil.example'))
+        with override_settings(SECURE_SSL_REDIRECT=True):
+            # The middleware reads its settings when the app is built
+            self.app = TrackingRedirectApp(self.app.application)
+            self.assertIsNone(self.call(path))
+        self.assertEqual(self.passed, ['/dashboard/', '/t/999999/', f'/t/{self.link.pk}/', path, path])
+
+
+class UserStatsTests(TestCase):
+    def test_stats_follow_transaction_lifecycle(self):
+        user = User.objects.create_user('tracker', password='secret-pass-123')
+        UserProfile.objects.create(user=user, balance=Decimal('500.00'))
+        link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/item', converted_link='')
+        first, second = [
+            Transaction.objects.create(user=user, affiliate_link=link, estimated_commission=Decimal(amount))
+            for amount in ('100.00', '200.00')
+        ]
+        first.status = 'approved'
+        first.save()
+        second.delete()
+        Withdrawal.objects.create(
+            user=user, amount=Decimal('100.00'), payment_method='gcash', payment_details='0917'
+        ).approve()
+
+        stats = UserStats.objects.get(user=user)
+        self.assertEqual(
+            (stats.total_orders, stats.approved_count, stats.pending_count, stats.link_count),
+            (1, 1, 0, 1),
+        )
+        self.assertEqual(stats.approved_cashback, Decimal('5.00'))
+        self.assertEqual(stats.total_withdrawn, Decimal('100.00'))
+
+        UserStats.objects.filter(user=user).update(total_orders=99)
+        rebuild_user_stats([user.pk])
+        self.assertEqual(UserStats.objects.get(user=user).total_orders, 1)
+
+
+class SettlementTests(TestCase):
+    def test_bulk_approval_credits_balances(self):
+        users = [User.objects.create_user(f'bulk{i}') for i in range(3)]
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+        Transaction.objects.bulk_create([
+            Transaction(user=users[i % 3], estimated_commission=Decimal('10.00'), cashback_amount=Decimal('0.50'))
+            for i in range(30)
+        ])
+        rebuild_user_stats()
+
+        # lock/read, status update, ledger insert, balance update, stats
+        # update, site stats update, plus savepoint/release for two atomic
+        # blocks
+        with self.assertNumQueries(10):
+            approved = settlement.approve_transactions(Transaction.objects.all())
+        self.assertEqual(approved, 30)
+        self.assertEqual(settlement.approve_transactions(Transaction.objects.all()), 0)
+        for user in users:
+            self.assertEqual(UserProfile.objects.get(user=user).balance, Decimal('5.00'))
+            self.assertEqual(UserStats.objects.get(user=user).approved_count, 10)
+            self.assertEqual(ledger.ledger_balance(user.pk), Decimal('5.00'))
+
+    def test_rows_settled_concurrently_are_credited_once(self):
+        user = User.objects.create_user('raced')
+        UserProfile.objects.create(user=user)
+        first, _ = [
+            Transaction.objects.create(user=user, estimated_commission=Decimal('10.00')) for _ in range(2)
+        ]
+        # Both rows were read as pending before another settlement approved the first
+        stale = list(Transaction.objects.order_by('pk').values_list('pk', 'user_id', 'cashback_amount'))
+        settlement.approve_transactions(Transaction.objects.filter(pk=first.pk))
+        with mock.patch.object(settlement, '_lock_pending', return_value=stale):
+            self.assertEqual(settlement.approve_transactions(Transaction.objects.all()), 1)
+
+        self.assertEqual(UserProfile.objects.get(user=user).balance, Decimal('1.00'))
+        self.assertEqual(ledger.ledger_balance(user.pk), Decimal('1.00'))
+        self.assertEqual(UserStats.objects.get(user=user).approved_count, 2)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('paged')
+        Transaction.objects.bulk_create([Transaction(user=user) for _ in range(8)])
+        # Five rows share one timestamp, so pages break inside the tie
+        now = timezone.now()
+        ids = list(Transaction.objects.order_by('pk').values_list('pk', flat=True))
+        Transaction.objects.filter(pk__in=ids[:5]).update(created_at=now - timedelta(hours=1))
+        for hours, pk in enumerate(ids[5:]):
+            Transaction.objects.filter(pk=pk).update(created_at=now + timedelta(hours=hours))
+        self.expected = list(Transaction.objects.order_by('-created_at', '-pk').values_list('pk', flat=True))
+
+    def test_cursors_walk_forwards_and_back(self):
+        pages = [paginate_keyset(Transaction.objects.all(), per_page=3)]
+        while pages[-1].has_next:
+            pages.append(paginate_keyset(Transaction.objects.all(), pages[-1].next_cursor, per_page=3))
+        self.assertEqual([txn.pk for page in pages for txn in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertFalse(pages[0].has_previous)
+
+        for i in range(len(pages) - 1, 0, -1):
+            previous = paginate_keyset(Transaction.objects.all(), pages[i].previous_cursor, per_page=3)
+            self.assertEqual([txn.pk for txn in previous], [txn.pk for txn in pages[i - 1]])
+            self.assertEqual(previous.has_previous, i > 1)
+            self.assertTrue(previous.has_next)
+
+    def test_tampered_cursor_shows_first_page(self):
+        first = [txn.pk for txn in paginate_keyset(Transaction.objects.all(), per_page=3)]
+        for cursor in ['not-a-cursor', 'bmV4dHxub3QtYS1kYXRlfDE', encode_cursor('next', timezone.now(), 'x')]:
+            page = paginate_keyset(Transaction.objects.all(), cursor, per_page=3)
+            self.assertEqual([txn.pk for txn in page], first)
+            self.assertFalse(page.has_previous)
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('booked', password='secret-pass-123')
+        UserProfile.objects.create(user=self.user)
+
+    def test_approval_and_deletion_are_booked(self):
+        txn = Transaction.objects.create(user=self.user, estimated_commission=Decimal('100.00'))
+        settlement.approve_transactions(Transaction.objects.filter(pk=txn.pk))
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('5.00'))
+
+        self.client.force_login(self.user)
+        self.client.post(reverse('delete_transaction', args=[txn.pk]))
+        self.assertFalse(Transaction.objects.filter(pk=txn.pk).exists())
+        self.assertEqual(
+            list(LedgerEntry.objects.order_by('pk').values_list('entry_type', 'amount', 'transaction_id')),
+            [('cashback', Decimal('5.00'), txn.pk), ('reversal', Decimal('-5.00'), txn.pk)],
+        )
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('0.00'))
+        self.assertEqual(ledger.ledger_balance(self.user.pk), Decimal('0.00'))
+
+    def test_deletion_reverses_the_status_at_delete_time(self):
+        txn = Transaction.objects.create(user=self.user, estimated_commission=Decimal('100.00'))
+        lookup = views.get_object_or_404
+
+        def approved_meanwhile(*args, **kwargs):
+            # The settlement job approves the row right after the view first reads it
+            found = lookup(*args, **kwargs)
+            settlement.approve_transactions(Transaction.objects.filter(pk=txn.pk))
+            return found
+
+        self.client.force_login(self.user)
+        with mock.patch.object(views, 'get_object_or_404', approved_meanwhile):
+            self.client.post(reverse('delete_transaction', args=[txn.pk]))
+        self.assertEqual(LedgerEntry.objects.filter(entry_type='reversal').get().amount, Decimal('-5.00'))
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('0.00'))
+
+    @override_settings(ROLLUP_LAG_SECONDS=0)
+    def test_balance_as_of_starts_from_snapshots(self):
+        now = timezone.now()
+        for amount, hours_ago in (('10.00', 3), ('20.00', 2)):
+            entry = ledger.post(self.user.pk, Decimal(amount), 'adjustment')
+            LedgerEntry.objects.filter(pk=entry.pk).update(created_at=now - timedelta(hours=hours_ago))
+        self.assertEqual(ledger.take_snapshots(), 1)
+        self.assertEqual(ledger.take_snapshots(), 0)
+        BalanceSnapshot.objects.update(taken_at=now - timedelta(minutes=90))
+        entry = ledger.post(self.user.pk, Decimal('-5.00'), 'adjustment')
+        LedgerEntry.objects.filter(pk=entry.pk).update(created_at=now - timedelta(hours=1))
+
+        self.assertEqual(ledger.balance_as_of(self.user.pk, now - timedelta(minutes=150)), Decimal('10.00'))
+        self.assertEqual(ledger.balance_as_of(self.user.pk, now - timedelta(minutes=80)), Decimal('30.00'))
+        # The snapshot, then the one entry after it
+        with self.assertNumQueries(2):
+            self.assertEqual(ledger.balance_as_of(self.user.pk, now), Decimal('25.00'))
+
+        self.assertEqual(ledger.take_snapshots(), 1)
+        self.assertEqual(BalanceSnapshot.objects.order_by('-pk').first().balance, Decimal('25.00'))
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('25.00'))
+
+
+    def test_snapshots_wait_for_late_commits(self):
+        def post(entry_id, amount):
+            ledger.post_many([
+                LedgerEntry(id=entry_id, user=self.user, amount=Decimal(amount), entry_type='adjustment'),
+            ])
+
+        post(20, '20.00')
+        self.assertEqual(ledger.take_snapshots(), 0)  # too new
+        age_rollup_horizons()
+        post(30, '30.00')
+        self.assertEqual(ledger.take_snapshots(), 1)
+        self.assertEqual(BalanceSnapshot.objects.get().last_entry_id, 20)
+        # Commits below the newest id after the snapshot was taken
+        post(25, '25.00')
+        age_rollup_horizons()
+        self.assertEqual(ledger.take_snapshots(), 1)
+
+        self.assertEqual(BalanceSnapshot.objects.order_by('-pk').first().balance, Decimal('75.00'))
+        self.assertEqual(ledger.balance_as_of(self.user.pk, timezone.now()), Decimal('75.00'))
+
+
+class WithdrawalHoldTests(TestCase):
+    def test_holds_follow_withdrawal_lifecycle(self):
+        user = User.objects.create_user('holder')
+        UserProfile.objects.create(user=user, balance=Decimal('300.00'))
+        first, created = holds.request_withdrawal(user, Decimal('150.00'), 'gcash', '0917', idempotency_key='a')
+        self.assertTrue(created)
+        self.assertEqual(holds.request_withdrawal(user, Decimal('150.00'), 'gcash', '0917', idempotency_key='a'),
+                         (first, False))
+        second, _ = holds.request_withdrawal(user, Decimal('150.00'), 'gcash', '0917', idempotency_key='b')
+        with self.assertRaises(holds.InsufficientBalance):
+            holds.request_withdrawal(user, Decimal('100.00'), 'gcash', '0917', idempotency_key='c')
+        self.assertEqual(UserProfile.objects.get(user=user).held, Decimal('300.00'))
+
+        second.reject()
+        first.approve()
+        first.approve()
+        profile = UserProfile.objects.get(user=user)
+        self.assertEqual((profile.balance, profile.held), (Decimal('150.00'), Decimal('0.00')))
+        self.assertEqual(ledger.ledger_balance(user.pk), Decimal('-150.00'))
+        self.assertEqual(holds.reconcile_holds(), 0)
+
+
+    def test_withdrawals_page_offers_only_the_available_balance(self):
+        user = User.objects.create_user('held', password='secret-pass-123')
+        UserProfile.objects.create(user=user, balance=Decimal('150.00'))
+        holds.request_withdrawal(user, Decimal('100.00'), 'gcash', '0917')
+        self.client.force_login(user)
+        response = self.client.get(reverse('withdrawals'))
+        self.assertEqual(response.context['available_balance'], Decimal('50.00'))
+        self.assertContains(response, 'Need ₱100 to withdraw')
+        self.assertNotContains(response, reverse('request_withdrawal'))
+
+    def test_admin_change_form_moves_and_settles_the_hold(self):
+        get_site_stats()
+        user = User.objects.create_user('edited')
+        UserProfile.objects.create(user=user, balance=Decimal('300.00'))
+        withdrawal, _ = holds.request_withdrawal(user, Decimal('150.00'), 'gcash', '0917')
+        self.client.force_login(User.objects.create_superuser('boss'))
+        url = reverse('admin:shoppelink_withdrawal_change', args=[withdrawal.pk])
+        form = {'amount': '120.00', 'payment_method': 'gcash', 'payment_details': '0917', 'status': 'pending'}
+
+        self.client.post(url, form)
+        self.assertEqual(UserProfile.objects.get(user=user).held, Decimal('120.00'))
+        self.assertEqual(get_site_stats()['pending_withdrawal_amount'], Decimal('120.00'))
+        self.client.post(url, {**form, 'status': 'approved'})
+        profile = UserProfile.objects.get(user=user)
+        self.assertEqual((profile.balance, profile.held), (Decimal('180.00'), Decimal('0.00')))
+        self.assertEqual(ledger.ledger_balance(user.pk), Decimal('-120.00'))
+        self.assertEqual(get_site_stats()['pending_withdrawal_amount'], Decimal('0.00'))
+
+
+class WithdrawalConcurrencyTests(TransactionTestCase):
+    def test_parallel_requests_never_overdraw(self):
+        user = User.objects.create_user('racer', password='secret-pass-123')
+        UserProfile.objects.create(user=user, balance=Decimal('500.00'))
+        url = reverse('request_withdrawal')
+        statuses = []
+
+        def submit(key):
+            client = Client()
+            client.force_login(user)
+            try:
+                for _ in range(3):  # a double (triple) submit of the same form
+                    response = client.post(url, {
+                        'amount': '100.00', 'payment_method': 'gcash', 'payment_details': '0917',
+                        'idempotency_key': key,
+                    })
+                    statuses.append(response.status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=submit, args=(f'form-{i}',)) for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(statuses), 36)
+        self.assertEqual(Withdrawal.objects.filter(user=user).count(), 5)
+        self.assertEqual(UserProfile.objects.get(user=user).held, Decimal('500.00'))
+        self.assertEqual(holds.reconcile_holds(), 0)
+
+
+class SiteStatsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_counters_follow_writes(self):
+        get_site_stats()  # builds the shards
+        user = User.objects.create_user('sitewide')
+        UserProfile.objects.create(user=user, balance=Decimal('500.00'))
+        link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/1/2')
+        transactions = [
+            Transaction.objects.create(user=user, affiliate_link=link, estimated_commission=Decimal('20.00'))
+            for _ in range(3)
+        ]
+        settlement.approve_transactions(Transaction.objects.filter(pk__in=[txn.pk for txn in transactions[:2]]))
+        for amount in ('100.00', '150.00'):
+            Withdrawal.objects.create(user=user, amount=Decimal(amount), payment_method='gcash', payment_details='0917')
+        settlement.approve_withdrawals(Withdrawal.objects.filter(amount=Decimal('100.00')))
+        AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/3/4').delete()
+
+        totals = get_site_stats()
+        self.assertEqual(totals, compute_site_stats())
+        self.assertEqual((totals['user_count'], totals['approved_count'], totals['pending_withdrawal_count']), (1, 2, 1))
+
+    def test_seeded_data_is_counted(self):
+        get_site_stats()
+        call_command('seed_data', users=3, links_per_user=2, transactions_per_user=5, withdrawals_per_user=2,
+                     clicks=10, stdout=io.StringIO())
+        self.assertEqual(get_site_stats(), compute_site_stats())
+        self.assertEqual(get_site_stats()['user_count'], 3)
+
+    def test_admin_dashboard_is_served_from_snapshot(self):
+        staff = User.objects.create_user('staff', password='secret-pass-123', is_staff=True)
+        Withdrawal.objects.bulk_create([
+            Withdrawal(user=staff, amount=Decimal('100.00'), payment_method='gcash', payment_details=str(i))
+            for i in range(settings.ADMIN_PENDING_WITHDRAWALS_PER_PAGE + 5)
+        ])
+        self.client.force_login(staff)
+        url = reverse('admin_dashboard')
+        self.client.get(url)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        tables = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('shoppelink_transaction', tables)
+        self.assertNotIn('shoppelink_sitestats', tables)
+        self.assertEqual(len(response.context['pending_withdrawals']), settings.ADMIN_PENDING_WITHDRAWALS_PER_PAGE)
+        self.assertTrue(response.context['pending_withdrawals'].has_next)
+
+
+class CommissionRuleTests(TestCase):
+    def setUp(self):
+        # Rules rolled back with the test do not send post_delete
+        self.addCleanup(rule_cache.invalidate)
+
+    def test_most_specific_rule_applies(self):
+        now = timezone.now()
+        self.assertEqual(rates_for('123').commission_rate, Decimal('0.10'))  # settings default
+        CommissionRule.objects.create(name='All', commission_rate=Decimal('0.08'), cashback_rate=Decimal('0.05'))
+        CommissionRule.objects.create(name='Shop', shop_id='123', commission_rate=Decimal('0.12'),
+                                      cashback_rate=Decimal('0.10'))
+        sale = CommissionRule.objects.create(
+            name='Sale', shop_id='123', category='Phones', commission_rate=Decimal('0.20'),
+            cashback_rate=Decimal('0.25'), starts_at=now - timedelta(days=1), ends_at=now + timedelta(days=1),
+        )
+        CommissionRule.objects.create(
+            name='Flash sale', shop_id='123', category='Phones', commission_rate=Decimal('0.30'),
+            cashback_rate=Decimal('0.30'), starts_at=now, ends_at=now + timedelta(hours=1), priority=1,
+        )
+
+        self.assertEqual(rates_for('999', 'Phones').commission_rate, Decimal('0.08'))
+        self.assertEqual(rates_for('123', 'Books').commission_rate, Decimal('0.12'))
+        self.assertEqual(rates_for('123', 'Phones', now - timedelta(hours=1)).rule_id, sale.pk)
+        self.assertEqual(rates_for('123', 'Phones', now + timedelta(minutes=30)).commission_rate, Decimal('0.30'))
+        self.assertEqual(rates_for('123', 'Phones', now + timedelta(hours=2)).rule_id, sale.pk)
+        self.assertEqual(rates_for('123', 'Phones', now + timedelta(days=2)).commission_rate, Decimal('0.12'))
+
+        sale.is_active = False
+        sale.save()
+        self.assertEqual(rates_for('123', 'Phones', now - timedelta(hours=1)).commission_rate, Decimal('0.12'))
+
+    def test_batch_evaluation_does_not_query(self):
+        CommissionRule.objects.create(name='Shop', shop_id='7', commission_rate=Decimal('0.12'),
+                                      cashback_rate=Decimal('0.10'))
+        rates_for()
+        rows = [(Decimal('100.00'), str(i % 10), '', None) for i in range(1000)]
+        with self.assertNumQueries(0):
+            priced = evaluate_many(rows)
+        self.assertEqual(priced[7], (Decimal('12.00'), Decimal('1.20')))
+        self.assertEqual(priced[8], (Decimal('10.00'), Decimal('0.50')))
+
+        user = User.objects.create_user('ruled')
+        txn = Transaction.objects.create(user=user, shop_id='7', estimated_commission=Decimal('30.00'))
+        self.assertEqual(txn.cashback_amount, Decimal('3.00'))
+
+
+class CommissionRecomputeTests(TestCase):
+    def setUp(self):
+        self.addCleanup(rule_cache.invalidate)
+
+    def test_pending_transactions_are_repriced_by_range(self):
+        user = User.objects.create_user('repriced')
+        link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/7/100')
+        Transaction.objects.bulk_create([
+            Transaction(user=user, affiliate_link=link, product_price=Decimal('100.00'),
+                        estimated_commission=Decimal('10.00'), cashback_amount=Decimal('0.50'),
+                        status='approved' if i % 5 == 0 else 'pending')
+            for i in range(20)
+        ])
+        CommissionRule.objects.create(name='Shop', shop_id='7', commission_rate=Decimal('0.12'),
+                                      cashback_rate=Decimal('0.10'))
+
+        ranges = recompute_ranges('test', parts=3)
+        self.assertEqual(len(ranges), 3)
+        name, _, last = ranges[0]
+        examined, updated = recompute_range(name, last, batch_size=2)
+        self.assertEqual(examined, updated)
+        # The other ranges, as the child processes run them; an existing run keeps its ranges
+        for name, _, _ in recompute_ranges('test', parts=5)[1:]:
+            call_command('recompute_commissions', run='test', range_name=name, stdout=io.StringIO())
+
+        self.assertEqual(
+            set(Transaction.objects.values_list('status', 'shop_id', 'estimated_commission', 'cashback_amount')),
+            {('pending', '7', Decimal('12.00'), Decimal('1.20')), ('approved', '', Decimal('10.00'), Decimal('0.50'))},
+        )
+        self.assertEqual(sum(recompute_range(name, last)[0] for name, _, last in ranges), 0)
+
+    def test_finished_run_starts_over_when_the_rules_change(self):
+        user = User.objects.create_user('repriced')
+        txn = Transaction.objects.create(user=user, shop_id='7', product_price=Decimal('100.00'),
+                                         estimated_commission=Decimal('10.00'), cashback_amount=Decimal('0.50'))
+        rule = CommissionRule.objects.create(name='Shop', shop_id='7', commission_rate=Decimal('0.12'),
+                                             cashback_rate=Decimal('0.10'))
+        call_command('recompute_commissions', stdout=io.StringIO())
+        txn.refresh_from_db()
+        self.assertEqual((txn.estimated_commission, txn.cashback_amount), (Decimal('12.00'), Decimal('1.20')))
+
+        out = io.StringIO()
+        call_command('recompute_commissions', stdout=out)
+        self.assertIn('examined 0', out.getvalue())
+
+        rule.commission_rate, rule.cashback_rate = Decimal('0.20'), Decimal('0.50')
+        rule.save()
+        call_command('recompute_commissions', stdout=io.StringIO())
+        txn.refresh_from_db()
+        self.assertEqual((txn.estimated_commission, txn.cashback_amount), (Decimal('20.00'), Decimal('10.00')))
+
+    def test_imported_conversions_keep_the_reported_commission(self):
+        user = User.objects.create_user('imported')
+        imported, estimated = Transaction.objects.bulk_create([
+            Transaction(user=user, shop_id='7', external_id='SP1', product_price=Decimal('0.00'),
+                        estimated_commission=Decimal('25.00'), cashback_amount=Decimal('1.25')),
+            Transaction(user=user, shop_id='7', product_price=Decimal('100.00'),
+                        estimated_commission=Decimal('10.00'), cashback_amount=Decimal('0.50')),
+        ])
+        CommissionRule.objects.create(name='Shop', shop_id='7', commission_rate=Decimal('0.12'),
+                                      cashback_rate=Decimal('0.10'))
+
+        (name, _, last), = recompute_ranges('imported')
+        self.assertEqual(recompute_range(name, last), (2, 2))
+        imported.refresh_from_db()
+        estimated.refresh_from_db()
+        self.assertEqual((imported.estimated_commission, imported.cashback_amount), (Decimal('25.00'), Decimal('2.50')))
+        self.assertEqual((estimated.estimated_commission, estimated.cashback_amount), (Decimal('12.00'), Decimal('1.20')))
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SLOW_REQUEST_MS=0, PROFILING_METRICS_TOKEN='scrape-token')
+class ProfilingTests(TestCase):
+    def setUp(self):
+        metrics_registry.reset()
+        self.addCleanup(metrics_registry.reset)
+        self.user = User.objects.create_user('profiled', password='secret-pass-123')
+        UserProfile.objects.create(user=self.user)
+
+    def test_requests_are_profiled(self):
+        self.client.force_login(self.user)
+        with self.assertLogs('shoppelink.profiling', 'WARNING') as logs:
+            self.client.get(reverse('dashboard'))
+        metrics = metrics_registry.snapshot()['dashboard']
+        self.assertEqual(metrics.latency.count, 1)
+        self.assertGreater(metrics.queries.total, 0)
+        self.assertGreater(metrics.template_ms, 0)
+        self.assertIn('Slow request GET /', logs.output[0])
+
+    @override_settings(PROFILING_SLOW_REQUEST_MS=60000)
+    def test_metrics_need_staff_or_token(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong-token').status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('shoppelink_click_buffer_pending 0', response.content.decode())
+
+        self.client.force_login(User.objects.create_user('watcher', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.settings(PROFILING_METRICS_TOKEN=''):
+            self.client.logout()
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+class BulkConversionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('converter', password='secret-pass-123')
+        self.client.force_login(self.user)
+
+    def convert(self, links):
+        return self.client.post(reverse('bulk_link_converter'), {'links': links}, content_type='application/json')
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        # 120 links still fit in one INSERT under SQLite's 999-parameter limit
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.convert([f'https://shopee.ph/product/1/{i}' for i in range(3)]).status_code, 201)
+        with CaptureQueriesContext(connection) as large:
+            response = self.convert([f'https://shopee.ph/product/2/{i}' for i in range(120)])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(large), len(small))
+
+        links = response.json()['links']
+        self.assertEqual(len(links), 120)
+        self.assertNotIn('id', links[0])
+        link = AffiliateLink.objects.get(short_code=links[0]['short_code'])
+        self.assertEqual(link.original_link, 'https://shopee.ph/product/2/0')
+        self.assertTrue(links[0]['converted_link'].endswith(reverse('track_short_link', args=[link.short_code])))
+        self.assertEqual(UserStats.objects.get(user=self.user).link_count, 123)
+
+    def test_invalid_links_reject_the_batch(self):
+        response = self.convert(['https://shopee.ph/product/1/1', 'https://example.com/x', 'not a url'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.json()['errors']), 2)
+        self.assertFalse(AffiliateLink.objects.exists())
+
+    def test_form_normalizes_and_deduplicates(self):
+        response = self.client.post(reverse('bulk_link_converter'), {
+            'links': '  shopee.ph/product/1/1\n\nhttps://shopee.ph/product/1/1\nhttps://shopee.com.ph/product/1/2\n',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [link.original_link for link in response.context['links']],
+            ['https://shopee.ph/product/1/1', 'https://shopee.com.ph/product/1/2'],
+        )
+
+
+class BenchmarkCommandTests(TestCase):
+    def tearDown(self):
+        click_buffer.discard()
+
+    def test_every_scenario_measures_a_working_page(self):
+        user = User.objects.create_user('busy')
+        UserProfile.objects.create(user=user)
+        link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/item-1')
+        Transaction.objects.create(user=user, affiliate_link=link, estimated_commission=Decimal('10.00'),
+                                   cashback_amount=Decimal('0.50'))
+        rebuild_user_stats()
+        out = io.StringIO()
+        call_command('benchmark', requests=2, approve_batch=1, stdout=out, stderr=io.StringIO())
+        scenarios = json.loads(out.getvalue())['scenarios']
+        self.assertEqual(set(scenarios), set(SCENARIOS))
+        self.assertEqual(scenarios['track_link_click']['status_codes'], {'302': 2})
+
+    def test_broken_scenario_fails(self):
+        user = User.objects.create_user('busy')
+        UserProfile.objects.create(user=user)
+        link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/item-1')
+        # Neither a code nor a stored ID-based URL: the link has no working tracking URL
+        AffiliateLink.objects.filter(pk=link.pk).update(short_code=None)
+        with self.assertRaisesMessage(CommandError, "track_link_click answered 404"):
+            call_command('benchmark', requests=2, scenario=['track_link_click'], stdout=io.StringIO(),
+                         stderr=io.StringIO())
+
+
+class JobQueueTests(TestCase):
+    def test_enqueued_approval_runs_once(self):
+        user = User.objects.create_user('queued')
+        UserProfile.objects.create(user=user)
+        Transaction.objects.bulk_create([
+            Transaction(user=user, estimated_commission=Decimal('10.00'), cashback_amount=Decimal('0.50'))
+            for _ in range(4)
+        ])
+        rebuild_user_stats()
+        ids = list(Transaction.objects.values_list('id', flat=True))
+        job = jobs.enqueue('approve_transactions', {'ids': ids}, idempotency_key='approve-batch-1')
+        self.assertEqual(jobs.enqueue('approve_transactions', {'ids': ids}, idempotency_key='approve-batch-1'), job)
+
+        self.assertEqual(jobs.work('test-worker', burst=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.result), ('succeeded', 1, {'approved': 4}))
+        self.assertEqual(UserProfile.objects.get(user=user).balance, Decimal('2.00'))
+
+    @skipUnless(connection.vendor == 'sqlite', "Lowers SQLite's limit on query parameters")
+    def test_selection_larger_than_the_query_parameter_limit(self):
+        connection.ensure_connection()
+        limit = connection.features.max_query_params
+        old_limit = connection.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+        self.addCleanup(connection.connection.setlimit, sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, old_limit)
+        user = User.objects.create_user('bulk')
+        UserProfile.objects.create(user=user)
+        Transaction.objects.bulk_create([
+            Transaction(user=user, estimated_commission=Decimal('1.00'), cashback_amount=Decimal('0.01'))
+            for _ in range(limit * 2 + 1)
+        ])
+        rebuild_user_stats()
+        ids = list(Transaction.objects.values_list('id', flat=True))
+        job = jobs.enqueue('approve_transactions', {'ids': ids})
+
+        self.assertEqual(jobs.work('test-worker', burst=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result), ('succeeded', {'approved': len(ids)}))
+        self.assertEqual(UserProfile.objects.get(user=user).balance, Decimal('0.01') * len(ids))
+
+    def test_failing_job_is_retried_then_failed(self):
+        job = jobs.enqueue('approve_transactions', {'unexpected': True}, max_attempts=2)
+        with self.assertLogs('shoppelink.jobs', 'ERROR'):
+            self.assertEqual(jobs.work('test-worker', burst=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn('TypeError', job.last_error)
+
+        Job.objects.filter(pk=job.pk).update(run_at=job.created_at)
+        with self.assertLogs('shoppelink.jobs', 'ERROR') as logs:
+            jobs.work('test-worker', burst=True)
+        self.assertIn('failed (attempt 2 of 2)', logs.output[0])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_outcome_of_a_run_requeued_as_stale_is_kept(self):
+        job = jobs.enqueue('rebuild_user_stats', {'user_ids': []})
+        claimed = jobs.claim_job('slow-worker')
+        self.assertEqual(jobs.requeue_stale_jobs(timeout=-1), 1)
+        self.assertTrue(jobs.run_job(claimed))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by), ('succeeded', 'slow-worker'))
+        self.assertIsNone(jobs.claim_job('other-worker'))
+
+        jobs.enqueue('rebuild_user_stats', {'user_ids': []})
+        claimed = jobs.claim_job('slow-worker')
+        jobs.requeue_stale_jobs(timeout=-1)
+        jobs.claim_job('other-worker')
+        with self.assertLogs('shoppelink.jobs', 'WARNING'):
+            jobs.run_job(claimed)
+        self.assertEqual(Job.objects.get(pk=claimed.pk).locked_by, 'other-worker')
+
+    def test_admin_actions_dedupe_only_double_submits(self):
+        with mock.patch('time.time', return_value=1000.0) as clock:
+            key = admin.selection_key('approve_transactions', [1, 2])
+            clock.return_value += 5
+            self.assertEqual(admin.selection_key('approve_transactions', [1, 2]), key)
+            self.assertNotEqual(admin.selection_key('approve_transactions', [1, 3]), key)
+            clock.return_value += admin.DOUBLE_SUBMIT_WINDOW
+            self.assertNotEqual(admin.selection_key('approve_transactions', [1, 2]), key)
+
+
+class DatabaseRoutingTests(TestCase):
+    def test_writes_and_migrations_stay_on_primary(self):
+        router = routers.ReadReplicaRouter()
+        with routers.replica_reads():
+            self.assertEqual(router.db_for_write(Transaction), 'default')
+        self.assertFalse(router.allow_migrate(routers.READ_REPLICA_ALIAS, 'shoppelink'))
+
+    def test_post_pins_reads_to_primary(self):
+        seen = []
+        middleware = routers.PrimaryStickinessMiddleware(lambda request: seen.append(routers._pinned.get()) or HttpResponse())
+        middleware(RequestFactory().post('/convert/'))
+        middleware(RequestFactory().get('/dashboard/'))
+        self.assertEqual(seen, [True, False])
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLite-specific connection settings")
+    def test_sqlite_connections_wait_for_locks(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_BUSY_TIMEOUT_MS)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('finance', password='secret-pass-123', is_staff=True, is_superuser=True)
+        Transaction.objects.bulk_create([
+            Transaction(user=cls.user, product_name=f'Item {i}', estimated_commission=Decimal('10.00'),
+                        status='approved' if i % 2 else 'pending')
+            for i in range(5)
+        ])
+
+    def test_admin_action_streams_selection(self):
+        self.client.force_login(self.user)
+        ids = list(Transaction.objects.filter(status='approved').values_list('id', flat=True))
+        response = self.client.post(reverse('admin:shoppelink_transaction_changelist'), {
+            'action': 'export_csv', '_selected_action': ids,
+        })
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'user_id', 'user__username'])
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]], ids)
+
+    def test_interrupted_export_resumes_after_last_row(self):
+        queryset = exports.filtered_queryset('transactions')
+        full = ''.join(exports.stream_export('transactions', queryset, 'ndjson'))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.ndjson')
+            with open(path, 'w') as f:
+                f.write(full[:full.index('\n', full.index('\n') + 1) + 5])
+            after = exports.last_exported_id(path, 'ndjson')
+            with open(path, 'a') as f:
+                f.writelines(exports.stream_export('transactions', queryset, 'ndjson', after=after))
+            with open(path) as f:
+                self.assertEqual(f.read(), full)
+
+    def test_csv_resume_with_line_breaks_in_fields(self):
+        for transaction in Transaction.objects.all():
+            transaction.product_name = f'Item {transaction.pk}\nsize "L"\n,{transaction.pk + 1},x'
+            transaction.save(update_fields=['product_name'])
+        queryset = exports.filtered_queryset('transactions')
+        full = ''.join(exports.stream_export('transactions', queryset, 'csv'))
+        second_row = full.index(f'\r\n{Transaction.objects.order_by("pk")[1].pk},') + 2
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv')
+            first_id = Transaction.objects.order_by('pk')[0].pk
+            # Cut inside the quoted field, right after a line break in it, and at a row boundary
+            cuts = [
+                (second_row + 30, {}),
+                (full.index('\n', second_row) + 1, {}),
+                (second_row, {}),
+                (second_row + 30, {'after': first_id}),
+            ]
+            for cut, options in cuts:
+                with open(path, 'w', newline='') as f:
+                    f.write(full[:cut])
+                call_command('export_records', 'transactions', output=path, resume=True, stdout=io.StringIO(), **options)
+                with open(path, newline='') as f:
+                    self.assertEqual(f.read(), full)
+
+
+class ReportImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reported')
+        UserProfile.objects.create(user=cls.user)
+        cls.link = AffiliateLink.objects.create(user=cls.user, original_link='https://shopee.ph/product/1/2')
+        cls.submitted = Transaction.objects.create(
+            user=cls.user, affiliate_link=cls.link, product_name='Typed by hand', estimated_commission=Decimal('1.00'),
+        )
+
+    def report(self):
+        return io.StringIO(
+            "Order ID,Sub ID,Item Name,Price,Commission,Status\n"
+            f"SP1,{self.link.short_code},Phone case,200.00,20.00,completed\n"
+            f"SP2,{self.link.pk},Charger,100.00,10.00,cancelled\n"
+            "SP3,nosuchcode,Cable,50.00,5.00,completed\n"
+            f"SP4,{self.link.short_code},Strap,n/a,5.00,pending\n"
+        )
+
+    def test_report_matches_and_settles_conversions(self):
+        mismatches = []
+        outcomes = import_report(self.report(), mismatch=lambda *row: mismatches.append(row))
+        self.assertEqual((outcomes['matched'], outcomes['created'], outcomes['approved'], outcomes['rejected']),
+                         (1, 1, 1, 1))
+        self.assertEqual(sorted((row[1], row[3]) for row in mismatches), [('SP3', 'unknown sub-ID'), ('SP4', 'invalid amount')])
+
+        self.submitted.refresh_from_db()
+        self.assertEqual((self.submitted.external_id, self.submitted.status), ('SP1', 'approved'))
+        self.assertEqual(self.submitted.cashback_amount, Decimal('1.00'))
+        self.assertEqual(Transaction.objects.get(external_id='SP2').status, 'rejected')
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('1.00'))
+        stats = UserStats.objects.get(user=self.user)
+        self.assertEqual((stats.total_orders, stats.approved_count, stats.pending_count), (2, 1, 0))
+
+        # Importing the same report again changes nothing
+        self.assertEqual(import_report(self.report())['unchanged'], 2)
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('1.00'))
+
+    def test_report_without_product_details_keeps_the_submitted_ones(self):
+        Transaction.objects.filter(pk=self.submitted.pk).update(product_price=Decimal('150.00'))
+        import_report(io.StringIO(
+            "Order ID,Sub ID,Item Name,Price,Commission,Status\n"
+            f"SP1,{self.link.short_code},,0,15.00,pending\n"
+        ))
+        self.submitted.refresh_from_db()
+        self.assertEqual(self.submitted.external_id, 'SP1')
+        self.assertEqual(
+            (self.submitted.product_name, self.submitted.product_price, self.submitted.estimated_commission),
+            ('Typed by hand', Decimal('150.00'), Decimal('15.00')),
+        )
+
+    def test_dry_run_writes_nothing(self):
+        outcomes = import_report(self.report(), dry_run=True)
+        self.assertEqual(outcomes['approved'], 1)
+        self.assertFalse(Transaction.objects.exclude(external_id=None).exists())
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('0.00'))
+
+    def test_undecodable_rows_are_reported_and_skipped(self):
+        code = self.link.short_code
+        reports = {
+            'ndjson': (
+                f'{{"order_id": "SP5", "sub_id": "{code}", "commission": "4.00", "status": "pending"}}\n'
+                '{"order_id": "SP6", "sub_id": \n'
+                f'{{"order_id": "SP7", "sub_id": "{code}", "commission": "4.00", "status": "pending"}}\n'
+            ),
+            'csv': (
+                "Order ID,Sub ID,Item Name,Commission,Status\n"
+                f"SP8,{code},{'x' * (csv.field_size_limit() + 1)},4.00,pending\n"
+                f"SP9,{code},Strap,4.00,pending\n"
+            ),
+        }
+        for (fmt, text), imported in zip(reports.items(), ['SP7', 'SP9']):
+            with self.subTest(fmt):
+                mismatches = []
+                outcomes = import_report(io.StringIO(text), mismatch=lambda *row: mismatches.append(row))
+                self.assertEqual((outcomes['rows'], outcomes['mismatched']), (3, 1) if fmt == 'ndjson' else (2, 1))
+                self.assertEqual(mismatches[0][0], 2)
+                self.assertTrue(Transaction.objects.filter(external_id=imported).exists())
+
+
+def age_rollup_horizons():
+    """Make the ids noted by analytics.rollup_limit old enough to be rolled up."""
+    RollupCheckpoint.objects.filter(name__endswith=':horizon').update(updated_at=timezone.now() - timedelta(hours=1))
+
+
+class ClickRollupTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('clicked')
+        self.link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/1/2')
+
+    def test_rollup_waits_for_late_commits(self):
+        ClickEvent.objects.create(id=10, link=self.link)
+        self.assertEqual(clicks.rollup_clicks(), 0)  # too new
+        age_rollup_horizons()
+        ClickEvent.objects.create(id=20, link=self.link)
+        self.assertEqual(clicks.rollup_clicks(), 1)
+        # Committed after id 20 was inserted, but 20 has not been rolled up yet
+        ClickEvent.objects.create(id=15, link=self.link)
+        self.assertEqual(clicks.rollup_clicks(), 0)
+        age_rollup_horizons()
+        self.assertEqual(clicks.rollup_clicks(), 2)
+
+        self.assertEqual(RollupCheckpoint.objects.get(name='clicks').position, 20)
+        for period in ('hour', 'day'):
+            self.assertEqual(ClickRollup.objects.get(period=period, link=self.link).clicks, 3)
+            self.assertEqual(ClickRollup.objects.get(period=period, link=None, user=self.link.user).clicks, 3)
+
+    @override_settings(ROLLUP_LAG_SECONDS=0)
+    def test_prune_keeps_recent_and_pending_events(self):
+        old = timezone.now() - timedelta(days=40)
+        ClickEvent.objects.bulk_create([ClickEvent(link=self.link, clicked_at=old) for _ in range(2)])
+        ClickEvent.objects.create(link=self.link)
+        clicks.rollup_clicks()
+        late = ClickEvent.objects.create(link=self.link, clicked_at=old)  # not rolled up yet
+
+        self.assertEqual(clicks.prune_click_events(retention_days=30), 2)
+        self.assertEqual(ClickEvent.objects.count(), 2)
+        self.assertTrue(ClickEvent.objects.filter(pk=late.pk).exists())
+
+
+@override_settings(ROLLUP_LAG_SECONDS=0)
+class EarningsAnalyticsTests(TestCase):
+    @override_settings(ROLLUP_LAG_SECONDS=60)
+    def test_late_transactions_are_not_skipped(self):
+        user = User.objects.create_user('late')
+        UserProfile.objects.create(user=user)
+        Transaction.objects.create(id=20, user=user, estimated_commission=Decimal('20.00'))
+        analytics.rollup_earnings()
+        age_rollup_horizons()
+        # Commits after id 20 was noted, while the horizon was ageing
+        Transaction.objects.create(id=15, user=user, estimated_commission=Decimal('15.00'))
+        analytics.rollup_earnings()
+        age_rollup_horizons()
+        analytics.rollup_earnings()
+
+        today = timezone.localdate()
+        series = analytics.earnings_series('day', today, today, user=user)
+        self.assertEqual((series['orders'], series['commission']), ([2], [35.0]))
+
+    def test_series_follow_new_rows_incrementally(self):
+        user = User.objects.create_user('charted', password='secret-pass-123')
+        UserProfile.objects.create(user=user)
+        link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/1/2')
+        today = timezone.localdate()
+        yesterday = timezone.now() - timedelta(days=1)
+        for commission in ('10.00', '30.00'):
+            Transaction.objects.create(user=user, affiliate_link=link, estimated_commission=Decimal(commission))
+        Transaction.objects.filter(estimated_commission=Decimal('10.00')).update(created_at=yesterday)
+        settlement.approve_transactions(Transaction.objects.all())
+        ClickEvent.objects.bulk_create([ClickEvent(link=link, clicked_at=yesterday) for _ in range(3)])
+        clicks.rollup_clicks()
+
+        # Clicks rolled up before the first run are seeded from the daily click rollups
+        self.assertEqual(analytics.rollup_earnings(), 4)
+        ClickEvent.objects.create(link=link)
+        clicks.rollup_clicks()
+        self.assertEqual(analytics.rollup_earnings(), 0)
+
+        with self.assertNumQueries(1):
+            series = analytics.earnings_series('day', today - timedelta(days=1), today, link=link)
+        self.assertEqual(series['labels'], [(today - timedelta(days=1)).isoformat(), today.isoformat()])
+        self.assertEqual(series['orders'], [1, 1])
+        self.assertEqual(series['commission'], [10.0, 30.0])
+        self.assertEqual(series['cashback'], [0.0, 2.0])  # credited today
+        self.assertEqual(series['clicks'], [3, 1])
+
+        Transaction.objects.create(user=user, affiliate_link=link, estimated_commission=Decimal('5.00'))
+        self.assertEqual(analytics.rollup_earnings(), 1)
+        self.client.force_login(user)
+        response = self.client.get(reverse('earnings_chart'), {'period': 'month', 'start': yesterday.date().isoformat()})
+        self.assertEqual(sum(response.json()['orders']), 3)
+        self.assertEqual(sum(response.json()['commission']), 45.0)
+        self.assertEqual(self.client.get(reverse('earnings_chart'), {'period': 'year'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('earnings_chart'), {'link': 'abc'}).status_code, 400)
+
+
+class LinkDedupTests(TestCase):
+    def tearDown(self):
+        click_buffer.discard()
+
+    def test_canonicalize_link(self):
+        for url in [
+            'https://shopee.ph/product/123/456',
+            'https://www.shopee.com.ph/product/123/456/?utm_source=fb&af_siteid=9',
+            'https://shopee.ph/Cool-Phone-Case-i.123.456?sp_atk=abc&xptdk=def',
+        ]:
+            self.assertEqual(canonicalize_link(url), 'shopee.ph/product/123/456')
+        self.assertEqual(
+            canonicalize_link('https://shopee.ph/search?smtt=0&keyword=case&page=2'),
+            'shopee.ph/search?keyword=case&page=2',
+        )
+
+    def test_converting_the_same_product_returns_the_existing_link(self):
+        user = User.objects.create_user('repeat', password='secret-pass-123')
+        self.client.force_login(user)
+        first = self.client.post(reverse('link_converter'), {'original_link': 'https://shopee.ph/product/1/2'})
+        again = self.client.post(reverse('link_converter'), {'original_link': 'https://shopee.ph/x-i.1.2?utm_source=x'})
+        self.assertEqual(first.context['affiliate_link'].pk, again.context['affiliate_link'].pk)
+        self.assertEqual(AffiliateLink.objects.filter(user=user).count(), 1)
+        self.assertEqual(UserStats.objects.get(user=user).link_count, 1)
+
+    def test_links_created_elsewhere_get_a_canonical_key(self):
+        user = User.objects.create_user('admin-made')
+        link = AffiliateLink.objects.create(user=user, original_link='https://shopee.ph/product/1/2')
+        self.assertEqual(link.canonical_key, canonical_key('https://shopee.ph/x-i.1.2'))
+        duplicate = AffiliateLink(user=user, original_link='https://shopee.ph/x-i.1.2?utm_source=x')
+        with self.assertRaises(ValidationError):
+            duplicate.full_clean()
+
+    def test_backfill_short_codes(self):
+        user = User.objects.create_user('legacy')
+        links = [
+            make_legacy(AffiliateLink.objects.create(user=user, original_link=f'https://shopee.ph/product/5/{i}'))
+            for i in range(3)
+        ]
+        self.assertEqual(backfill_short_codes(batch_size=2), 3)
+        for link in links:
+            link.refresh_from_db()
+            self.assertTrue(link.short_code)
+            response = self.client.get(link.converted_link)
+            self.assertRedirects(response, link.original_link, fetch_redirect_response=False)
+
+        make_legacy(links[0])
+        with mock.patch('shoppelink.conversion.generate_code', return_value=links[1].short_code) as draw:
+            with self.assertRaises(IntegrityError):
+                backfill_short_codes()
+        self.assertEqual(draw.call_count, MAX_ATTEMPTS)
+
+    def test_merge_duplicate_links(self):
+        user = User.objects.create_user('dupes')
+        links = []
+        for url, click_count in [
+            ('https://shopee.ph/product/1/2', 3),
+            ('https://shopee.ph/phone-i.1.2', 4),
+            ('https://shopee.ph/product/9/9', 1),
+        ]:
+            links.append(AffiliateLink.objects.create(user=user, original_link=url, click_count=click_count))
+            # Rows from before canonical keys existed
+            AffiliateLink.objects.filter(pk=links[-1].pk).update(canonical_key=None)
+        Transaction.objects.create(user=user, affiliate_link=links[1], estimated_commission=Decimal('1.00'))
+        bucket = links[0].created_at.replace(minute=0, second=0, microsecond=0)
+        for link in links[:2]:
+            ClickRollup.objects.create(user=user, link=link, period='hour', bucket_start=bucket, clicks=2)
+
+        # The duplicate is in a later chunk than the link it merges into
+        self.assertEqual(merge_duplicate_links(batch_size=1, dry_run=True), (2, 1))
+        self.assertEqual(AffiliateLink.objects.filter(canonical_key__isnull=True).count(), 3)
+        self.assertEqual(merge_duplicate_links(batch_size=2), (2, 1))
+        survivor = AffiliateLink.objects.get(pk=links[0].pk)
+        self.assertEqual(survivor.click_count, 7)
+        self.assertEqual(AffiliateLink.objects.filter(user=user).count(), 2)
+        self.assertEqual(survivor.transactions.count(), 1)
+        self.assertEqual(ClickRollup.objects.get(link=survivor).clicks, 4)
+        self.assertEqual(UserStats.objects.get(user=user).link_count, 2)
+
+        # The merged link's tracking URLs still redirect to the product
+        redirect_cache.clear()
+        short_code_cache.clear()
+        for url in [reverse('track_link_click', args=[links[1].pk]), links[1].get_absolute_url()]:
+            response = self.client.get(url)
+            self.assertRedirects(response, 'https://shopee.ph/product/1/2', fetch_redirect_response=False)
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN output is SQLite-specific")
+class QueryPlanTests(TestCase):
+    """Fail if a page's queries scan a whole table or sort rows an index should already order."""
+
+    # "SCAN shoppelink_transaction" with no "USING ... INDEX" is a full table scan
+    FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+    # Scanned on purpose: Django's session cleanup, and the few SiteStats shards, which are summed whole
+    SMALL_TABLES = {'django_session', 'shoppelink_sitestats'}
+    # SQLite also reports a walk of the primary key that LIMIT stops early as a SCAN
+    PK_WALK = r'ORDER BY "{table}"\."id" (?:ASC|DESC) LIMIT \d+$'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('planner', password='secret-pass-123')
+        UserProfile.objects.create(user=cls.user, balance=Decimal('500.00'))
+        others = [User.objects.create_user(f'other{i}') for i in range(5)]
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in others])
+        links = AffiliateLink.objects.bulk_create([
+            AffiliateLink(user=user, original_link=f'https://shopee.ph/item-{i}', short_code=generate_code())
+            for user in [cls.user] + others for i in range(20)
+        ])
+        cls.link = make_legacy(links[0], short_code=links[0].short_code)
+        Transaction.objects.bulk_create([
+            Transaction(
+                user=link.user,
+                affiliate_link=link,
+                product_name='Item',
+                estimated_commission=Decimal('10.00'),
+                cashback_amount=Decimal('0.50'),
+                status=('pending', 'approved', 'rejected')[i % 3],
+            )
+            for i, link in enumerate(links * 5)
+        ])
+        Withdrawal.objects.bulk_create([
+            Withdrawal(user=user, amount=Decimal('100.00'), payment_method='gcash', payment_details='0917',
+                       status=('pending', 'approved')[i % 2])
+            for user in [cls.user] + others for i in range(10)
+        ])
+        cls.transaction = Transaction.objects.filter(user=cls.user).first()
+        rebuild_user_stats()
+        get_site_stats()  # builds the shards
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def tearDown(self):
+        click_buffer.discard()
+
+    def assertNoFullScans(self, url, params=None, method='get', user=None, queries=None):
+        self.client.force_login(user or self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, params or {})
+        self.assertIn(response.status_code, (200, 302))
+        if queries is not None:
+            self.assertEqual(len(ctx.captured_queries), queries, [query['sql'] for query in ctx.captured_queries])
+        with connection.cursor() as cursor:
+            for query in ctx.captured_queries:
+                sql = query['sql']
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    match = self.FULL_SCAN.match(detail)
+                    if (match and match.group(1) not in self.SMALL_TABLES
+                            and not re.search(self.PK_WALK.format(table=match.group(1)), sql)):
+                        self.fail(f"{url} scans {match.group(1)}:\n{sql}")
+                    if detail.startswith('USE TEMP B-TREE FOR ORDER BY'):
+                        self.fail(f"{url} sorts without an index:\n{sql}")
+        return response
+
+    def test_dashboard(self):
+        self.assertNoFullScans(reverse('dashboard'))
+
+    def test_transactions(self):
+        response = self.assertNoFullScans(reverse('transactions'))
+        self.assertNoFullScans(reverse('transactions'), {'cursor': response.context['page'].next_cursor})
+        self.assertNoFullScans(reverse('transactions'), {'status': 'approved'})
+
+    def test_transaction_detail(self):
+        self.assertNoFullScans(reverse('transaction_detail', args=[self.transaction.id]))
+
+    def test_affiliate_links(self):
+        response = self.assertNoFullScans(reverse('affiliate_links'))
+        self.assertNoFullScans(reverse('affiliate_links'), {'cursor': response.context['page'].next_cursor})
+
+    def test_withdrawals(self):
+        self.assertNoFullScans(reverse('withdrawals'))
+        self.assertNoFullScans(reverse('withdrawals'), {'status': 'pending'})
+
+    def test_admin_dashboard(self):
+        cache.clear()
+        staff = User.objects.create_user('staffer', is_staff=True)
+        response = self.assertNoFullScans(reverse('admin_dashboard'), user=staff, queries=6)
+        self.assertEqual(response.status_code, 200)
+        self.assertNoFullScans(reverse('admin_dashboard'), {'cursor': response.context['page'].next_cursor}, user=staff)
+        # The snapshot is cached; only the session, the user and the pending queue are read
+        self.assertNoFullScans(reverse('admin_dashboard'), user=staff, queries=3)
+
+    def test_link_converter(self):
+        url = reverse('link_converter')
+        response = self.assertNoFullScans(url, {'original_link': 'https://shopee.ph/product/7/77'}, method='post',
+                                          queries=8)
+        self.assertEqual(response.context['affiliate_link'].original_link, 'https://shopee.ph/product/7/77')
+        # Converting the same product again finds the existing link
+        self.assertNoFullScans(url, {'original_link': 'https://shopee.ph/product/7/77?ref=x'}, method='post', queries=5)
+
+    def test_track_link_click(self):
+        redirect_cache.clear()
+        self.assertNoFullScans(reverse('track_link_click', args=[self.link.id]))
+
+    def test_track_short_link(self):
+        short_code_cache.clear()
+        self.assertNoFullScans(self.link.get_absolute_url())
+        self.assertEqual(self.client.get(reverse('track_short_link', args=['nosuchcode'])).status_code, 404)
@@ -19,9 +19,15 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib.auth import views as auth_views
+from shoppelink import views as shoppelink_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics/', shoppelink_views.metrics, name='metrics'),
+    path('convert/bulk/', shoppelink_views.bulk_link_converter, name='bulk_link_converter'),
+    path('analytics/earnings/', shoppelink_views.earnings_chart, name='earnings_chart'),
+    path('analytics/earnings/site/', shoppelink_views.site_earnings_chart, name='site_earnings_chart'),
+    path('s/<str:code>/', shoppelink_views.track_short_link, name='track_short_link'),
     path('', include('shoppelink.urls')),
 ]
 
@@ -2,19 +2,37 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, authenticate
 from django.contrib import messages
-from django.db.models import Sum
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.utils.crypto import constant_time_compare
+from django.db import transaction as db_transaction
+from django.db.models import Count, Q, Sum
 from django.utils import timezone
-from decimal import Decimal
+from django.utils.dateparse import parse_date
+from datetime import timedelta
+import json
 import re
 import uuid
-from django.urls import reverse
 from django.contrib.admin.views.decorators import staff_member_required
 
-from .models import UserProfile, AffiliateLink, Transaction, Withdrawal
+from .models import UserProfile, AffiliateLink, Transaction, Withdrawal, ClickRollup
+from . import holds, ledger
+from .analytics import earnings_series
+from .clicks import click_buffer, client_fingerprint
+from .commissions import rates_for
+from .conversion import convert_links, is_shopee_link, normalize_links, shop_id_of, with_tracking_urls
+from .middleware import registry as metrics_registry
+from .pagination import paginate_keyset, status_filter
+from .redirect_cache import redirect_cache, short_code_cache
+from .routers import read_from_replica
+from .shortcodes import is_valid_code
+from .stats import get_dashboard_stats, get_site_stats, get_user_stats
 from .forms import (
     CustomUserCreationForm,
     UserProfileForm, 
     AffiliateLinkForm, 
+    BulkLinkConverterForm,
     TransactionForm, 
     WithdrawalForm,
     ProductInfoForm
@@ -68,12 +86,13 @@ def register(request):
     })
 
 @login_required
+@read_from_replica
 def dashboard(request):
     """User dashboard view"""
     user = request.user
     
-    # Get user's balance
-    profile = UserProfile.objects.get(user=user)
+    # Get user's balance and all counters in one query
+    profile = get_dashboard_stats(user)
     
     # Get recent transactions
     recent_transactions = Transaction.objects.filter(user=user).order_by('-created_at')[:5]
@@ -81,14 +100,6 @@ def dashboard(request):
     # Get pending withdrawals
     pending_withdrawals = Withdrawal.objects.filter(user=user, status='pending').order_by('-requested_at')
     
-    # Get transaction stats
-    approved_transactions = Transaction.objects.filter(user=user, status='approved')
-    pending_transactions = Transaction.objects.filter(user=user, status='pending')
-    total_cashback = approved_transactions.aggregate(Sum('cashback_amount'))['cashback_amount__sum'] or 0
-    
-    # Get link count
-    link_count = AffiliateLink.objects.filter(user=user).count()
-    
     # Get top products (based on cashback amount)
     top_products = Transaction.objects.filter(user=user, status='approved').order_by('-cashback_amount')[:5]
     
@@ -96,13 +107,13 @@ def dashboard(request):
         'profile': profile,
         'recent_transactions': recent_transactions,
         'pending_withdrawals': pending_withdrawals,
-        'total_cashback': total_cashback,
-        'transaction_count': approved_transactions.count(),
-        'pending_count': pending_transactions.count(),
-        'total_orders': Transaction.objects.filter(user=user).count(),
-        'link_count': link_count,
+        'total_cashback': profile.total_cashback,
+        'transaction_count': profile.transaction_count,
+        'pending_count': profile.pending_count,
+        'total_orders': profile.total_orders,
+        'link_count': profile.link_count,
         'top_products': top_products,
-        'available_balance': profile.balance,
+        'available_balance': holds.available_balance(profile),
     }
     
     return render(request, 'shoppelink/dashboard.html', context)
@@ -117,27 +128,12 @@ def link_converter(request):
             original_link = form.cleaned_data['original_link']
             
             # Check if it's a valid Shopee link
-            if not ('shopee.ph' in original_link or 'shopee.com.ph' in original_link):
+            if not is_shopee_link(original_link):
                 messages.error(request, "Please enter a valid Shopee link.")
                 return render(request, 'shoppelink/link_converter.html', {'form': form})
             
-            # Save the affiliate link object to get an ID
-            affiliate_link = AffiliateLink(
-                user=request.user,
-                original_link=original_link,
-                converted_link=''  # Will be updated shortly
-            )
-            affiliate_link.save()
-
-            # Generate the tracking link, which will be the converted_link
-            # The domain should be your actual domain
-            tracking_link = request.build_absolute_uri(
-                reverse('track_link_click', args=[affiliate_link.id])
-            )
-            
-            # Update the affiliate link with the tracking link
-            affiliate_link.converted_link = tracking_link
-            affiliate_link.save()
+            # One insert; the tracking link is derived from the ID when rendered
+            affiliate_link, = with_tracking_urls(request, convert_links(request.user, [original_link]))
             
             # Get product info for cashback estimation
             product_info_form = ProductInfoForm()
@@ -154,6 +150,43 @@ def link_converter(request):
     
     return render(request, 'shoppelink/link_converter.html', {'form': form})
 
+@login_required
+def bulk_link_converter(request):
+    """Convert many links at once, from the form or a JSON body of {"links": [...]}"""
+    if request.method == 'POST' and request.content_type == 'application/json':
+        try:
+            payload = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'errors': ['Request body is not valid JSON.']}, status=400)
+        values = payload.get('links') if isinstance(payload, dict) else None
+        if not isinstance(values, list):
+            return JsonResponse({'errors': ['Expected an object with a "links" list.']}, status=400)
+        
+        urls, errors = normalize_links(values)
+        if errors or not urls:
+            return JsonResponse({'errors': errors or ['Enter at least one Shopee link.']}, status=400)
+        
+        links = with_tracking_urls(request, convert_links(request.user, urls))
+        return JsonResponse({
+            'links': [
+                {'short_code': link.short_code, 'original_link': link.original_link, 'converted_link': link.converted_link}
+                for link in links
+            ]
+        }, status=201)
+    
+    links = []
+    if request.method == 'POST':
+        form = BulkLinkConverterForm(request.POST)
+        
+        if form.is_valid():
+            links = with_tracking_urls(request, convert_links(request.user, form.cleaned_data['links']))
+            messages.success(request, f"Converted {len(links)} link{'s' if len(links) != 1 else ''}.")
+            form = BulkLinkConverterForm()
+    else:
+        form = BulkLinkConverterForm()
+    
+    return render(request, 'shoppelink/bulk_link_converter.html', {'form': form, 'links': links})
+
 @login_required
 def submit_transaction(request, link_id):
     """Submit a transaction after checkout"""
@@ -166,11 +199,11 @@ def submit_transaction(request, link_id):
             product_name = form.cleaned_data['product_name']
             product_price = form.cleaned_data['product_price']
             
-            # Calculate estimated commission (placeholder - you'll need your actual commission rate)
-            estimated_commission = calculate_estimated_commission(product_price)
-            
-            # Calculate cashback (5% of commission)
-            cashback_amount = estimated_commission * Decimal('0.05')
+            # Commission and cashback from the rule for this shop
+            shop_id = shop_id_of(affiliate_link.original_link)
+            rates = rates_for(shop_id)
+            estimated_commission = rates.commission(product_price)
+            cashback_amount = rates.cashback(estimated_commission)
             
             # Create transaction
             transaction = Transaction(
@@ -178,6 +211,7 @@ def submit_transaction(request, link_id):
                 affiliate_link=affiliate_link,
                 product_name=product_name,
                 product_price=product_price,
+                shop_id=shop_id,
                 estimated_commission=estimated_commission,
                 cashback_amount=cashback_amount,
                 status='pending'
@@ -189,36 +223,50 @@ def submit_transaction(request, link_id):
     else:
         form = ProductInfoForm()
     
+    with_tracking_urls(request, [affiliate_link])
     return render(request, 'shoppelink/submit_transaction.html', {
         'form': form,
         'affiliate_link': affiliate_link
     })
 
 @login_required
+@read_from_replica
 def transaction_detail(request, transaction_id):
     """View transaction details"""
     transaction = get_object_or_404(Transaction, id=transaction_id, user=request.user)
+    if transaction.affiliate_link:
+        with_tracking_urls(request, [transaction.affiliate_link])
     
     return render(request, 'shoppelink/transaction_detail.html', {
         'transaction': transaction
     })
 
 @login_required
+@read_from_replica
 def transactions(request):
     """View all user transactions"""
-    transactions = Transaction.objects.filter(user=request.user).order_by('-created_at')
+    status = status_filter(request, Transaction)
+    transactions = Transaction.objects.filter(user=request.user)
+    if status:
+        transactions = transactions.filter(status=status)
+    page = paginate_keyset(transactions, request.GET.get('cursor'))
     
     return render(request, 'shoppelink/transactions.html', {
-        'transactions': transactions
+        'transactions': page,
+        'page': page,
+        'status': status,
+        'status_choices': Transaction.STATUS_CHOICES,
+        'stats': get_user_stats(request.user),
     })
 
 @login_required
 def request_withdrawal(request):
     """Request a withdrawal"""
     user_profile = UserProfile.objects.get(user=request.user)
+    available = holds.available_balance(user_profile)
     
     # Check if user has enough balance
-    if user_profile.balance < 100:
+    if available < holds.MINIMUM_WITHDRAWAL:
         messages.error(request, "You need at least ₱100 to request a withdrawal.")
         return redirect('dashboard')
     
@@ -226,113 +274,227 @@ def request_withdrawal(request):
         form = WithdrawalForm(request.POST)
         
         if form.is_valid():
-            amount = form.cleaned_data['amount']
-            
-            # Check if withdrawal amount is valid
-            if amount > user_profile.balance:
-                messages.error(request, "You cannot withdraw more than your available balance.")
-                return render(request, 'shoppelink/request_withdrawal.html', {'form': form})
-            
-            if amount < 100:
-                messages.error(request, "Minimum withdrawal amount is ₱100.")
-                return render(request, 'shoppelink/request_withdrawal.html', {'form': form})
-            
-            # Create withdrawal request
-            withdrawal = Withdrawal(
-                user=request.user,
-                amount=amount,
-                payment_method=form.cleaned_data['payment_method'],
-                payment_details=form.cleaned_data['payment_details'],
-                status='pending'
-            )
-            withdrawal.save()
+            # The balance is checked and held under a lock; a resubmitted form carries the same key
+            try:
+                holds.request_withdrawal(
+                    request.user,
+                    form.cleaned_data['amount'],
+                    form.cleaned_data['payment_method'],
+                    form.cleaned_data['payment_details'],
+                    idempotency_key=form.cleaned_data['idempotency_key'],
+                )
+            except ValueError as e:
+                messages.error(request, str(e))
+                return render(request, 'shoppelink/request_withdrawal.html', {'form': form, 'balance': available})
             
             messages.success(request, "Withdrawal request submitted successfully!")
             return redirect('dashboard')
     else:
-        form = WithdrawalForm(initial={'amount': user_profile.balance})
+        form = WithdrawalForm(initial={'amount': available, 'idempotency_key': uuid.uuid4().hex})
     
     return render(request, 'shoppelink/request_withdrawal.html', {
         'form': form,
-        'balance': user_profile.balance
+        'balance': available
     })
 
 @login_required
+@read_from_replica
 def withdrawals(request):
     """View all user withdrawals"""
-    withdrawals = Withdrawal.objects.filter(user=request.user).order_by('-requested_at')
+    status = status_filter(request, Withdrawal)
+    withdrawals = Withdrawal.objects.filter(user=request.user)
+    counts = withdrawals.aggregate(
+        pending_count=Count('id', filter=Q(status='pending')),
+        approved_count=Count('id', filter=Q(status='approved')),
+    )
+    if status:
+        withdrawals = withdrawals.filter(status=status)
+    page = paginate_keyset(withdrawals, request.GET.get('cursor'), order_field='requested_at')
     
-    # Calculate total withdrawn amount
-    total_withdrawn = Withdrawal.objects.filter(
-        user=request.user, 
-        status='approved'
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
+    # Total withdrawn amount is kept in the user's stats row
+    total_withdrawn = get_user_stats(request.user).total_withdrawn
+    
+    # Pending withdrawals hold part of the balance; only the rest can be requested
+    available_balance = holds.available_balance(UserProfile.objects.get(user=request.user))
     
     return render(request, 'shoppelink/withdrawals.html', {
-        'withdrawals': withdrawals,
-        'total_withdrawn': total_withdrawn
+        'withdrawals': page,
+        'page': page,
+        'status': status,
+        'status_choices': Withdrawal.STATUS_CHOICES,
+        'pending_count': counts['pending_count'],
+        'approved_count': counts['approved_count'],
+        'total_withdrawn': total_withdrawn,
+        'available_balance': available_balance,
     })
 
+ADMIN_SNAPSHOT_CACHE_KEY = 'shoppelink:admin_dashboard'
+
+def _admin_snapshot():
+    """Site totals and recent activity; none of it scans a whole table."""
+    from django.contrib.auth.models import User
+    
+    site_stats = get_site_stats()
+    return {
+        'site_stats': site_stats,
+        'total_users': site_stats['user_count'],
+        'total_links': site_stats['link_count'],
+        'total_transactions': site_stats['total_orders'],
+        'total_cashback': site_stats['approved_cashback'],
+        'recent_transactions': list(Transaction.objects.select_related('user').order_by('-created_at')[:10]),
+        # The primary key follows date_joined, and unlike it is indexed
+        'recent_users': list(User.objects.order_by('-pk')[:5]),
+        'snapshot_at': timezone.now(),
+    }
+
 @staff_member_required
 def admin_dashboard(request):
     """Admin dashboard with overall stats."""
+    # Every staff member sees the same snapshot, refreshed every few seconds
+    context = cache.get_or_set(ADMIN_SNAPSHOT_CACHE_KEY, _admin_snapshot, settings.ADMIN_DASHBOARD_CACHE_TTL)
     
-    # Import User model at the function level to avoid circular imports
-    from django.contrib.auth.models import User
-    
-    # Overall stats
-    total_users = User.objects.count()
-    total_links = AffiliateLink.objects.count()
-    total_transactions = Transaction.objects.count()
-    total_cashback = Transaction.objects.filter(status='approved').aggregate(Sum('cashback_amount'))['cashback_amount__sum'] or 0
-    
-    # Recent activity
-    recent_transactions = Transaction.objects.order_by('-created_at')[:10]
-    recent_users = User.objects.order_by('-date_joined')[:5]
+    # One page of the pending queue at a time, read by range on (status, requested_at)
+    pending_withdrawals = paginate_keyset(
+        Withdrawal.objects.filter(status='pending').select_related('user'),
+        request.GET.get('cursor'),
+        order_field='requested_at',
+        per_page=settings.ADMIN_PENDING_WITHDRAWALS_PER_PAGE,
+    )
     
-    # Pending withdrawals
-    pending_withdrawals = Withdrawal.objects.filter(status='pending').order_by('-requested_at')
-
-    context = {
-        'total_users': total_users,
-        'total_links': total_links,
-        'total_transactions': total_transactions,
-        'total_cashback': total_cashback,
-        'recent_transactions': recent_transactions,
-        'recent_users': recent_users,
+    return render(request, 'shoppelink/admin_dashboard.html', {
+        **context,
         'pending_withdrawals': pending_withdrawals,
-    }
+        'page': pending_withdrawals,
+        'redirect_cache_stats': redirect_cache.stats(),
+    })
+
+def metrics(request):
+    """Request metrics collected by the profiling middleware, in Prometheus text format."""
+    token = settings.PROFILING_METRICS_TOKEN
+    bearer = request.headers.get('Authorization', '')
+    if not (request.user.is_staff or (token and constant_time_compare(bearer, f'Bearer {token}'))):
+        return HttpResponseForbidden()
     
-    return render(request, 'shoppelink/admin_dashboard.html', context)
+    lines = [metrics_registry.render_prometheus().rstrip('\n')]
+    for name, value in redirect_cache.stats().items():
+        lines.append(f'shoppelink_redirect_cache_{name} {value}')
+    for name, value in short_code_cache.stats().items():
+        lines.append(f'shoppelink_short_code_cache_{name} {value}')
+    lines.append(f'shoppelink_click_buffer_pending {click_buffer.pending}')
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
 
 @login_required
 def delete_transaction(request, transaction_id):
     """Deletes a transaction."""
-    transaction = get_object_or_404(Transaction, id=transaction_id, user=request.user)
+    get_object_or_404(Transaction, id=transaction_id, user=request.user)
     
     if request.method == 'POST':
-        # If the transaction was approved, deduct the cashback from the user's balance
-        if transaction.status == 'approved':
-            profile = request.user.profile
-            profile.balance -= transaction.cashback_amount
-            profile.save()
-            messages.success(request, f"Transaction #{transaction.id} deleted and ₱{transaction.cashback_amount} deducted from your balance.")
-        else:
-            messages.success(request, f"Transaction #{transaction.id} deleted.")
-        
-        transaction.delete()
+        with db_transaction.atomic():
+            # Lock the row and read its status again: a concurrent delete or settlement may have changed it
+            transaction = (
+                Transaction.objects.select_for_update().filter(id=transaction_id, user=request.user).first()
+            )
+            if transaction is None:
+                return redirect('transactions')
+            # If the transaction was approved, deduct the cashback from the user's balance
+            if transaction.status == 'approved':
+                ledger.post(
+                    request.user.id,
+                    -transaction.cashback_amount,
+                    'reversal',
+                    transaction=transaction,
+                    memo=f"Transaction #{transaction.id} deleted",
+                )
+                messages.success(request, f"Transaction #{transaction.id} deleted and ₱{transaction.cashback_amount} deducted from your balance.")
+            else:
+                messages.success(request, f"Transaction #{transaction.id} deleted.")
+            
+            transaction.delete()
     
     return redirect('transactions')
 
 @login_required
+@read_from_replica
 def affiliate_links(request):
     """Displays all affiliate links generated by the user."""
-    links = AffiliateLink.objects.filter(user=request.user).order_by('-created_at')
+    status = status_filter(request, AffiliateLink)
+    links = AffiliateLink.objects.filter(user=request.user)
+    if status:
+        links = links.filter(status=status)
+    page = paginate_keyset(links, request.GET.get('cursor'))
+    
+    # Recent clicks come from the pre-aggregated hourly rollups
+    since = timezone.now() - timedelta(hours=24)
+    recent_clicks = dict(
+        ClickRollup.objects.filter(link__in=[link.id for link in page], period='hour', bucket_start__gte=since)
+        .values('link_id')
+        .annotate(clicks=Sum('clicks'))
+        .values_list('link_id', 'clicks')
+    )
+    for link in page:
+        link.clicks_24h = recent_clicks.get(link.id, 0)
+    with_tracking_urls(request, page)
+    
     context = {
-        'links': links
+        'links': page,
+        'page': page,
+        'status': status,
+        'status_choices': AffiliateLink.STATUS_CHOICES,
     }
     return render(request, 'shoppelink/affiliate_links.html', context)
 
+# Default span of a series when no start date is given
+SERIES_SPANS = {'day': timedelta(days=29), 'week': timedelta(weeks=25), 'month': timedelta(days=365)}
+
+def _earnings_series_response(request, user=None, link=None):
+    """JSON series for `user`/`link` from the period, start and end query parameters."""
+    period = request.GET.get('period', 'day')
+    if period not in SERIES_SPANS:
+        return JsonResponse({'errors': [f'period must be one of {", ".join(SERIES_SPANS)}.']}, status=400)
+    try:
+        last = parse_date(request.GET['end']) if request.GET.get('end') else timezone.localdate()
+        first = parse_date(request.GET['start']) if request.GET.get('start') else last - SERIES_SPANS[period]
+        if first is None or last is None:
+            raise ValueError("Dates must be given as YYYY-MM-DD.")
+        series = earnings_series(period, first, last, user=user, link=link)
+    except ValueError as e:
+        return JsonResponse({'errors': [str(e)]}, status=400)
+    return JsonResponse(series)
+
+def _invalid_id(request, *names):
+    """A 400 response if one of the query parameters `names` is given but is not an ID, else None."""
+    for name in names:
+        value = request.GET.get(name)
+        if value and not value.isdigit():
+            return JsonResponse({'errors': [f'{name} must be a numeric ID.']}, status=400)
+    return None
+
+@login_required
+@read_from_replica
+def earnings_chart(request):
+    """Daily, weekly or monthly earnings and clicks of the user, or of one of their links."""
+    error = _invalid_id(request, 'link')
+    if error:
+        return error
+    link = None
+    if request.GET.get('link'):
+        link = get_object_or_404(AffiliateLink, pk=request.GET['link'], user=request.user)
+    return _earnings_series_response(request, user=request.user, link=link)
+
+@staff_member_required
+@read_from_replica
+def site_earnings_chart(request):
+    """Earnings and clicks of the whole site, or of any user or link."""
+    error = _invalid_id(request, 'link', 'user')
+    if error:
+        return error
+    link = user = None
+    if request.GET.get('link'):
+        link = get_object_or_404(AffiliateLink, pk=request.GET['link'])
+    elif request.GET.get('user'):
+        user = request.GET['user']
+    return _earnings_series_response(request, user=user, link=link)
+
 # Helper functions
 def convert_to_affiliate_link(original_link, username):
     """Convert a Shopee link to an affiliate link"""
@@ -350,20 +512,29 @@ def convert_to_affiliate_link(original_link, username):
     
     return affiliate_link
 
-def calculate_estimated_commission(product_price):
-    """Calculate estimated commission based on product price (placeholder)."""
-    # Replace with your actual commission calculation logic
-    # For example, a flat 10% commission rate
-    commission_rate = Decimal('0.10')
-    return product_price * commission_rate
+def calculate_estimated_commission(product_price, shop_id='', category=''):
+    """Estimated commission on a sale, at the rate of the matching commission rule."""
+    return rates_for(shop_id, category).commission(product_price)
 
 def track_link_click(request, link_id):
     """Tracks a click on an affiliate link and redirects to the original URL."""
-    affiliate_link = get_object_or_404(AffiliateLink, id=link_id)
+    original_link = redirect_cache.get(link_id)
+    if original_link is None:
+        raise Http404("No AffiliateLink matches the given query.")
     
-    # Increment the click count
-    affiliate_link.click_count += 1
-    affiliate_link.save(update_fields=['click_count'])
+    # Queue the click; the buffer writes counts back in batches
+    click_buffer.record(link_id, client_fingerprint(request))
     
     # Redirect to the original Shopee link
-    return redirect(affiliate_link.original_link)
+    return redirect(original_link)
+
+def track_short_link(request, code):
+    """Tracks a click on a short-code tracking URL and redirects to the original URL."""
+    resolved = short_code_cache.get(code) if is_valid_code(code) else None
+    if resolved is None:
+        raise Http404("No AffiliateLink matches the given query.")
+    
+    link_id, original_link = resolved
+    click_buffer.record(link_id, client_fingerprint(request))
+    
+    return redirect(original_link)